@@ -0,0 +1,121 @@
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Content defined chunking of files, based on the FastCDC algorithm.
+A file is split at positions chosen by a rolling gear hash of its content instead of
+at fixed offsets, so inserting or changing bytes in the middle of a large file only changes
+the chunks around the change. The rest of the chunks stay the same and don't have to be stored again.
+
+The rolling hash is calculated with numpy a block at a time when it is installed, which is much faster
+than the byte by byte loop used without it. Both give exactly the same cut points.
+"""
+
+DEFAULT_AVERAGE_CHUNK_SIZE = 1024 * 1024
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+HASH_WINDOW = 64 # A byte is shifted out of the 64-bit fingerprint after this many more bytes
+HASH_BLOCK_SIZE = 256 * 1024 # How many fingerprints are calculated at a time with numpy
+
+# The gear table has to stay the same forever, otherwise the chunk boundaries of new backups would not match the old ones.
+GEAR = [random.Random(i).getrandbits(64) for i in range(0, 256)]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+
+class ContentDefinedChunker:
+    """
+    Splits files into chunks of min_size to max_size bytes, averaging around average_size.
+    Uses normalized chunking: cut points before the average size have to match
+    a stricter mask than cut points after it, which keeps chunk sizes close to the average.
+    The first min_size bytes of each chunk are never hashed, since no cut can happen there.
+    """
+
+    def __init__(self, average_size=DEFAULT_AVERAGE_CHUNK_SIZE, min_size=None, max_size=None):
+        self.average_size = int(average_size)
+        self.min_size = int(min_size) if min_size else self.average_size // 4
+        self.max_size = int(max_size) if max_size else self.average_size * 4
+        bits = max(self.average_size.bit_length() - 1, 1)
+        self.strict_mask = self._get_mask(bits + 2)
+        self.loose_mask = self._get_mask(bits - 2)
+
+    def chunks(self, path):
+        """
+        Yields the content of the file at the given path as content defined chunks.
+        Only up to max_size bytes of the file are buffered at a time.
+        """
+        with open(path, 'rb') as f:
+            buffer = b''
+            offset = 0
+            eof = False
+            while True:
+                if not eof and len(buffer) - offset < self.max_size:
+                    data = f.read(self.max_size * 2)
+                    eof = not data
+                    buffer = buffer[offset:] + data
+                    offset = 0
+                    continue
+                if offset >= len(buffer):
+                    return
+                view = memoryview(buffer)[offset:]
+                cut = self._find_cut(view)
+                yield bytes(view[:cut])
+                offset += cut
+
+    def _find_cut(self, data):
+        """
+        Returns the length of the next chunk at the start of the given data.
+        """
+        length = len(data)
+        if length <= self.min_size:
+            return length
+        normal_size = min(self.average_size, length)
+        max_size = min(self.max_size, length)
+        if GEAR_ARRAY is not None:
+            return self._find_cut_vectorized(data, normal_size, max_size)
+        fingerprint = 0
+        gear = GEAR
+        mask = self.strict_mask
+        for i in range(self.min_size, normal_size):
+            fingerprint = ((fingerprint << 1) + gear[data[i]]) & MASK_64
+            if not fingerprint & mask:
+                return i + 1
+        mask = self.loose_mask
+        for i in range(normal_size, max_size):
+            fingerprint = ((fingerprint << 1) + gear[data[i]]) & MASK_64
+            if not fingerprint & mask:
+                return i + 1
+        return max_size
+
+    def _find_cut_vectorized(self, data, normal_size, max_size):
+        """
+        Same as the loop in _find_cut, but calculates the fingerprints of a block of positions at once with numpy.
+        The fingerprint at a position is the sum of gear[byte] << distance over the last 64 bytes
+        since min_size, which is built up by doubling the window six times.
+        """
+        content = numpy.frombuffer(data, dtype=numpy.uint8)
+        for start in range(self.min_size, max_size, HASH_BLOCK_SIZE):
+            end = min(start + HASH_BLOCK_SIZE, max_size)
+            context = min(start - self.min_size, HASH_WINDOW - 1)
+            fingerprints = GEAR_ARRAY[content[start - context:end]]
+            width = 1
+            while width < HASH_WINDOW:
+                fingerprints[width:] += fingerprints[:-width] << numpy.uint64(width)
+                width *= 2
+            fingerprints = fingerprints[context:]
+            strict_end = min(max(normal_size - start, 0), end - start)
+            for first, last, mask in ((0, strict_end, self.strict_mask), (strict_end, end - start, self.loose_mask)):
+                matches = numpy.flatnonzero((fingerprints[first:last] & numpy.uint64(mask)) == 0)
+                if len(matches):
+                    return start + first + int(matches[0]) + 1
+        return max_size
+
+    def _get_mask(self, bits):
+        """
+        Returns a mask with the given number of bits set in the top of a 64-bit fingerprint.
+        The top bits depend on the most bytes of the rolling window, which gives better cut points.
+        """
+        bits = max(bits, 1)
+        return ((1 << bits) - 1) << (64 - bits)
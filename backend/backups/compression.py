@@ -0,0 +1,201 @@
+import os
+import bz2
+import lzma
+import math
+import zlib
+from collections import Counter
+
+from becky.utils import iter_file_chunks
+
+"""
+Streaming compression of backed up files.
+The codec and level are backup parameters ('compression' and 'compression_level').
+Files that are already compressed are stored as is: they are recognized by their extension
+or, failing that, by the entropy of their first block. The first block is the first chunk the copy reads,
+so probing never reads a file twice (see ProbingCompressor).
+The codec used for each file is saved to BackupItem.compression, so restore knows how to decompress it.
+"""
+
+NO_COMPRESSION = 'none'
+COMPRESSION_CODECS = [NO_COMPRESSION, 'zlib', 'lzma', 'bz2', 'zstd']
+COMPRESSION_LEVELS = {'zlib': (-1, 9), 'lzma': (0, 9), 'bz2': (1, 9), 'zstd': (-131072, 22)} # Lowest and highest level of each codec
+PROBE_SIZE = 64 * 1024
+MAX_ENTROPY = 7.5 # Bits per byte, anything above this won't compress noticeably
+COMPRESSED_EXTENSIONS = set([
+    '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.lz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.jar', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a',
+    '.mp4', '.m4v', '.mkv', '.webm', '.avi', '.mov', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.pdf',
+])
+
+
+def get_compressor(codec, level=None):
+    """
+    Returns a new streaming compressor object with compress() and flush() methods for the given codec.
+    If no level is given, the default level of the codec is used.
+    """
+    if codec == 'zlib':
+        return zlib.compressobj(int(level) if level is not None else zlib.Z_DEFAULT_COMPRESSION)
+    elif codec == 'lzma':
+        return lzma.LZMACompressor(preset=int(level) if level is not None else None)
+    elif codec == 'bz2':
+        return bz2.BZ2Compressor(int(level) if level is not None else 9)
+    elif codec == 'zstd':
+        return _import_zstandard().ZstdCompressor(level=int(level) if level is not None else 3).compressobj()
+    else:
+        raise UnsupportedCompressionCodecException(codec)
+
+def get_decompressor(codec):
+    """
+    Returns a new streaming decompressor object with a decompress() method for the given codec.
+    """
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    elif codec == 'lzma':
+        return lzma.LZMADecompressor()
+    elif codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif codec == 'zstd':
+        return _import_zstandard().ZstdDecompressor().decompressobj()
+    else:
+        raise UnsupportedCompressionCodecException(codec)
+
+def compress_bytes(data, codec, level=None):
+    """
+    Compresses the given bytes in one go.
+    """
+    if codec == NO_COMPRESSION:
+        return data
+    compressor = get_compressor(codec, level)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_bytes(data, codec):
+    """
+    Decompresses the given bytes in one go.
+    """
+    if codec == NO_COMPRESSION:
+        return data
+    return get_decompressor(codec).decompress(data)
+
+def iter_decompressed_chunks(path, codec):
+    """
+    Yields the decompressed content of the file at the given path in chunks,
+    without ever holding the whole file in memory.
+    """
+    if codec == NO_COMPRESSION:
+        yield from iter_file_chunks(path)
+        return
+    decompressor = get_decompressor(codec)
+    for chunk in iter_file_chunks(path):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+def is_compressible(path, first_block=None):
+    """
+    Returns whether the file at the given path is worth compressing.
+    Files with a known compressed extension are skipped right away,
+    otherwise the entropy of the given first block of the file is probed.
+    Without a first block, only the extension is checked.
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    if first_block is None:
+        return True
+    return calculate_entropy(first_block[:PROBE_SIZE]) <= MAX_ENTROPY
+
+def calculate_entropy(data):
+    """
+    Returns the Shannon entropy of the given bytes in bits per byte.
+    """
+    if not data:
+        return 0.0
+    length = len(data)
+    return -sum((count / length) * math.log2(count / length) for count in Counter(data).values())
+
+def choose_codec(path, codec, first_block=None):
+    """
+    Returns the codec that should be used for the file at the given path.
+    Without the first block of the file, the codec may still turn out to be 'none' once the content is probed.
+    """
+    if codec == NO_COMPRESSION or not is_compressible(path, first_block):
+        return NO_COMPRESSION
+    return codec
+
+def validate_compression_level(codec, level):
+    """
+    Returns the given compression level as an integer, or None if it isn't set.
+    Raises InvalidCompressionLevelException if the level isn't an integer within the range of the codec.
+    """
+    if level is None or str(level).strip() == '':
+        return None
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        raise InvalidCompressionLevelException(level)
+    lowest, highest = COMPRESSION_LEVELS.get(codec, (level, level))
+    if not lowest <= level <= highest:
+        raise InvalidCompressionLevelException(level, message="Compression level is out of range for codec {}.".format(codec))
+    return level
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise UnsupportedCompressionCodecException('zstd', message="The zstandard package is not installed.")
+    return zstandard
+
+
+class ProbingCompressor:
+    """
+    A streaming compressor that probes the first chunk it is given before compressing anything.
+    If the chunk looks already compressed, the rest of the data is passed through as is and codec becomes 'none'.
+    The codec has to be read after the data has been compressed, it is the one the data was stored with.
+    """
+
+    def __init__(self, codec, level=None):
+        self.codec = codec
+        self.level = level
+        self.compressor = None
+        self.probed = False
+
+    def compress(self, data):
+        if not self.probed:
+            self.probed = True
+            if is_compressible('', data):
+                self.compressor = get_compressor(self.codec, self.level)
+            else:
+                self.codec = NO_COMPRESSION
+        if self.compressor is None:
+            return data
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if self.compressor is None:
+            return b''
+        return self.compressor.flush()
+
+
+class UnsupportedCompressionCodecException(Exception):
+
+    def __init__(self, codec, message="Attempted to use an unsupported compression codec."):
+        self.codec = codec
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return "{} -- Codec {} is not supported.".format(self.message, str(self.codec))
+
+
+class InvalidCompressionLevelException(Exception):
+
+    def __init__(self, level, message="Attempted to use an invalid compression level."):
+        self.level = level
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return "{} -- Compression level {} is not valid.".format(self.message, str(self.level))
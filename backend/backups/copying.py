@@ -0,0 +1,108 @@
+import os
+import errno
+import threading
+import shutil
+from collections import Counter
+
+from backups.throttling import THROTTLED_SLICE_SIZE
+
+"""
+Copying files without moving their data through user space.
+The strategies are tried from the cheapest to the most expensive:
+    clone - FICLONE ioctl, shares the data blocks on copy-on-write file systems (btrfs, xfs, ...).
+    copy_file_range - the kernel copies the data, possibly server side on network file systems.
+    sendfile - the kernel copies the data through the page cache.
+    buffered - plain read/write through a user space buffer, works everywhere.
+Once a strategy fails as unsupported between two devices, it isn't tried again between them.
+The buffered copy is never marked unsupported, an error in it is a real error and is raised.
+If a RateLimiter (see backups.throttling) limits the bandwidth, data is copied in slices
+of THROTTLED_SLICE_SIZE bytes and each slice waits for its tokens.
+"""
+
+COPY_STRATEGIES = ['clone', 'copy_file_range', 'sendfile', 'buffered']
+FICLONE = 0x40049409
+UNSUPPORTED_ERRNOS = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP])
+
+
+class CopyEngine:
+
+    def __init__(self, strategies=None, limiter=None):
+        self.strategies = [strategy for strategy in (strategies or COPY_STRATEGIES) if strategy in COPY_STRATEGIES]
+        if 'buffered' not in self.strategies:
+            self.strategies.append('buffered')
+        self.unsupported = set()
+        self.statistics = Counter()
+        self.lock = threading.Lock()
+        self.limiter = limiter
+
+    def copy(self, source_path, destination_path):
+        """
+        Copies the file at source_path to destination_path with the first strategy that works.
+        Returns the name of the used strategy. Raises OSError if no strategy could copy the file.
+        """
+        with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+            devices = (os.fstat(source.fileno()).st_dev, os.fstat(destination.fileno()).st_dev)
+            size = os.fstat(source.fileno()).st_size
+            for strategy in self.strategies:
+                if (strategy, devices) in self.unsupported:
+                    continue
+                try:
+                    getattr(self, '_copy_{}'.format(strategy))(source, destination, size)
+                except (OSError, AttributeError, ImportError) as e:
+                    if strategy == 'buffered' or (isinstance(e, OSError) and e.errno not in UNSUPPORTED_ERRNOS):
+                        raise
+                    self.unsupported.add((strategy, devices))
+                    source.seek(0)
+                    destination.seek(0)
+                    destination.truncate()
+                    continue
+                with self.lock:
+                    self.statistics[strategy] += 1
+                return strategy
+        raise OSError(errno.EIO, 'No copy strategy could copy the file', source_path)
+
+    def _copy_clone(self, source, destination, size):
+        import fcntl
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+    def _copy_copy_file_range(self, source, destination, size):
+        offset = 0
+        while offset < size:
+            copied = os.copy_file_range(source.fileno(), destination.fileno(), self._get_slice_size(size - offset), offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+            self._throttle(copied)
+
+    def _copy_sendfile(self, source, destination, size):
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(destination.fileno(), source.fileno(), offset, self._get_slice_size(size - offset))
+            if sent == 0:
+                break
+            offset += sent
+            self._throttle(sent)
+
+    def _copy_buffered(self, source, destination, size):
+        if not self._is_throttled():
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+            return
+        while True:
+            data = source.read(THROTTLED_SLICE_SIZE)
+            if not data:
+                break
+            destination.write(data)
+            self._throttle(len(data))
+
+    def _is_throttled(self):
+        return self.limiter is not None and self.limiter.get_bandwidth_limit() > 0
+
+    def _get_slice_size(self, remaining):
+        """
+        Returns how much should be copied with the next call, given the number of bytes remaining.
+        """
+        return min(remaining, THROTTLED_SLICE_SIZE) if self._is_throttled() else remaining
+
+    def _throttle(self, size):
+        if self.limiter is not None:
+            self.limiter.consume_bytes(size)
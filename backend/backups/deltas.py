@@ -0,0 +1,104 @@
+import hashlib
+import struct
+
+from backups.chunking import ContentDefinedChunker
+
+"""
+Binary deltas between two versions of a file.
+The previous version (the base) is split into content defined chunks and indexed by their hashes.
+The new version is chunked the same way: chunks found in the base are written as references
+to the base, the rest are written as literal data. Since the chunk boundaries follow the content,
+inserted or removed bytes only affect the chunks around them.
+
+A delta file is a sequence of records:
+    b'C' + offset + length - copy length bytes from the given offset of the base.
+    b'L' + length + data - the data itself.
+Offsets and lengths are unsigned 64-bit big endian integers.
+"""
+
+DELTA_CHUNK_SIZE = 8 * 1024
+COPY_RECORD = b'C'
+LITERAL_RECORD = b'L'
+COPY_HEADER = struct.Struct('>QQ')
+LITERAL_HEADER = struct.Struct('>Q')
+
+
+def get_delta_chunker():
+    return ContentDefinedChunker(average_size=DELTA_CHUNK_SIZE)
+
+def build_delta_index(base_path, chunker=None):
+    """
+    Returns a dictionary from the hash of each chunk of the base file to the chunk's offset and length.
+    """
+    chunker = chunker or get_delta_chunker()
+    index = {}
+    offset = 0
+    for chunk in chunker.chunks(base_path):
+        index.setdefault(_hash_chunk(chunk), (offset, len(chunk)))
+        offset += len(chunk)
+    return index
+
+def write_delta(source_path, base_index, delta_file, hasher=None, max_literal_bytes=None, chunker=None):
+    """
+    Writes a delta from the indexed base to the file at source_path into the given open file.
+    If a hasher is given, it is updated with the content of the source file.
+    Returns the number of literal bytes written, or None if writing was stopped because
+    there would have been more than max_literal_bytes of them.
+    """
+    chunker = chunker or get_delta_chunker()
+    literal_bytes = 0
+    pending_copy = None
+    for chunk in chunker.chunks(source_path):
+        if hasher is not None:
+            hasher.update(chunk)
+        match = base_index.get(_hash_chunk(chunk))
+        if match is not None and match[1] == len(chunk):
+            if pending_copy is not None and pending_copy[0] + pending_copy[1] == match[0]:
+                pending_copy = (pending_copy[0], pending_copy[1] + match[1])
+            else:
+                _write_copy(delta_file, pending_copy)
+                pending_copy = match
+            continue
+        _write_copy(delta_file, pending_copy)
+        pending_copy = None
+        literal_bytes += len(chunk)
+        if max_literal_bytes is not None and literal_bytes > max_literal_bytes:
+            return None
+        delta_file.write(LITERAL_RECORD + LITERAL_HEADER.pack(len(chunk)))
+        delta_file.write(chunk)
+    _write_copy(delta_file, pending_copy)
+    return literal_bytes
+
+def iter_applied_delta(delta_path, base_path, read_size=1024 * 1024):
+    """
+    Yields the content of the file rebuilt by applying the delta at delta_path to the base file at base_path.
+    """
+    with open(delta_path, 'rb') as delta_file, open(base_path, 'rb') as base_file:
+        while True:
+            record = delta_file.read(1)
+            if not record:
+                return
+            if record == COPY_RECORD:
+                offset, length = COPY_HEADER.unpack(delta_file.read(COPY_HEADER.size))
+                base_file.seek(offset)
+                yield from _iter_read(base_file, length, read_size)
+            elif record == LITERAL_RECORD:
+                length, = LITERAL_HEADER.unpack(delta_file.read(LITERAL_HEADER.size))
+                yield from _iter_read(delta_file, length, read_size)
+            else:
+                raise ValueError('Unknown delta record {!r} in {}'.format(record, delta_path))
+
+def _write_copy(delta_file, copy):
+    if copy is not None:
+        delta_file.write(COPY_RECORD + COPY_HEADER.pack(*copy))
+
+def _iter_read(f, length, read_size):
+    while length > 0:
+        data = f.read(min(length, read_size))
+        if not data:
+            raise EOFError('Delta refers past the end of the file.')
+        length -= len(data)
+        yield data
+
+def _hash_chunk(chunk):
+    return hashlib.blake2b(chunk, digest_size=16).digest()
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backups.models import Backup
+
+
+class Command(BaseCommand):
+    help = 'Moves the stored files of existing backups to the current output layout of their provider, f.ex. from a flat local store to the sharded one or back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('backups', nargs='*', help='Names of the backups to migrate. All backups are migrated by default.')
+
+    def handle(self, *args, **options):
+        backup_models = Backup.objects.all()
+        if options['backups']:
+            backup_models = backup_models.filter(name__in=options['backups'])
+            missing = set(options['backups']) - set(backup_models.values_list('name', flat=True))
+            if missing:
+                raise CommandError('No backups named {}.'.format(', '.join(sorted(missing))))
+        for backup_model in backup_models:
+            try:
+                moved_count = backup_model.get_backup_provider().migrate_layout()
+            finally:
+                backup_model.get_logger().flush()
+            if moved_count is None:
+                self.stdout.write('{}: the provider has a single layout, nothing to migrate.'.format(backup_model.name))
+            else:
+                self.stdout.write('{}: moved {} files.'.format(backup_model.name, moved_count))
@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 06:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0024_backupmetadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupitem',
+            name='checksum_algorithm',
+            field=models.CharField(default='md5', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='backupitem',
+            name='checksum',
+            field=models.CharField(max_length=128),
+        ),
+    ]
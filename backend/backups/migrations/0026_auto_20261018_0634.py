@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-18 06:34
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0025_auto_20261018_0631'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChecksumCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device', models.BigIntegerField()),
+                ('inode', models.BigIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('mtime_ns', models.BigIntegerField()),
+                ('ctime_ns', models.BigIntegerField()),
+                ('algorithm', models.CharField(max_length=16)),
+                ('checksum', models.CharField(max_length=128)),
+                ('last_used', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='checksumcacheentry',
+            constraint=models.UniqueConstraint(fields=('device', 'inode', 'size', 'mtime_ns', 'ctime_ns', 'algorithm'), name='unique_checksum_fingerprint'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 06:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0026_auto_20261018_0634'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupitem',
+            name='storage_format',
+            field=models.CharField(default='file', max_length=16),
+        ),
+    ]
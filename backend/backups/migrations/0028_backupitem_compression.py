@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 06:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0027_backupitem_storage_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupitem',
+            name='compression',
+            field=models.CharField(default='none', max_length=16),
+        ),
+    ]
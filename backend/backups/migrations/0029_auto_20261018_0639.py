@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 06:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0028_backupitem_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupitem',
+            name='pack_length',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='backupitem',
+            name='pack_offset',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-18 06:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0029_auto_20261018_0639'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupitem',
+            name='delta_base',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='delta_versions', to='backups.backupitem'),
+        ),
+        migrations.AddField(
+            model_name='backupitem',
+            name='delta_chain',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2 on 2026-10-18 06:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0030_auto_20261018_0641'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='backupitem',
+            index=models.Index(fields=['backup', 'path', 'creation_time'], name='backup_item_path_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backupitem',
+            index=models.Index(fields=['backup', 'directory'], name='backup_item_directory_idx'),
+        ),
+    ]
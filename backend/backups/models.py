@@ -1,18 +1,26 @@
 import json
 import os
+import stat
 import pathlib
 import datetime
 import hashlib
 import uuid
 from django.db import models, transaction
+from django.db.models import Q, OuterRef, Subquery
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 
 from settings.models import GlobalParameter
 from logs.models import BackupLogger
-from becky.utils import remove_prefix, calculate_checksum
+from backups.progress import ProgressReporter
+from backups.pipeline import ChecksumStage, PipelineStatistics
+from backups.compression import NO_COMPRESSION, COMPRESSION_CODECS, UnsupportedCompressionCodecException, validate_compression_level
+from backups.throttling import RateLimiter
+from becky.utils import remove_prefix, calculate_checksum, batched, DEFAULT_CHECKSUM_ALGORITHM, CHECKSUM_ALGORITHMS, UnsupportedChecksumAlgorithmException
 import backups
 
+SAVE_BATCH_SIZE = 500 # How many backed up items are saved to the database at once
+
 class Backup(models.Model):
     name = models.CharField(max_length=128, null=False)
     scanner = models.CharField(max_length=128, null=False)
@@ -37,26 +45,30 @@ class Backup(models.Model):
         json_output['timestamps'] = self.get_backup_timestamps()
         return json_output
 
-    def create_backup_file_instance(self, path, creation_time=None):
+    def create_backup_file_instance(self, path, creation_time=None, file_stat=None):
         """
         Given a file path, creates BackupFiles from it if one doesn't already exist in the database.
         This is a helper function for scanners/providers, so that they can easily
         generate new BackupFile objects at any point. 
         Can be given a creation time, otherwise uses the current time as the creation time.
+        Can be given the stat result of the path, if the caller already has one.
         """
         backup_file = BackupItem(backup=self, path=path, creation_time=creation_time)
-        backup_file.update_metadata()
+        backup_file.update_metadata(file_stat)
         return backup_file
 
-    def create_backup_file_instances(self, files, creation_time=None):
+    def create_backup_file_instances(self, files, creation_time=None, file_stats=None):
         """
         Calls 'create_backup_file_instances' for each file given in
         and returns the values as a list.
         Can be given a creation time, otherwise uses the current time as the creation time.
+        Can be given a dictionary of path -> stat result, so no file has to be stat'd again.
         """
         if not creation_time:
             creation_time = timezone.now()
-        backup_files = [self.create_backup_file_instance(f, creation_time) for f in files]
+        if not file_stats:
+            file_stats = {}
+        backup_files = [self.create_backup_file_instance(f, creation_time, file_stats.get(f)) for f in files]
         return backup_files
 
     def get_remote_files(self, path, timestamp):
@@ -99,6 +111,50 @@ class Backup(models.Model):
         provider = backups.providers.get_provider(self.provider, self)
         return provider
 
+    def get_checksum_algorithm(self, provider=None):
+        """
+        Returns the checksum algorithm new backup items should be hashed with.
+        Uses the 'checksum_algorithm' parameter, but falls back to the default
+        algorithm if the given provider can't verify files hashed with the selected one.
+        """
+        algorithm = self.get_parameter_value('checksum_algorithm', DEFAULT_CHECKSUM_ALGORITHM)
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            raise UnsupportedChecksumAlgorithmException(algorithm)
+        if provider and not provider.supports_checksum_algorithm(algorithm):
+            self.get_logger().log("Provider can't verify {} checksums, using {} instead.", 'BACKUP', 'WARNING', algorithm, DEFAULT_CHECKSUM_ALGORITHM)
+            algorithm = DEFAULT_CHECKSUM_ALGORITHM
+        return algorithm
+
+    def get_compression(self):
+        """
+        Returns the compression codec and level new backup items should be stored with.
+        Uses the 'compression' and 'compression_level' parameters, no compression by default.
+        Both are validated here, so a bad value stops the run before any file is stored.
+        """
+        codec = self.get_parameter_value('compression', NO_COMPRESSION)
+        if codec not in COMPRESSION_CODECS:
+            raise UnsupportedCompressionCodecException(codec)
+        level = validate_compression_level(codec, self.get_parameter_value('compression_level', None))
+        return codec, level
+
+    def get_checksum_cache(self):
+        """
+        Returns the ChecksumCache shared by this backup model, its provider and the checksum stage.
+        It has to be flushed once the task at hand is done.
+        """
+        if getattr(self, '_checksum_cache', None) is None:
+            max_entries = self.get_parameter_value('checksum_cache_size', 1000000)
+            self._checksum_cache = ChecksumCache(max_entries=int(max_entries))
+        return self._checksum_cache
+
+    def get_rate_limiter(self):
+        """
+        Returns the RateLimiter shared by this backup model and its provider.
+        """
+        if getattr(self, '_rate_limiter', None) is None:
+            self._rate_limiter = RateLimiter(self)
+        return self._rate_limiter
+
     def get_file_scanner(self):
         """
         Checks the desired file scanner from the model and intializes it.
@@ -139,6 +195,17 @@ class Backup(models.Model):
             parameter = GlobalParameter.get_global_parameter(key)
         return parameter
 
+    def get_parameter_value(self, key, default=None):
+        """
+        Returns the value of the parameter with the given key.
+        Backup specific parameters take precedence over the global ones.
+        If neither is set, returns the given default.
+        """
+        parameter = self.get_parameter(key)
+        if parameter and parameter.value != '':
+            return parameter.value
+        return default
+
     
     def get_backup_file(self, path):
         """
@@ -200,6 +267,9 @@ class Backup(models.Model):
         Returns the current status message and the current percentage of
         the task at hand.
         """
+        progress_reporter = getattr(self, '_progress_reporter', None)
+        if progress_reporter and progress_reporter.running:
+            return progress_reporter.to_json()
         if self.statuses.exists():
             return self.statuses.first().to_json()
         else:
@@ -222,27 +292,31 @@ class Backup(models.Model):
         the restore_path folder.
         """
 
-        # Selecting exact match files AND older files
-        selection_items = []
-        for selection in selections:
-            items = list(self.backup_items.filter(directory__startswith=selection, creation_time__lte=timestamp))
-            items += list(self.backup_items.filter(path=selection, creation_time__lte=timestamp))
-            selection_items += items
-
-        # Removing any older version of a file if a newer one is present
-        newest_items = {}
-        newest_item_ts = {}
-        for item in selection_items:
-            if item.path not in newest_items or item.creation_time > newest_item_ts.get(item.path, 0):
-                newest_items[item.path] = item
-                newest_item_ts[item.path] = item.creation_time
-        selection_items = list(newest_items.values())
-        
+        selection_items = self.get_restore_items(selections, timestamp)
         provider = self.get_backup_provider()
-        restored_files = provider.restore_files(selection_items, restore_path)
+        try:
+            restored_files = provider.restore_files(selection_items, restore_path)
+        finally:
+            provider.close()
+            self.get_logger().flush()
         return restored_files
 
 
+    def get_restore_items(self, selections, timestamp):
+        """
+        Returns the newest version at the given time of every item that is one of the selected paths or inside one.
+        Resolved from the catalog with a single query, ordered by path, so parent folders come before their contents.
+        Folders are matched with a range on the directory ('<folder>/' up to '<folder>0', '0' being the character after '/'),
+        which uses the directory index and is case sensitive, unlike a LIKE prefix match.
+        The newest version of each path is picked with a subquery on the path index.
+        """
+        query = Q()
+        for selection in selections:
+            folder = selection.rstrip('/')
+            query |= Q(path=folder or '/') | Q(directory=folder or '/') | Q(directory__gte=folder + '/', directory__lt=folder + '0')
+        newest_version = self.backup_items.filter(path=OuterRef('path'), creation_time__lte=timestamp).order_by('-creation_time').values('creation_time')[:1]
+        return list(self.backup_items.filter(query, creation_time=Subquery(newest_version)).order_by('path'))
+
     def run_backup(self):
         """
         Starts the backup process. If this is the first time running it,
@@ -256,50 +330,103 @@ class Backup(models.Model):
 
         scanner = self.get_file_scanner()
         provider = self.get_backup_provider()
-        logger = self._get_logger()
-        logger.log("Starting file scanning...", 'BACKUP', 'INFO')
-        found_files = scanner.scan_files(self.get_all_backup_files(), current_timestamp)
-        logger.log("Starting file backing...", 'BACKUP', 'INFO')
-        saved_files = provider.backup_files(found_files)
-        with transaction.atomic():
-            for f in saved_files:
-                f.calculate_checksum()
-                f.save()
-        logger.log("Backup done.", 'BACKUP', 'INFO')
+        logger = self.get_logger()
+        statistics = PipelineStatistics()
+        try:
+            logger.log("Starting file scanning and backing...", 'BACKUP', 'INFO')
+            found_files = statistics.measure('scan', scanner.scan_files(self.get_all_backup_files(), current_timestamp))
+            saved_files = statistics.measure('copy', provider.backup_files(found_files))
+            hashed_files = statistics.measure('checksum', self._get_checksum_stage(provider).process(saved_files))
+            saved_count = self._save_backup_items(hashed_files)
+            statistics.finish('save')
+            self._forget_modified_times(provider.get_failed_files())
+            for stage in statistics.summary():
+                logger.log("Stage {}: {} files, {} bytes in {} seconds ({} files/s, {} MB/s).", 'BACKUP', 'INFO', stage['stage'], stage['files'], stage['bytes'], stage['seconds'], stage['files_per_second'], stage['megabytes_per_second'])
+            for key, value in provider.get_run_statistics().items():
+                logger.log("Provider {}: {}", 'BACKUP', 'INFO', key, value)
+            logger.log("Backup done.", 'BACKUP', 'INFO')
+        except Exception as e:
+            logger.log("Backup failed: {}", 'BACKUP', 'ERROR', e)
+            raise
+        finally:
+            provider.close()
+            self.get_checksum_cache().flush()
+            logger.flush()
         self.set_status('Idle', 0, 0)
         backup_info = {
                 'timestamp' : current_timestamp, 
-                'new_files': found_files,
+                'new_files': saved_count,
+                'stages': statistics.summary(),
+                'provider': provider.get_run_statistics(),
                 'status': 'success'
         }
         BackupMetadata(backup=self, key='backup_timestamp', value=current_timestamp.timestamp()).save() # Saving a metadata row of when this backup iteration was ran.
         return backup_info
 
+    def _get_checksum_stage(self, provider):
+        """
+        Returns the pipeline stage that calculates the checksums of backed up files.
+        Uses the 'checksum_workers' and 'checksum_pool' ('thread' or 'process') parameters.
+        """
+        workers = self.get_parameter_value('checksum_workers', None)
+        pool = self.get_parameter_value('checksum_pool', 'thread')
+        return ChecksumStage(algorithm=self.get_checksum_algorithm(provider), workers=workers, pool=pool, cache=self.get_checksum_cache())
+
+    def _forget_modified_times(self, paths):
+        """
+        Clears the stored modified times of the given paths, so the scanner sees them as changed
+        on the next run. Used for files the provider failed to back up.
+        """
+        for batch in batched(paths, SAVE_BATCH_SIZE):
+            DifferentialInformation.objects.filter(backup=self, path__in=batch).update(current_modified=None)
+
+    def _save_backup_items(self, backup_items):
+        """
+        Saves the given, freshly backed up and hashed BackupItems to the database.
+        Items are consumed and saved in batches, so the whole backup never has to be kept in memory.
+        Returns the number of saved items.
+        """
+        saved_count = 0
+        for batch in batched(backup_items, SAVE_BATCH_SIZE):
+            with transaction.atomic():
+                BackupItem.objects.bulk_create(batch, batch_size=SAVE_BATCH_SIZE)
+            saved_count += len(batch)
+        return saved_count
+
     def verify_files(self):
         """
         Runs a verify action on the provider.
         This checks if the local and remote data are in sync by comparing their hashes.
         """
         provider = self.get_backup_provider()
-        logger = self._get_logger()
-        logger.log("Starting backup verification process.", 'BACKUP', 'INFO')
-        provider.verify_files()
-        logger.log("Files verified successfully.", 'BACKUP', 'INFO')
+        logger = self.get_logger()
+        try:
+            logger.log("Starting backup verification process.", 'BACKUP', 'INFO')
+            provider.verify_files()
+            logger.log("Files verified successfully.", 'BACKUP', 'INFO')
+        finally:
+            provider.close()
+            self.get_checksum_cache().flush()
+            logger.flush()
         return True
 
-    def set_status(self, status_message, percentage, running):
+    def set_status(self, status_message, percentage, running, force=False):
         """
         Sets the current status of the backup model to the given status.
+        If percentage is None, the previous percentage is kept.
+        The status is kept in memory and only written to the database every 'status_interval_ms'
+        milliseconds, or right away when the backup starts or stops running or if force is set.
         """
-        if not percentage:
-            if self.statuses.last():
-                percentage = self.statuses.last().percentage
-            else:
-                percentage = 0
-        with transaction.atomic():
-            new_status = BackupStatus(backup=self, message=status_message, percentage=percentage, running=running)
-            self.statuses.all().delete()
-            new_status.save()
+        self.get_progress_reporter().update(status_message, percentage, running, force)
+
+    def get_progress_reporter(self):
+        """
+        Returns the ProgressReporter of this backup model, creating it on first use.
+        """
+        if getattr(self, '_progress_reporter', None) is None:
+            interval = self.get_parameter_value('status_interval_ms', 1000)
+            self._progress_reporter = ProgressReporter(self, interval_ms=int(interval))
+        return self._progress_reporter
 
     def should_run_now(self, timestamp):
         """
@@ -324,13 +451,16 @@ class Backup(models.Model):
 
 
 
-    def _get_logger(self):
+    def get_logger(self):
         """
         Returns a logger object that other objects can and will use to log their events.
+        The same buffered logger is shared by the model, its scanner and its provider,
+        so it has to be flushed once the task at hand is done.
         TODO: For now, just using the default logger. At someone allow using different loggers as well?
         """
-        logger = BackupLogger(self)
-        return logger
+        if getattr(self, '_logger', None) is None:
+            self._logger = BackupLogger(self, buffered=True)
+        return self._logger
 
     
 
@@ -351,15 +481,33 @@ class BackupItem(models.Model):
     directory = models.TextField()
     file_size = models.BigIntegerField(default=0)
     modified = models.TimeField(null=True)
-    checksum = models.CharField(max_length=64)
+    checksum = models.CharField(max_length=128)
+    checksum_algorithm = models.CharField(max_length=16, default=DEFAULT_CHECKSUM_ALGORITHM)
+    storage_format = models.CharField(max_length=16, default='file') # How the provider stored the content behind savename
+    compression = models.CharField(max_length=16, default='none') # Codec the stored content is compressed with
+    pack_offset = models.BigIntegerField(null=True) # Location of the content inside a pack segment, if the item is packed
+    pack_length = models.BigIntegerField(null=True)
+    delta_base = models.ForeignKey('self', null=True, on_delete=models.RESTRICT, related_name='delta_versions') # Version this item is stored as a delta against
+    delta_chain = models.IntegerField(default=0) # How many deltas have to be applied to rebuild this item
     creation_time = models.DateTimeField()
 
-    def calculate_checksum(self):
+    class Meta:
+        indexes = [
+            models.Index(fields=['backup', 'path', 'creation_time'], name='backup_item_path_idx'),
+            models.Index(fields=['backup', 'directory'], name='backup_item_directory_idx'),
+        ]
+
+    def calculate_checksum(self, algorithm=None, cache=None):
         """
-        Calculates a MD5 checksum hash of the current file.
+        Calculates a checksum hash of the current file.
         This is used to verify that the content match.
+        If no algorithm is given, the item's current algorithm is used.
+        The used algorithm is saved next to the checksum, so older items stay verifiable.
+        If a ChecksumCache is given, unchanged files are not hashed again.
         """
-        self.checksum = calculate_checksum(self.path)
+        if algorithm:
+            self.checksum_algorithm = algorithm
+        self.checksum = calculate_checksum(self.path, self.checksum_algorithm, cache=cache)
 
     def _get_filename_key(self):
         """
@@ -370,25 +518,31 @@ class BackupItem(models.Model):
     
         
 
-    def update_metadata(self):
+    def update_metadata(self, file_stat=None):
         self._set_path_metadata()
-        self._set_file_metadata()
+        self._set_file_metadata(file_stat)
 
-    def _set_file_metadata(self):
+    def _set_file_metadata(self, file_stat=None):
         """
         Updates the file metadata if possible, such as 
         file size.
+        Uses the given stat result if there is one, otherwise stats the path.
         TODO: other metadata, like modified timestamps etc.
         """
-        if os.path.exists(self.path):
-            if os.path.isdir(self.path):
+        if file_stat is None:
+            try:
+                file_stat = os.stat(self.path)
+            except OSError:
+                file_stat = None
+        if file_stat is not None:
+            if stat.S_ISDIR(file_stat.st_mode):
                 self.file_size = 0 #For now
                 self.file_type = 'directory'
             else:
-                self.file_size = os.path.getsize(self.path)
+                self.file_size = file_stat.st_size
                 self.file_type = 'file'
 
-            modified = int(pathlib.Path(self.path).stat().st_mtime)
+            modified = file_stat.st_mtime_ns // 1000000000
             self.modified = datetime.datetime.fromtimestamp(modified)
         if not self.creation_time:
             self.creation_time = timezone.now()
@@ -437,3 +591,149 @@ class BackupParameter(models.Model):
     key = models.CharField(max_length=64, null=False)
     value = models.CharField(max_length=1024, null=False)
     key = models.CharField(max_length=64, null=False)
+
+
+class ChecksumCacheEntry(models.Model):
+    """ A cached checksum of a file, keyed by the stat fingerprint of the file at the time it was hashed. """
+    device = models.BigIntegerField()
+    inode = models.BigIntegerField()
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    ctime_ns = models.BigIntegerField()
+    algorithm = models.CharField(max_length=16)
+    checksum = models.CharField(max_length=128)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'inode', 'size', 'mtime_ns', 'ctime_ns', 'algorithm'], name='unique_checksum_fingerprint'),
+        ]
+
+
+"""
+Checksum cache that any provider or pipeline stage can use to skip hashing
+files that haven't changed since they were last hashed.
+A file is considered unchanged if its (device, inode, size, mtime_ns, ctime_ns)
+fingerprint is the same. New entries and usage timestamps are written in batches,
+so flush() has to be called once the task at hand is done.
+The cache is bounded to 'checksum_cache_size' entries, evicting the least recently used ones.
+"""
+class ChecksumCache:
+
+    def __init__(self, max_entries=1000000, batch_size=500):
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.new_entries = {}
+        self.used_entries = set()
+
+    def fingerprint(self, path, file_stat=None):
+        """
+        Returns the fingerprint of the file at the given path, or None if it can't be stat'd.
+        """
+        if file_stat is None:
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                return None
+        return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns)
+
+    def get(self, fingerprint, algorithm):
+        """
+        Returns the cached checksum for the given fingerprint and algorithm, or None if there isn't one.
+        """
+        if fingerprint is None:
+            return None
+        if (fingerprint, algorithm) in self.new_entries:
+            return self.new_entries[(fingerprint, algorithm)]
+        device, inode, size, mtime_ns, ctime_ns = fingerprint
+        entry = ChecksumCacheEntry.objects.filter(device=device, inode=inode, size=size, mtime_ns=mtime_ns, ctime_ns=ctime_ns, algorithm=algorithm).values_list('id', 'checksum').first()
+        if entry is None:
+            return None
+        self.used_entries.add(entry[0])
+        if len(self.used_entries) >= self.batch_size:
+            self._touch_used_entries()
+        return entry[1]
+
+    def put(self, fingerprint, algorithm, checksum):
+        """
+        Adds a new checksum to the cache.
+        """
+        if fingerprint is None:
+            return
+        self.new_entries[(fingerprint, algorithm)] = checksum
+        if len(self.new_entries) >= self.batch_size:
+            self._save_new_entries()
+
+    def defer(self, path, algorithm):
+        """
+        Looks up the checksum of the file at the given path and returns a DeferredChecksumCache
+        that knows it, for handing over to a worker thread.
+        """
+        fingerprint = self.fingerprint(path)
+        checksum = self.get(fingerprint, algorithm)
+        known = {(fingerprint, algorithm): checksum} if checksum is not None else {}
+        return DeferredChecksumCache(self, known)
+
+    def flush(self):
+        """
+        Writes all pending entries to the database and evicts the least recently used entries
+        if the cache has grown over its maximum size.
+        """
+        self._save_new_entries()
+        self._touch_used_entries()
+        self._evict()
+
+    def _save_new_entries(self):
+        entries = []
+        now = timezone.now()
+        for (fingerprint, algorithm), checksum in self.new_entries.items():
+            device, inode, size, mtime_ns, ctime_ns = fingerprint
+            entries.append(ChecksumCacheEntry(device=device, inode=inode, size=size, mtime_ns=mtime_ns, ctime_ns=ctime_ns, algorithm=algorithm, checksum=checksum, last_used=now))
+        self.new_entries = {}
+        ChecksumCacheEntry.objects.bulk_create(entries, batch_size=self.batch_size, ignore_conflicts=True)
+
+    def _touch_used_entries(self):
+        used_entries, self.used_entries = list(self.used_entries), set()
+        for batch in batched(used_entries, self.batch_size):
+            ChecksumCacheEntry.objects.filter(id__in=batch).update(last_used=timezone.now())
+
+    def _evict(self):
+        """
+        Deletes the least recently used entries that don't fit in the cache.
+        """
+        overflow = ChecksumCacheEntry.objects.count() - self.max_entries
+        if overflow <= 0:
+            return
+        cutoff = ChecksumCacheEntry.objects.order_by('last_used', 'id').values_list('last_used', 'id')[overflow - 1]
+        ChecksumCacheEntry.objects.filter(models.Q(last_used__lt=cutoff[0]) | models.Q(last_used=cutoff[0], id__lte=cutoff[1])).delete()
+
+
+class DeferredChecksumCache:
+    """
+    Stand-in for a ChecksumCache that can be used from worker threads without touching the database.
+    It only knows the checksums that were looked up for it beforehand (see ChecksumCache.defer),
+    new checksums are kept in memory until apply() hands them over to the real cache.
+    """
+
+    def __init__(self, cache, known=None):
+        self.cache = cache
+        self.known = known or {}
+        self.new_entries = []
+
+    def fingerprint(self, path, file_stat=None):
+        return self.cache.fingerprint(path, file_stat)
+
+    def get(self, fingerprint, algorithm):
+        return self.known.get((fingerprint, algorithm))
+
+    def put(self, fingerprint, algorithm, checksum):
+        self.new_entries.append((fingerprint, algorithm, checksum))
+
+    def apply(self):
+        """
+        Adds the new checksums to the real cache. Has to be called from the thread that owns it.
+        """
+        for fingerprint, algorithm, checksum in self.new_entries:
+            self.cache.put(fingerprint, algorithm, checksum)
+        self.new_entries = []
+
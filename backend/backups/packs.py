@@ -0,0 +1,80 @@
+import os
+import uuid
+
+"""
+Pack segments for storing lots of small files.
+Instead of creating a file (and an inode) for every small file, their contents are appended
+one after another into large segment files. The segment, offset and length of each file are
+saved to its BackupItem, so a single file can be read back by seeking to its offset.
+"""
+
+PACK_FOLDER = 'packs'
+DEFAULT_PACK_SIZE = 64 * 1024 * 1024
+
+
+class PackWriter:
+    """
+    Appends data to pack segments under the given folder.
+    A new segment is started once the current one grows over pack_size bytes.
+    Every append is written straight to the segment file, so the data of an entry
+    is on disk by the time its location is returned. If writing an entry fails, the segment is
+    cut back to where the entry started, so the offsets of the following entries stay right.
+    """
+
+    def __init__(self, folder, pack_size=DEFAULT_PACK_SIZE):
+        self.folder = folder
+        self.pack_size = pack_size
+        self.segment = None
+        self.segment_name = None
+        self.offset = 0
+
+    def append(self, data):
+        """
+        Appends the given data to the current segment.
+        Returns the name of the segment, relative to the folder, and the offset the data was written to.
+        """
+        if self.segment is None or self.offset >= self.pack_size:
+            self._start_segment()
+        offset = self.offset
+        view = memoryview(data)
+        try:
+            while view:
+                written = self.segment.write(view)
+                view = view[written:]
+        except Exception:
+            self._rewind()
+            raise
+        self.offset += len(data)
+        return self.segment_name, offset
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def _rewind(self):
+        """
+        Drops a partially written entry from the end of the current segment.
+        If even that fails, the segment is closed and the next entry starts a new one.
+        """
+        try:
+            self.segment.truncate(self.offset)
+            self.segment.seek(self.offset)
+        except OSError:
+            self.close()
+
+    def _start_segment(self):
+        self.close()
+        self.segment_name = os.path.join(PACK_FOLDER, '{}.pack'.format(uuid.uuid4()))
+        os.makedirs(os.path.join(self.folder, PACK_FOLDER), exist_ok=True)
+        self.segment = open(os.path.join(self.folder, self.segment_name), 'wb', buffering=0)
+        self.offset = 0
+
+
+def read_pack_slice(path, offset, length):
+    """
+    Returns length bytes from the given offset of the pack segment at the given path.
+    """
+    with open(path, 'rb') as segment:
+        segment.seek(offset)
+        return segment.read(length)
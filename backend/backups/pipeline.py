@@ -0,0 +1,148 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from becky.utils import calculate_checksum, DEFAULT_CHECKSUM_ALGORITHM
+
+"""
+Building blocks of the streaming backup pipeline.
+A backup run is a chain of generators: the scanner yields changed files,
+the provider yields them once they are copied, the checksum stage yields them
+once they are hashed and finally they are saved to the database in batches.
+"""
+
+class ChecksumStage:
+    """
+    Calculates the checksums of backed up items in a thread or process pool.
+    Items are submitted to the pool as they arrive and yielded back in the same order
+    once hashed. Only a bounded number of items is kept in flight at a time.
+    Items that already have a checksum (f.ex. hashed while copying) are passed through as is.
+    If a checksum cache is given, it is consulted before submitting an item to the pool
+    and the new checksums are added to it, all from the calling thread.
+    """
+
+    def __init__(self, algorithm=DEFAULT_CHECKSUM_ALGORITHM, workers=None, pool='thread', cache=None):
+        self.algorithm = algorithm
+        self.cache = cache
+        self.workers = max(1, int(workers)) if workers else (os.cpu_count() or 1)
+        self.max_in_flight = self.workers * 4
+        self.pool = pool
+
+    def process(self, backup_items):
+        """
+        Yields the given BackupItems with their checksums calculated.
+        """
+        executor_class = ProcessPoolExecutor if self.pool == 'process' else ThreadPoolExecutor
+        with executor_class(max_workers=self.workers) as executor:
+            in_flight = deque()
+            for backup_item in backup_items:
+                fingerprint = None
+                if backup_item.checksum:
+                    future = None
+                elif backup_item.file_type == 'directory':
+                    self._set_checksum(backup_item, '0')
+                    future = None
+                else:
+                    fingerprint, cached_checksum = self._get_cached_checksum(backup_item)
+                    if cached_checksum is not None:
+                        self._set_checksum(backup_item, cached_checksum)
+                        future = None
+                    else:
+                        future = executor.submit(calculate_checksum, backup_item.path, self.algorithm)
+                in_flight.append((backup_item, future, fingerprint))
+                while len(in_flight) > self.max_in_flight:
+                    yield self._finish(*in_flight.popleft())
+            while in_flight:
+                yield self._finish(*in_flight.popleft())
+
+    def _finish(self, backup_item, future, fingerprint):
+        """
+        Waits for the checksum of the given item, if it is still being calculated.
+        """
+        if future is not None:
+            self._set_checksum(backup_item, future.result())
+            if self.cache is not None:
+                self.cache.put(fingerprint, self.algorithm, backup_item.checksum)
+        return backup_item
+
+    def _get_cached_checksum(self, backup_item):
+        """
+        Returns the fingerprint of the item's file and its cached checksum, if there is one.
+        """
+        if self.cache is None:
+            return None, None
+        fingerprint = self.cache.fingerprint(backup_item.path)
+        return fingerprint, self.cache.get(fingerprint, self.algorithm)
+
+    def _set_checksum(self, backup_item, checksum):
+        backup_item.checksum = checksum
+        backup_item.checksum_algorithm = self.algorithm
+
+
+class PipelineStatistics:
+    """
+    Measures how many items and bytes pass through each stage of the pipeline and how long each stage takes.
+    Stages are measured in the order they are chained. Time spent inside a stage includes the time
+    spent waiting for the stages before it, so that is subtracted when reporting.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.counts = {}
+        self.sizes = {}
+        self.times = {}
+        self.started = time.monotonic()
+        self.finished = None
+
+    def measure(self, stage, items):
+        """
+        Wraps the given iterable and yields its items, measuring the time it takes to produce them.
+        """
+        self.stages.append(stage)
+        self.counts[stage] = 0
+        self.sizes[stage] = 0
+        self.times[stage] = 0.0
+        iterator = iter(items)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.times[stage] += time.monotonic() - start
+                return
+            self.times[stage] += time.monotonic() - start
+            self.counts[stage] += 1
+            self.sizes[stage] += getattr(item, 'file_size', 0) or 0
+            yield item
+
+    def finish(self, final_stage):
+        """
+        Marks the pipeline as done. The time not spent in any measured stage
+        is attributed to the final, consuming stage.
+        """
+        self.finished = time.monotonic()
+        last_stage = self.stages[-1] if self.stages else None
+        self.stages.append(final_stage)
+        self.counts[final_stage] = self.counts.get(last_stage, 0)
+        self.sizes[final_stage] = self.sizes.get(last_stage, 0)
+        self.times[final_stage] = self.finished - self.started
+
+    def summary(self):
+        """
+        Returns a list of dictionaries with the throughput of each stage.
+        """
+        summary = []
+        previous_time = 0.0
+        for stage in self.stages:
+            seconds = max(self.times[stage] - previous_time, 0.0)
+            previous_time = self.times[stage]
+            summary.append({
+                'stage': stage,
+                'files': self.counts[stage],
+                'bytes': self.sizes[stage],
+                'seconds': round(seconds, 3),
+                'files_per_second': round(self.counts[stage] / seconds, 2) if seconds else None,
+                'megabytes_per_second': round(self.sizes[stage] / 1024 / 1024 / seconds, 2) if seconds else None,
+            })
+        return summary
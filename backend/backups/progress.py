@@ -0,0 +1,55 @@
+import time
+
+"""
+In-memory progress reporting for a running backup.
+Scanners and providers report their progress very often, sometimes once per file.
+The reporter keeps the latest status in memory and writes it to the
+BackupStatus table at most once per interval, so the database isn't
+hammered while the web workers are trying to read from it.
+"""
+
+class ProgressReporter:
+
+    def __init__(self, backup_model, interval_ms=1000):
+        self.backup_model = backup_model
+        self.interval = interval_ms / 1000
+        self.message = 'Idle'
+        self.percentage = 0
+        self.running = False
+        self.last_write = None
+        self.written_running = None
+        self.dirty = False
+
+    def update(self, status_message, percentage, running, force=False):
+        """
+        Updates the in-memory status.
+        If percentage is None, the previous percentage is kept.
+        The status is written to the database if enough time has passed since the
+        previous write, if the running state changes or if force is set.
+        """
+        self.message = status_message
+        if percentage is not None:
+            self.percentage = int(percentage)
+        self.running = bool(running)
+        if force or self.running != self.written_running or self._interval_passed():
+            self.flush()
+        else:
+            self.dirty = True
+
+    def flush(self):
+        """
+        Writes the current status to the database.
+        The status row of the backup is updated in place, it is only created if it doesn't exist yet.
+        """
+        updated = self.backup_model.statuses.update(message=self.message, percentage=self.percentage, running=self.running)
+        if not updated:
+            self.backup_model.statuses.create(message=self.message, percentage=self.percentage, running=self.running)
+        self.last_write = time.monotonic()
+        self.written_running = self.running
+        self.dirty = False
+
+    def to_json(self):
+        return {'status_message': self.message, 'percentage': self.percentage, 'running': self.running}
+
+    def _interval_passed(self):
+        return self.last_write is None or time.monotonic() - self.last_write >= self.interval
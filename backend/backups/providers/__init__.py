@@ -1,6 +1,7 @@
 from backups.providers.differential_local_provider import DifferentialLocalProvider
 from backups.providers.differential_remote_provider import DifferentialRemoteProvider
 from backups.providers.differential_s3_provider import DifferentialS3Provider
+from backups.providers.snapshot_local_provider import SnapshotLocalProvider
 import backups.providers.exceptions as exceptions
 
 
@@ -14,6 +15,8 @@ def get_provider(provider_name, backup_model):
 
     if provider_name == 'local+differential':
         return DifferentialLocalProvider(parameters, backup_model)
+    elif provider_name == 'local+snapshot':
+        return SnapshotLocalProvider(parameters, backup_model)
     elif provider_name == 'remote+differential':
         return DifferentialRemoteProvider(parameters, backup_model)
     elif provider_name == 's3+differential':
@@ -2,10 +2,15 @@ from abc import ABC, abstractmethod
 
 class BaseProvider(ABC):
 
+    supported_checksum_algorithms = None # None means the provider can verify checksums of any algorithm
+
     @abstractmethod
-    def backup_files(self, list_of_files):
+    def backup_files(self, files):
         """
-        Receives a list of files that have to be backed up.
+        Receives an iterable of files that have to be backed up.
+        The files may still be produced by the scanner while they are being backed up,
+        so the iterable should be consumed lazily.
+        Yields each file once it has been backed up.
         """
         pass
 
@@ -27,9 +32,49 @@ class BaseProvider(ABC):
         pass
 
 
+    def get_run_statistics(self):
+        """
+        Returns a dictionary of provider specific statistics about the last backup run,
+        f.ex. how the files were copied. These are added to the backup info.
+        """
+        return {}
+
+    def get_failed_files(self):
+        """
+        Returns the paths of the files that couldn't be backed up during the last backup run.
+        These files are left out of the yielded files, so they get picked up again on the next run.
+        """
+        return []
+
+    def migrate_layout(self):
+        """
+        Moves the stored files to the provider's current storage layout.
+        Returns the number of moved files, or None if the provider has only one layout.
+        """
+        return None
+
+    def close(self):
+        """
+        Releases anything the provider kept open during a backup, restore or verify run,
+        f.ex. connections to the remote server.
+        """
+        pass
+
+    def supports_checksum_algorithm(self, algorithm):
+        """
+        Returns whether the provider can verify files hashed with the given algorithm.
+        """
+        return self.supported_checksum_algorithms is None or algorithm in self.supported_checksum_algorithms
+
     def _get_parameter(self, key):
         """
         Returns the parameter with the given key from the backup parameters.
         """
         return self.parameters['providerSettings'][key]
 
+    def _get_optional_parameter(self, key, default=None):
+        """
+        Returns the parameter with the given key from the backup parameters,
+        or the given default if it hasn't been set.
+        """
+        return self.parameters['providerSettings'].get(key, default)
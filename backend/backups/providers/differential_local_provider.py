@@ -1,54 +1,217 @@
 import os
+import re
 import glob
+import json
+import uuid
 import shelve
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from shutil import copyfile
 from django.db import models
 
 import backups.providers.exceptions as exceptions
+from backups.chunking import ContentDefinedChunker, DEFAULT_AVERAGE_CHUNK_SIZE
+from backups.copying import CopyEngine
+from backups.deltas import build_delta_index, write_delta, iter_applied_delta
+from backups.packs import PackWriter, DEFAULT_PACK_SIZE, read_pack_slice
+from backups.compression import NO_COMPRESSION, ProbingCompressor, choose_codec, compress_bytes, decompress_bytes, iter_decompressed_chunks
 from backups.providers.base_provider import BaseProvider
-from logs.models import BackupLogger
-from becky.utils import remove_prefix, join_file_path, path_to_folders, calculate_checksum
+from becky.utils import remove_prefix, join_file_path, path_to_folders, calculate_checksum, copy_file_with_checksum, get_hasher, batched
 
 """
 A local backup provider that can backup files differentially from one location
 to another, within a local system.
 On each subsequent update a changed file gets a new version saved.
+
+The 'storage_mode' provider setting selects how the versions are stored:
+    file - (default) Each version is copied to its own file.
+    content - Each version is stored as a blob named after its content hash.
+              A blob is only written if no other version has the same content,
+              so duplicate and reverted files share the same blob.
+    chunked - Each version is split into content defined chunks (see backups.chunking)
+              and only chunks that aren't stored yet are written to 'chunks/'.
+              The savename of the version points at a manifest in 'manifests/'
+              listing its chunks in order. Good for large files that change a little at a time.
+              The average chunk size can be set with the 'chunk_size' provider setting.
+    delta - A changed file is stored as a binary delta (see backups.deltas) against the previous
+            version of the same path in 'deltas/'. A full copy is stored instead once the chain of deltas
+            reaches 'delta_max_chain' versions (10 by default), or if more than 'delta_max_ratio'
+            of the file (0.5 by default) would have to be stored as literal data.
+
+In the file mode, files smaller than the 'pack_threshold' provider setting (in bytes) are appended
+to pack segments in 'packs/' instead (see backups.packs). Each segment holds up to 'pack_size' bytes.
+
+The 'layout' provider setting selects how the stored files are spread into folders:
+    sharded - (default) Files are stored in 'ab/cd/' sub folders named after the first characters
+              of their uuid or hash, so no folder grows too large.
+    flat - Files are stored straight in their folder, like older versions did.
+Restore and verify find files from either layout. An existing store can be moved to the
+layout currently set with the 'migrate_output_layout' management command.
+
+Files are stored and restored by a pool of 'parallelism' threads (1 by default).
+Files are still yielded, and progress reported, in the order they were received.
+A file that fails to be stored is logged and left out instead of failing the whole backup.
+All database access stays in the calling thread, the threads only read and write files.
+
+Plain uncompressed copies are made with the cheapest copy strategy the file systems support
+(see backups.copying), optionally limited with the 'copy_strategies' provider setting.
+
+Reading and writing is limited by the 'bandwidth_limit' and 'operation_limit' parameters (see backups.throttling).
+Every stored or restored file counts as an operation.
+
+Files, blobs, chunks and packed files are compressed with the codec set in the 'compression' backup parameter,
+unless the file is already compressed (see backups.compression).
 """
 
+STORAGE_MODES = ['file', 'content', 'chunked', 'delta']
+LAYOUTS = ['sharded', 'flat']
+SHARDED_NAME = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{2}/[^/]+$')
+MIGRATION_BATCH_SIZE = 500
+CHUNK_FOLDER = 'chunks'
+MANIFEST_FOLDER = 'manifests'
+DELTA_FOLDER = 'deltas'
+
 class DifferentialLocalProvider(BaseProvider):
     
     def __init__(self, parameters, backup_model):
         self.parameters = parameters
         self.backup_model = backup_model
-        self.logger = BackupLogger(backup_model)
+        self.logger = backup_model.get_logger()
+        self.checksum_cache = backup_model.get_checksum_cache()
+        self.rate_limiter = backup_model.get_rate_limiter()
+        self.copy_engine = CopyEngine(self._get_optional_parameter('copy_strategies'), self.rate_limiter)
+        self.failed_files = []
+        self.layout = self._get_optional_parameter('layout', 'sharded')
+        if self.layout not in LAYOUTS:
+            raise exceptions.UnsupportedStorageModeException(self.layout, message="Attempted to use an unsupported output layout.")
+        self.created_folders = set()
         self.tag = 'DifferentialBackupProvider'
 
-    def backup_files(self, list_of_files):
+    def backup_files(self, files):
         """
-        Receives a list of files to be backed up. 
+        Receives an iterable of files to be backed up.
+        Yields each file once it has been copied.
         """
         self._log('INFO', 'Started backing up files.')
-        self._log('INFO', 'Files sorted, starting backing up {} files.'.format(len(list_of_files)))
 
         copy_path = self._get_parameter('output_path')
         if not os.path.exists(copy_path):
             os.makedirs(copy_path)
         self._log('DEBUG', 'Saving files to {}'.format(copy_path))
-        self.backup_model.set_status('Starting to copy files. \t Files copied so far {}/{}'.format(0, len(list_of_files)), 0, True)
-        saved_files = []
-        for file_in_index, file_in in enumerate(list_of_files):
-            saved_files.append(file_in)
-            if os.path.isdir(file_in.path): continue
+        checksum_algorithm = self.backup_model.get_checksum_algorithm(self)
+        storage_mode = self._get_storage_mode()
+        compression, compression_level = self.backup_model.get_compression()
+        pack_threshold = int(self._get_optional_parameter('pack_threshold', 0)) if storage_mode == 'file' else 0
+        pack_writer = PackWriter(copy_path, int(self._get_optional_parameter('pack_size', DEFAULT_PACK_SIZE)))
+        parallelism = self._get_parallelism()
+        self.backup_model.set_status('Starting to copy files. \t Files copied so far {}'.format(0), 0, True)
+        file_in_index = 0
+        in_flight = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                try:
+                    for file_in in files:
+                        in_flight.append(self._submit_file(executor, file_in, copy_path, storage_mode, checksum_algorithm, compression, compression_level, pack_threshold, pack_writer))
+                        while in_flight and (len(in_flight) > parallelism * 2 or in_flight[0][1] is None or in_flight[0][1].done()):
+                            stored_file = self._finish_store(*in_flight.popleft())
+                            if stored_file is not None:
+                                file_in_index += 1
+                                yield stored_file
+                                self._report_copy_progress(file_in_index)
+                    while in_flight:
+                        stored_file = self._finish_store(*in_flight.popleft())
+                        if stored_file is not None:
+                            file_in_index += 1
+                            yield stored_file
+                            self._report_copy_progress(file_in_index)
+                finally:
+                    for _, future, _ in in_flight: # Don't start copying files nobody is waiting for anymore
+                        if future is not None:
+                            future.cancel()
+        finally:
+            pack_writer.close()
+
+        self._log('INFO', '{} new files backed up.'.format(file_in_index))
+        if self.failed_files:
+            self._log('WARNING', '{} files could not be backed up.'.format(len(self.failed_files)))
+
+    def get_failed_files(self):
+        return self.failed_files
+
+    def _submit_file(self, executor, file_in, copy_path, storage_mode, checksum_algorithm, compression, compression_level, pack_threshold, pack_writer):
+        """
+        Does the database lookups needed for storing the given file and submits it to the worker threads.
+        Small files that go into a pack segment are stored right away.
+        Returns the file, the future of storing it and the checksum cache given to the worker.
+        """
+        self.rate_limiter.refresh()
+        if file_in.file_type == 'directory':
+            return file_in, None, None
+        if storage_mode == 'file' and file_in.file_size < pack_threshold:
+            return file_in, self._run_inline(self._store_packed, file_in, pack_writer, checksum_algorithm, compression, compression_level), None
+        cache = self.checksum_cache.defer(file_in.path, checksum_algorithm)
+        delta_base = self._get_delta_base(file_in) if storage_mode == 'delta' else None
+        future = executor.submit(self._store_file, file_in, copy_path, storage_mode, checksum_algorithm, compression, compression_level, cache, delta_base)
+        return file_in, future, cache
 
+    def _store_file(self, file_in, copy_path, storage_mode, checksum_algorithm, compression, compression_level, cache, delta_base=None):
+        """
+        Stores a single file with the given storage mode. Runs in the worker threads.
+        The codec is only chosen by the extension here, the content is probed as it is stored.
+        """
+        self.rate_limiter.consume_operations()
+        file_in.compression = choose_codec(file_in.path, compression)
+        if storage_mode == 'content':
+            self._store_blob(file_in, copy_path, checksum_algorithm, compression_level, cache)
+        elif storage_mode == 'chunked':
+            self._store_chunks(file_in, copy_path, checksum_algorithm, compression_level)
+        elif storage_mode == 'delta':
+            self._store_delta(file_in, copy_path, checksum_algorithm, compression_level, cache, delta_base)
+        else:
             file_out = self._generate_output_path(file_in, copy_path)
-            self._copy_file(file_in, file_out)
+            self._copy_file(file_in, file_out, checksum_algorithm, compression_level, cache)
+
+    def _finish_store(self, file_in, future, cache):
+        """
+        Waits for the given file to be stored and hands its new checksums over to the checksum cache.
+        Returns the file, or None if storing it failed.
+        """
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                self.failed_files.append(file_in.path)
+                self._log('ERROR', 'Failed to back up file {}: {}', file_in.path, e)
+                return None
+        if cache is not None:
+            cache.apply()
+        return file_in
+
+    def _report_copy_progress(self, file_in_index):
+        if file_in_index % 100 == 0:
+            self._log('DEBUG', '{} new files backed up.', file_in_index)
+            self.backup_model.set_status('Copying files. \t Files copied so far {}'.format(file_in_index), None, True)
 
-            if file_in_index % 100 == 0:
-                self._log('DEBUG', '{} new files backed up.'.format(file_in_index))
-                self.backup_model.set_status('Starting to copy files. \t Files copied so far {}/{}'.format(file_in_index, len(list_of_files)), int((file_in_index / len(list_of_files)) * 100), True)
+    def _run_inline(self, function, *args):
+        """
+        Runs the given function in the calling thread and returns its outcome as a finished Future.
+        """
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _get_parallelism(self):
+        return max(1, int(self._get_optional_parameter('parallelism', 1)))
 
-        self._log('INFO', '{} new files backed up.'.format(len(list_of_files)))
-        return saved_files
+    def get_run_statistics(self):
+        """
+        Returns how many files were copied with each copy strategy.
+        """
+        return {'copy_strategies': dict(self.copy_engine.statistics)}
 
     def restore_files(self, files_to_restore, restore_path, **kwargs):
         """
@@ -58,25 +221,60 @@ class DifferentialLocalProvider(BaseProvider):
         copy_path = self._get_parameter('output_path')
         self._log('INFO', '{} files/folders to restore.'.format(len(files_to_restore)))
         restored_files = []
-        for selection_item in files_to_restore:
-            if selection_item.file_type == 'directory': continue
-            selection_item_path = join_file_path(copy_path, selection_item.savename)
-            restored_file_path = join_file_path(restore_path, selection_item.path)
-            self._restore_file(selection_item_path, restored_file_path)
-            restored_files.append(selection_item.path)
+        with ThreadPoolExecutor(max_workers=self._get_parallelism()) as executor:
+            restores = []
+            for selection_item in files_to_restore:
+                if selection_item.file_type == 'directory': continue
+                self.rate_limiter.refresh()
+                self._load_delta_chain(selection_item)
+                restored_file_path = join_file_path(restore_path, selection_item.path)
+                restores.append((selection_item, executor.submit(self._restore_file, selection_item, restored_file_path, copy_path)))
+            for selection_item, future in restores:
+                try:
+                    future.result()
+                except Exception as e:
+                    self._log('ERROR', 'Failed to restore file {}: {}', selection_item.path, e)
+                    continue
+                restored_files.append(selection_item.path)
         return restored_files
         self._log('INFO', '{} files/folders restored.'.format(len(files_to_restore)))
 
-    def _restore_file(self, selection_item_path, restore_file_path):
+    def _restore_file(self, selection_item, restore_file_path, copy_path):
         """
         Restores the given file to the given path, creating any necessary directories on the way.
+        Plain copies are copied as is, everything else is streamed from its stored content.
         """
+        self.rate_limiter.consume_operations()
         folder = restore_file_path.rsplit('/', 1)[0]
         if not os.path.exists(folder):
-            os.makedirs(folder)
+            os.makedirs(folder, exist_ok=True)
         
-        self._log('DEBUG', 'Copying file {} to {}.'.format(selection_item_path, restore_file_path))
-        copyfile(selection_item_path, restore_file_path)
+        selection_item_path = self._get_stored_path(copy_path, selection_item.savename)
+        self._log('DEBUG', 'Copying file {} to {}.', selection_item_path, restore_file_path)
+        if selection_item.storage_format == 'file' and selection_item.compression == NO_COMPRESSION:
+            self.copy_engine.copy(selection_item_path, restore_file_path)
+        else:
+            self._write_stored_content(selection_item, restore_file_path, copy_path)
+
+    def _iter_stored_content(self, backup_item, copy_path):
+        """
+        Yields the original content of the given item from however it was stored.
+        """
+        backup_file_path = self._get_stored_path(copy_path, backup_item.savename)
+        if backup_item.storage_format == 'chunked':
+            yield from self._iter_manifest_chunks(backup_file_path, copy_path, backup_item.compression)
+        elif backup_item.storage_format == 'packed':
+            yield self._read_packed_file(backup_item, backup_file_path)
+        elif backup_item.storage_format == 'delta':
+            yield from self._iter_delta_content(backup_item, backup_file_path, copy_path)
+        else:
+            yield from iter_decompressed_chunks(backup_file_path, backup_item.compression)
+
+    def _write_stored_content(self, backup_item, path, copy_path):
+        with open(path, 'wb') as f:
+            for chunk in self._iter_stored_content(backup_item, copy_path):
+                self.rate_limiter.consume_bytes(len(chunk))
+                f.write(chunk)
 
 
     def verify_files(self):
@@ -91,11 +289,11 @@ class DifferentialLocalProvider(BaseProvider):
         matched_files = set()
         for backup_item in current_items:
             if backup_item.file_type == 'directory': continue
-            backup_file_path = join_file_path(copy_path, backup_item.savename)
-            backup_file_checksum = calculate_checksum(backup_file_path)
+            backup_file_path = self._get_stored_path(copy_path, backup_item.savename)
+            backup_file_checksum = self._calculate_stored_checksum(backup_item, backup_file_path, copy_path)
             if backup_item.checksum != backup_file_checksum:
                 mismatched_files.add(backup_item.path)
-                self._log('DEBUG', 'File {} failed the verification process.'.format(backup_item.path))
+                self._log('DEBUG', 'File {} failed the verification process.', backup_item.path)
             else:
                 matched_files.add(backup_item.path)
         if len(mismatched_files) > 0:
@@ -103,6 +301,20 @@ class DifferentialLocalProvider(BaseProvider):
             raise exceptions.DataVerificationFailedException(fail_count=len(mismatched_files))
         self._log('INFO', "Found {} files that passed verification process.".format(len(matched_files)))
 
+    def _calculate_stored_checksum(self, backup_item, backup_file_path, copy_path):
+        """
+        Calculates the checksum of the given item's content as it would be restored.
+        Returns None if the stored content is missing.
+        The stored content is always read, never taken from the checksum cache, so corruption of the stored files is noticed.
+        """
+        checksum = get_hasher(backup_item.checksum_algorithm)
+        try:
+            for chunk in self._iter_stored_content(backup_item, copy_path):
+                checksum.update(chunk)
+        except OSError:
+            return None
+        return checksum.hexdigest()
+
     def _get_parameter(self, key):
         """
         Returns the parameter with the given key from the backup parameters.
@@ -110,25 +322,355 @@ class DifferentialLocalProvider(BaseProvider):
         return self.parameters['providerSettings'][key]
     
 
-    def _copy_file(self, file_in, file_out):
+    def _copy_file(self, file_in, file_out, checksum_algorithm, compression_level=None, cache=None):
         """
         Receives a single file that should be copied to the copy folder.
+        Compressed files are copied through a buffer and their checksum is calculated while copying.
+        Other files are copied with the copy engine, so a copy within a file system can share the data blocks
+        or be done by the kernel. Their checksum is then calculated from the stored copy, so it always matches the copy.
+        The copy itself is never added to the checksum cache, verify has to read it.
+        """
+        compressor = self._get_compressor(file_in, compression_level)
+        if compressor is not None:
+            file_in.checksum = copy_file_with_checksum(file_in.path, file_out.path, checksum_algorithm, compressor, self.rate_limiter)
+            file_in.compression = compressor.codec
+            if file_in.compression != NO_COMPRESSION:
+                with self.copy_engine.lock:
+                    self.copy_engine.statistics['compressed'] += 1
+        else:
+            self.copy_engine.copy(file_in.path, file_out.path)
+            file_in.checksum = calculate_checksum(file_out.path, checksum_algorithm)
+        file_in.checksum_algorithm = checksum_algorithm
+
+    def _store_blob(self, file_in, copy_path, checksum_algorithm, compression_level=None, cache=None):
+        """
+        Stores the given file as a content addressed blob and points its savename at the blob.
+        The source is hashed first (usually straight from the checksum cache), so a file
+        whose content is already stored, compressed or not, is never copied.
+        New content is copied to a temporary file and renamed to its blob name once
+        the hash of the copied data is known, so a half written blob is never visible.
+        """
+        cache = cache or self.checksum_cache
+        checksum = calculate_checksum(file_in.path, checksum_algorithm, cache=cache)
+        blob_name = None
+        for compression in dict.fromkeys([file_in.compression, NO_COMPRESSION]):
+            name = self._get_storage_name(self._get_blob_name(checksum, checksum_algorithm, compression))
+            if os.path.exists(join_file_path(copy_path, name)):
+                blob_name, file_in.compression = name, compression
+                break
+        if blob_name is None:
+            temporary_path = join_file_path(copy_path, '.tmp-{}'.format(uuid.uuid4()))
+            try:
+                compressor = self._get_compressor(file_in, compression_level)
+                checksum = copy_file_with_checksum(file_in.path, temporary_path, checksum_algorithm, compressor, self.rate_limiter)
+                file_in.compression = compressor.codec if compressor is not None else NO_COMPRESSION
+                blob_name = self._get_storage_name(self._get_blob_name(checksum, checksum_algorithm, file_in.compression))
+                self._create_folder(join_file_path(copy_path, blob_name))
+                os.replace(temporary_path, join_file_path(copy_path, blob_name))
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+        file_in.checksum = checksum
+        file_in.checksum_algorithm = checksum_algorithm
+        file_in.savename = blob_name
+
+    def _store_packed(self, file_in, pack_writer, checksum_algorithm, compression=NO_COMPRESSION, compression_level=None):
+        """
+        Appends the given small file to the current pack segment and saves its location to file_in.
+        Pack segments are written sequentially, so this runs in the calling thread.
+        """
+        self.rate_limiter.consume_operations()
+        with open(file_in.path, 'rb') as f:
+            data = f.read()
+        file_in.compression = choose_codec(file_in.path, compression, data)
+        self.rate_limiter.consume_bytes(len(data))
+        checksum = get_hasher(checksum_algorithm)
+        checksum.update(data)
+        data = compress_bytes(data, file_in.compression, compression_level)
+        file_in.savename, file_in.pack_offset = pack_writer.append(data)
+        file_in.pack_length = len(data)
+        file_in.storage_format = 'packed'
+        file_in.checksum = checksum.hexdigest()
+        file_in.checksum_algorithm = checksum_algorithm
+
+    def _read_packed_file(self, backup_item, pack_path):
+        """
+        Returns the original content of the given packed item.
+        """
+        data = read_pack_slice(pack_path, backup_item.pack_offset, backup_item.pack_length)
+        return decompress_bytes(data, backup_item.compression)
+
+    def _store_chunks(self, file_in, copy_path, checksum_algorithm, compression_level=None):
+        """
+        Splits the given file into content defined chunks and stores the chunks that aren't stored yet.
+        The chunks are listed in a manifest that the savename of the file points at.
+        The checksum of the whole file is calculated from the same chunks, so the file is only read once.
+        """
+        chunker = self._get_chunker()
+        checksum = get_hasher(checksum_algorithm)
+        chunk_names = []
+        for chunk in chunker.chunks(file_in.path):
+            if not chunk_names:
+                file_in.compression = choose_codec(file_in.path, file_in.compression, chunk)
+            self.rate_limiter.consume_bytes(len(chunk))
+            checksum.update(chunk)
+            chunk_hasher = get_hasher(checksum_algorithm)
+            chunk_hasher.update(chunk)
+            chunk_name = self._get_storage_name(join_file_path(CHUNK_FOLDER, self._get_blob_name(chunk_hasher.hexdigest(), checksum_algorithm, file_in.compression)))
+            chunk_path = join_file_path(copy_path, chunk_name)
+            if not os.path.exists(chunk_path):
+                self._write_atomically(chunk_path, compress_bytes(chunk, file_in.compression, compression_level))
+            chunk_names.append(chunk_name)
+        file_in.checksum = checksum.hexdigest()
+        file_in.checksum_algorithm = checksum_algorithm
+        file_in.storage_format = 'chunked'
+        file_in.savename = self._get_storage_name(join_file_path(MANIFEST_FOLDER, file_in.savename))
+        manifest = {'algorithm': checksum_algorithm, 'chunks': chunk_names}
+        self._write_atomically(join_file_path(copy_path, file_in.savename), json.dumps(manifest).encode('utf-8'))
+
+    def _iter_manifest_chunks(self, manifest_path, copy_path, compression=NO_COMPRESSION):
+        """
+        Yields the content of each chunk listed in the given manifest, in order.
+        """
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        for chunk_name in manifest['chunks']:
+            with open(self._get_stored_path(copy_path, chunk_name), 'rb') as chunk_file:
+                yield decompress_bytes(chunk_file.read(), compression)
+
+    def _store_delta(self, file_in, copy_path, checksum_algorithm, compression_level=None, cache=None, base_item=None):
+        """
+        Stores the given file as a delta against the given previous version of the same path.
+        Falls back to a full copy if there is no previous version, if the chain of deltas
+        leading to it is too long or if the delta would be too large compared to the file.
+        Deltas are never compressed, the literal data in them is usually small.
         """
-        copyfile(file_in.path, file_out.path)
+        max_chain = int(self._get_optional_parameter('delta_max_chain', 10))
+        if base_item is None or base_item.delta_chain >= max_chain:
+            return self._copy_file(file_in, self._generate_output_path(file_in, copy_path), checksum_algorithm, compression_level, cache)
+        max_ratio = float(self._get_optional_parameter('delta_max_ratio', 0.5))
+        delta_name = self._get_storage_name(join_file_path(DELTA_FOLDER, file_in.savename))
+        delta_path = join_file_path(copy_path, delta_name)
+        self._create_folder(delta_path)
+        checksum = get_hasher(checksum_algorithm)
+        base_path = self._materialize_item(base_item, copy_path)
+        self.rate_limiter.consume_bytes(file_in.file_size)
+        try:
+            base_index = build_delta_index(base_path)
+            with open(delta_path, 'wb') as delta_file:
+                literal_bytes = write_delta(file_in.path, base_index, delta_file, checksum, max_literal_bytes=file_in.file_size * max_ratio)
+        finally:
+            os.remove(base_path)
+        if literal_bytes is None:
+            self._log('DEBUG', 'Delta of {} is too large, storing a full copy.', file_in.path)
+            os.remove(delta_path)
+            return self._copy_file(file_in, self._generate_output_path(file_in, copy_path), checksum_algorithm, compression_level, cache)
+        file_in.checksum = checksum.hexdigest()
+        file_in.checksum_algorithm = checksum_algorithm
+        file_in.storage_format = 'delta'
+        file_in.compression = NO_COMPRESSION
+        file_in.savename = delta_name
+        file_in.delta_base = base_item
+        file_in.delta_chain = base_item.delta_chain + 1
+
+    def _get_delta_base(self, file_in):
+        """
+        Returns the latest backed up version of the given file, if there is one,
+        with its whole delta chain loaded so it can be rebuilt without touching the database.
+        """
+        versions = self.backup_model.backup_items.filter(path=file_in.path, file_type='file')
+        if file_in.creation_time:
+            versions = versions.filter(creation_time__lt=file_in.creation_time)
+        return self._load_delta_chain(versions.order_by('-creation_time').first())
+
+    def _load_delta_chain(self, backup_item):
+        """
+        Loads the bases of the given delta item, so worker threads never query them lazily.
+        """
+        base_item = backup_item
+        while base_item is not None and base_item.storage_format == 'delta':
+            base_item = base_item.delta_base
+        return backup_item
+
+    def _iter_delta_content(self, backup_item, delta_path, copy_path):
+        """
+        Yields the content of a delta item by rebuilding its base and applying the delta to it.
+        """
+        base_path = self._materialize_item(backup_item.delta_base, copy_path)
+        try:
+            yield from iter_applied_delta(delta_path, base_path)
+        finally:
+            os.remove(base_path)
+
+    def _materialize_item(self, backup_item, copy_path):
+        """
+        Writes the original content of the given item to a temporary file in the copy folder and returns its path.
+        The caller is responsible for removing the file.
+        """
+        fd, path = tempfile.mkstemp(prefix='.tmp-', dir=copy_path)
+        os.close(fd)
+        try:
+            self._write_stored_content(backup_item, path, copy_path)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    def _get_chunker(self):
+        average_size = self._get_optional_parameter('chunk_size', DEFAULT_AVERAGE_CHUNK_SIZE)
+        return ContentDefinedChunker(average_size=int(average_size))
+
+    def _write_atomically(self, path, data):
+        """
+        Writes the given data to a temporary file next to the given path and renames it in place.
+        """
+        folder = path.rsplit('/', 1)[0]
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        temporary_path = '{}.tmp-{}'.format(path, uuid.uuid4())
+        try:
+            with open(temporary_path, 'wb') as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _get_blob_name(self, checksum, checksum_algorithm, compression=NO_COMPRESSION):
+        """
+        Returns the name of the blob holding content with the given checksum.
+        The algorithm and the compression codec are part of the name, so changing either never mixes up blobs.
+        """
+        if compression == NO_COMPRESSION:
+            return '{}-{}'.format(checksum_algorithm, checksum)
+        return '{}-{}.{}'.format(checksum_algorithm, checksum, compression)
+
+    def _get_compressor(self, file_in, compression_level=None):
+        """
+        Returns a compressor for the codec chosen for the given file, or None if it isn't compressed.
+        The compressor probes the first chunk, its codec is the one the file ended up stored with.
+        """
+        if file_in.compression == NO_COMPRESSION:
+            return None
+        return ProbingCompressor(file_in.compression, compression_level)
+
+    def _get_storage_mode(self):
+        """
+        Returns the storage mode set in the provider settings.
+        """
+        storage_mode = self._get_optional_parameter('storage_mode', 'file')
+        if storage_mode not in STORAGE_MODES:
+            raise exceptions.UnsupportedStorageModeException(storage_mode)
+        return storage_mode
 
     def _generate_output_path(self, file_in, copy_path):
         """
         Generates an output path for the new file.
         Takes in account the creation time as well as the absolute path of the input file.
         """
+        file_in.savename = self._get_storage_name(file_in.savename)
         new_file_name = file_in.savename
         file_out =  join_file_path(copy_path, new_file_name)
+        self._create_folder(file_out)
         # self._log('DEBUG', 'Output path for {} is {}'.format(file_in.path, file_out))
         return self.backup_model.create_backup_file_instance(file_out)
 
-    def _log(self, level, message):
+    def migrate_layout(self):
+        """
+        Moves the stored files of this backup to the current layout, sharded or flat, and updates their savenames.
+        Files are moved before their savenames are updated, and reading falls back to the other layout,
+        so an interrupted migration can simply be run again. Pack segments and chunks referenced from
+        manifests are left where they are. Returns the number of moved files.
+        """
+        copy_path = self._get_parameter('output_path')
+        moved_count = 0
+        last_id = 0
+        items = self.backup_model.backup_items.exclude(file_type='directory').exclude(storage_format='packed').order_by('id')
+        while True:
+            batch = list(items.filter(id__gt=last_id)[:MIGRATION_BATCH_SIZE])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            migrated_items = []
+            for backup_item in batch:
+                new_name = self._get_sharded_name(backup_item.savename) if self.layout == 'sharded' else self._get_flat_name(backup_item.savename)
+                if new_name == backup_item.savename:
+                    continue
+                old_path = join_file_path(copy_path, backup_item.savename)
+                new_path = join_file_path(copy_path, new_name)
+                if os.path.exists(old_path) and not os.path.exists(new_path):
+                    self._create_folder(new_path)
+                    os.replace(old_path, new_path)
+                    moved_count += 1
+                backup_item.savename = new_name
+                migrated_items.append(backup_item)
+            self.backup_model.backup_items.model.objects.bulk_update(migrated_items, ['savename'], batch_size=MIGRATION_BATCH_SIZE)
+            self._log('DEBUG', 'Moved {} stored files to the {} layout so far.', moved_count, self.layout)
+        self._log('INFO', 'Moved {} stored files to the {} layout.'.format(moved_count, self.layout))
+        return moved_count
+
+    def _get_storage_name(self, name):
+        """
+        Returns the name the file with the given name is stored with in the current layout.
+        """
+        return self._get_sharded_name(name) if self.layout == 'sharded' else name
+
+    def _get_sharded_name(self, name):
+        """
+        Returns the given name in the sharded layout, where files are placed in 'ab/cd/' sub folders
+        of their folder, taken from the start of their uuid or hash. Names that are already sharded are returned as is.
+        """
+        if self._is_sharded_name(name):
+            return name
+        folder, _, filename = name.rpartition('/')
+        key = filename.rsplit('-', 1)[-1]
+        return '/'.join([part for part in [folder, key[0:2], key[2:4], filename] if part])
+
+    def _get_flat_name(self, name):
+        """
+        Returns the given name in the flat layout.
+        """
+        if not self._is_sharded_name(name):
+            return name
+        parts = name.split('/')
+        return '/'.join(parts[:-3] + parts[-1:])
+
+    def _is_sharded_name(self, name):
+        """
+        Returns whether the given name is in the sharded layout: its two parent folders are
+        the start of its uuid or hash, not just any folders with two character names.
+        """
+        if not SHARDED_NAME.search(name):
+            return False
+        parts = name.split('/')
+        key = parts[-1].rsplit('-', 1)[-1]
+        return parts[-3] == key[0:2] and parts[-2] == key[2:4]
+
+    def _get_stored_path(self, copy_path, name):
+        """
+        Returns the path of the stored file with the given name.
+        If it isn't found, the same file is looked for in the other layout.
+        """
+        path = join_file_path(copy_path, name)
+        if os.path.exists(path):
+            return path
+        other_name = self._get_flat_name(name) if self._is_sharded_name(name) else self._get_sharded_name(name)
+        other_path = join_file_path(copy_path, other_name)
+        return other_path if os.path.exists(other_path) else path
+
+    def _create_folder(self, path):
+        """
+        Creates the folder of the given file path if it hasn't been created yet.
+        """
+        folder = path.rsplit('/', 1)[0]
+        if folder not in self.created_folders:
+            os.makedirs(folder, exist_ok=True)
+            self.created_folders.add(folder)
+
+    def _log(self, level, message, *args):
         """
         Helper method to log events.
         Uses the logger provided on initialization to add logs.
+        Any extra arguments are formatted into the message only if the level is logged.
         """
-        self.logger.log(message=message, level=level, tag=self.tag)
+        self.logger.log(message, self.tag, level, *args)
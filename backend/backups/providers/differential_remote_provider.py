@@ -3,71 +3,148 @@ import glob
 import shelve
 import tempfile
 import uuid
+import threading
+import subprocess
+from collections import namedtuple
 from shutil import copyfile
+from django.utils import timezone
+from django.db.models import OuterRef, Subquery
 import backups.providers.exceptions as exceptions
+from backups.ssh import get_connection, release_connection
+from backups.remote_checksums import iter_remote_checksums
 from backups.providers.base_provider import BaseProvider
-from logs.models import BackupLogger
-from becky.utils import remove_prefix, join_file_path, path_to_folders
+from backups.providers.snapshot_local_provider import SNAPSHOT_NAME_FORMAT, LAST_SNAPSHOT_KEY
+from backups.compression import NO_COMPRESSION, COMPRESSED_EXTENSIONS
+from becky.utils import remove_prefix, join_file_path, path_to_folders, batched, split_balanced
 
 """
 A remote backup provider that can backup files from the local system
 to a remote server in a differential fashion.
+Files are stored uncompressed on the remote server, but if the 'compression'
+backup parameter is set, rsync compresses them on the wire.
+The 'bandwidth_limit' parameter (see backups.throttling) is passed to rsync as --bwlimit.
+It is read again before each rsync call, so a change applies from the next batch on.
+Each batch counts its files against the 'operation_limit' parameter before it is sent.
+All ssh, scp and rsync calls of a run go through one multiplexed SSH connection (see backups.ssh),
+which is opened on first use and closed by close().
+Checksums are verified on the remote server with any supported algorithm (see backups.remote_checksums),
+which needs python3 on the remote server.
+With the 'rsync_shards' provider setting above 1, each batch is split into that many shards of about
+the same total size, copied by concurrent rsync processes over the shared connection.
+
+The 'layout' provider setting selects how the files are laid out on the remote server:
+    mirror - (default) Files are copied to 'remote_path/<path>', a new version overwrites the previous one.
+    versioned - Each run writes a snapshot 'remote_path/<timestamp>/<path>'. Changed files are copied
+                into it, then the rest of the still existing files are sent with --link-dest against
+                the previous snapshot, so rsync hardlinks them instead of transferring them again.
+                The savename of each item points at the snapshot it was written to,
+                so every version stays restorable. A snapshot left unfinished by a failed run
+                is never used as the base of the next one.
 """
+
+RSYNC_BATCH_SIZE = 1000 # How many files are sent with a single rsync call, or set of concurrent rsync calls
+RSYNC_STATUS_INTERVAL = 1 # Seconds between status updates while rsync is running
+LAYOUTS = ['mirror', 'versioned']
+
+RsyncFile = namedtuple('RsyncFile', ['path', 'file_size'])
+
 class DifferentialRemoteProvider(BaseProvider):
     
     def __init__(self, parameters, backup_model):
         self.parameters = parameters
         self.backup_model = backup_model
-        self.logger = BackupLogger(backup_model)
+        self.logger = backup_model.get_logger()
+        self.rate_limiter = backup_model.get_rate_limiter()
+        self.connection = None
+        self.failed_files = []
+        self.layout = self._get_optional_parameter('layout', 'mirror')
+        if self.layout not in LAYOUTS:
+            raise exceptions.UnsupportedStorageModeException(self.layout, message="Attempted to use an unsupported remote layout.")
         self.tag = 'DifferentialRemoteBackupProvider'
 
-    def backup_files(self, list_of_files):
+    def backup_files(self, files):
         """
-        Receives a list of files to be backed up. 
+        Receives an iterable of files to be backed up. 
+        Files are copied with rsync in batches, so copying can start before
+        the scanner has found every file.
+        Yields each file once its batch has been copied. Files of an rsync shard that failed are left out
+        and listed by get_failed_files(), so they are copied again on the next run.
         """
         self._log('INFO', 'Started backing up files.')
-        list_of_files.sort(key=lambda x: len(x.path)) # Sort, so folders will be created before any files are copied in.
+        self.failed_files = []
         remote_addr = self._get_parameter('remote_addr')
         remote_copy_path = self._get_parameter('remote_path')
         ssh_identity_path = self._get_parameter('ssh_id_path')
 
-        self._log('DEBUG', 'Saving files to {}/{}'.format(remote_addr, remote_copy_path))
-        self._log('INFO', 'Files sorted, starting backing up {} files.'.format(len(list_of_files)))
-        self.backup_model.set_status('Starting to copy files. \t Files copied so far {}/{}'.format(0, len(list_of_files)), 0, True)
+        snapshot_name = None
+        link_options = []
+        if self.layout == 'versioned':
+            previous_snapshot = self._get_previous_snapshot()
+            snapshot_name = timezone.now().strftime(SNAPSHOT_NAME_FORMAT)
+            if previous_snapshot:
+                link_options = ['--link-dest={}'.format(join_file_path(remote_copy_path, previous_snapshot))]
+            self._log('INFO', 'Saving snapshot {}.'.format(snapshot_name))
+        destination_path = join_file_path(remote_copy_path, snapshot_name) if snapshot_name else remote_copy_path
+
+        self._log('DEBUG', 'Saving files to {}/{}'.format(remote_addr, destination_path))
+        self.backup_model.set_status('Starting to copy files. \t Files copied so far {}'.format(0), 0, True)
+
+        copied_count = 0
+        copied_paths = set()
+        for files_to_copy in batched(files, RSYNC_BATCH_SIZE):
+            files_to_copy.sort(key=lambda x: len(x.path)) # Sort, so folders will be created before any files are copied in.
+            self.rate_limiter.refresh()
+            self.rate_limiter.consume_operations(len(files_to_copy))
+            failed_paths = set(f.path for f in self._copy_files(files_to_copy, remote_addr, destination_path, ssh_identity_path, copied_count, link_options))
+            self.failed_files.extend(failed_paths)
+            files_to_copy = [file_in for file_in in files_to_copy if file_in.path not in failed_paths]
+            copied_count += len(files_to_copy)
+            if snapshot_name:
+                for file_in in files_to_copy:
+                    file_in.savename = join_file_path(snapshot_name, file_in.path)
+                    file_in.storage_format = 'snapshot'
+                    copied_paths.add(file_in.path)
+            yield from files_to_copy
+            self.backup_model.set_status('Copying files. \t Files copied so far {}'.format(copied_count), None, True)
+        self._log('INFO', '{} new files backed up.'.format(copied_count))
+        if self.failed_files:
+            self._log('WARNING', '{} files could not be backed up.'.format(len(self.failed_files)))
 
-        saved_files = []
-        files_to_copy = []
-        for file_in_index, file_in in enumerate(list_of_files):
-            files_to_copy.append(file_in)
-            if file_in.file_type == 'directory': continue # We don't save directories
-            file_out = self._generate_output_path(file_in, remote_copy_path)
+        if snapshot_name:
+            linked = self._link_unchanged_files(remote_addr, destination_path, ssh_identity_path, link_options, copied_paths)
+            if linked and not self.failed_files:
+                self.backup_model.metadata.update_or_create(key=LAST_SNAPSHOT_KEY, defaults={'value': snapshot_name})
+            else:
+                self._log('WARNING', 'Snapshot {} is incomplete, the next run links against the previous one.'.format(snapshot_name))
 
-        self._copy_files(files_to_copy, remote_addr, remote_copy_path, ssh_identity_path)
-        self._log('INFO', '{} new files backed up.'.format(len(list_of_files)))
-        return files_to_copy
+    def get_failed_files(self):
+        return self.failed_files
 
-    def restore_files(self, selections, restore_path, **kwargs):
+    def restore_files(self, files_to_restore, restore_path, **kwargs):
         """
         Restores selected files from the backups to the restore folder.
+        The files are the BackupItems resolved from the catalog, so nothing is looked up on the local file system.
+        They are copied with a single rsync batch, or with concurrent shards if 'rsync_shards' is set.
         """
         self._log('INFO', 'Starting file restore process.') 
         remote_addr = self._get_parameter('remote_addr')
         remote_copy_path = self._get_parameter('remote_path')
         ssh_identity_path = self._get_parameter('ssh_id_path')
 
-        files_to_restore = []
-        for selection in selections:
-            selection_files = path_to_folders(selection.path) + glob.glob(selection.path + "/**/*", recursive=True)
-            files_to_restore += selection_files
         self._log('INFO', '{} files/folders to restore.'.format(len(files_to_restore)))
-        files_to_restore = list(set(files_to_restore))
-        files_to_restore.sort(key=len)
-        files_to_copy = []
-        for selection_file in files_to_restore:
-            backup_file = self.backup_model.create_backup_file_instance(selection_file)
-            files_to_copy.append(backup_file)
-        self._copy_remote_files(files_to_copy, restore_path, remote_addr, remote_copy_path, ssh_identity_path)
-        self._log('INFO', '{} files/folders restored.'.format(len(files_to_restore)))
+        self.rate_limiter.refresh(force=True)
+        self.rate_limiter.consume_operations(len(files_to_restore))
+        files_by_folder = {}
+        for backup_item in files_to_restore:
+            files_by_folder.setdefault(self._get_item_folder(backup_item, remote_copy_path), []).append(backup_item)
+        failed_paths = set()
+        for folder, folder_files in files_by_folder.items():
+            failed_paths.update(backup_item.path for backup_item in self._copy_remote_files(folder_files, restore_path, remote_addr, folder, ssh_identity_path))
+        if failed_paths:
+            self._log('ERROR', '{} files/folders could not be restored.'.format(len(failed_paths)))
+        restored_paths = [backup_item.path for backup_item in files_to_restore if backup_item.path not in failed_paths]
+        self._log('INFO', '{} files/folders restored.'.format(len(restored_paths)))
+        return restored_paths
 
     def verify_files(self):
         """
@@ -76,15 +153,83 @@ class DifferentialRemoteProvider(BaseProvider):
         """
         backup_items = self.backup_model.get_all_backup_items()
         remote_copy_path = self._get_parameter('remote_path')
-        remote_paths = [join_file_path(remote_copy_path, backup_item.path) for backup_item in backup_items]
-        remote_checksums = self._get_remote_checksums(remote_paths)
+        items_by_algorithm = {}
+        for backup_item in backup_items:
+            if backup_item.file_type == 'directory': continue
+            remote_item_path = join_file_path(self._get_item_folder(backup_item, remote_copy_path), backup_item.path)
+            items_by_algorithm.setdefault(backup_item.checksum_algorithm, {})[remote_item_path] = backup_item
         mismatched_files = set()
-        for backup_item_i, backup_item in enumerate(backup_items):
-            if backup_item.checksum != remote_checksums.get(join_file_path(remote_copy_path, backup_item.path), '0'):
-                mismatched_files.add(backup_item.path)
+        for algorithm, items in items_by_algorithm.items():
+            unchecked_paths = set(items.keys())
+            for remote_path, checksum in self._get_remote_checksums(list(items.keys()), algorithm):
+                if remote_path not in unchecked_paths: continue
+                unchecked_paths.discard(remote_path)
+                if items[remote_path].checksum != checksum:
+                    mismatched_files.add(items[remote_path].path)
+            mismatched_files.update(items[remote_path].path for remote_path in unchecked_paths) # Missing or unreadable on the remote server
         if len(mismatched_files) > 0:
             raise exceptions.DataVerificationFailedException(fail_count=len(mismatched_files))
 
+    def _link_unchanged_files(self, remote_addr, destination_path, ssh_identity_path, link_options, copied_paths):
+        """
+        Completes the new snapshot with every backed up file that still exists, is still selected and wasn't copied in this run.
+        Only the newest version of each path in the catalog is looked at.
+        They are sent with --link-dest against the previous snapshot, so rsync hardlinks the unchanged ones
+        on the remote server instead of transferring them. Without a previous snapshot, f.ex. right after
+        switching from the mirror layout, they are transferred once.
+        Returns whether every file made it into the new snapshot.
+        """
+        self._log('INFO', 'Linking unchanged files from the previous snapshot.')
+        self.backup_model.set_status('Linking unchanged files.', None, True)
+        selections = [selection.path.rstrip('/') for selection in self.backup_model.files.all()]
+        unchanged_files = {}
+        newest_version = self.backup_model.backup_items.filter(path=OuterRef('path')).order_by('-creation_time').values('creation_time')[:1]
+        newest_items = self.backup_model.backup_items.filter(file_type='file', creation_time=Subquery(newest_version))
+        for path, file_size in newest_items.values_list('path', 'file_size').iterator():
+            if path in copied_paths:
+                continue
+            if not any(path == selection or path.startswith(selection + '/') for selection in selections):
+                continue
+            if os.path.isfile(path):
+                unchanged_files[path] = RsyncFile(path, file_size)
+        self.rate_limiter.refresh()
+        failed_files = self._copy_files(sorted(unchanged_files.values()), remote_addr, destination_path, ssh_identity_path, extra_options=link_options + ['--ignore-existing'])
+        self._log('INFO', '{} unchanged files linked from the previous snapshot.'.format(len(unchanged_files) - len(failed_files)))
+        return not failed_files
+
+    def _get_previous_snapshot(self):
+        """
+        Returns the name of the last finished snapshot, or None if there isn't one.
+        """
+        metadata = self.backup_model.metadata.filter(key=LAST_SNAPSHOT_KEY).first()
+        return metadata.value if metadata else None
+
+    def _get_item_folder(self, backup_item, remote_copy_path):
+        """
+        Returns the remote folder the given item is stored under: its snapshot, or remote_path itself in the mirror layout.
+        """
+        if backup_item.storage_format == 'snapshot':
+            return join_file_path(remote_copy_path, backup_item.savename.split('/', 1)[0])
+        return remote_copy_path
+
+    def close(self):
+        """
+        Closes the SSH connection of this run.
+        """
+        if self.connection is not None:
+            release_connection(self.connection)
+            self.connection = None
+
+    def _get_connection(self):
+        """
+        Returns the SSH connection to the remote server, opening it on first use.
+        """
+        if self.connection is None:
+            self.connection = get_connection(self._get_parameter('remote_addr'), self._get_parameter('ssh_id_path'))
+            if not self.connection.is_open():
+                self._log('WARNING', 'Could not open a shared SSH connection to {}, connecting separately for each command.', self.connection.remote_addr)
+        return self.connection
+
     def get_remote_files(self, path, **kwargs):
         """
         Returns all remote files at the given path. 
@@ -100,63 +245,99 @@ class DifferentialRemoteProvider(BaseProvider):
         """
         return self.parameters['providerSettings'][key]
 
-    def _get_remote_checksums(self, remote_paths):
+    def _get_remote_checksums(self, remote_paths, algorithm):
         """
-        Runs checksums on the remote server on the given paths.
-        Process:
-            1. Copies the list of files to run checksum to the server.
-            2. Runs md5sum on each file on the remote server and save results to tmp.
-            3. Copy back the results.
-        TODO: Maybe use an actual SSH client to do this without any file saving.
+        Yields (path, checksum) pairs of the given paths, calculated on the remote server with the given algorithm.
+        The paths are streamed over the shared SSH connection and hashed in parallel by
+        'remote_checksum_workers' threads (one per remote CPU by default), see backups.remote_checksums.
         """
-        remote_addr = self._get_parameter('remote_addr')
-        remote_copy_path = self._get_parameter('remote_path')
-        ssh_identity_path = self._get_parameter('ssh_id_path')
-
-        remote_paths_file = '/tmp/{}'.format(str(uuid.uuid4()))
-        remote_checksums_file = '/tmp/{}'.format(str(uuid.uuid4()))
-        open(remote_paths_file, "w").write('\n'.join(remote_paths) + '\n')
-        command = 'scp -i {} {} {}:{} > /dev/null'.format(ssh_identity_path, remote_paths_file, remote_addr, remote_paths_file)
-        os.system(command)
-        command = "ssh -i {} {} 'while read line; do md5sum $line; done < {} > {} 2>/dev/null' > /dev/null".format(ssh_identity_path, remote_addr, remote_paths_file, remote_checksums_file)
-        os.system(command)
-        command = 'scp -i {} {}:{} {} > /dev/null'.format(ssh_identity_path, remote_addr, remote_checksums_file, remote_checksums_file)
-        os.system(command)
-        checksum_lines = open(remote_checksums_file, "r").read().split('\n')
-        checksums = {}
-        checksum_lines = [l.strip() for l in checksum_lines if l.strip()]
-        for checksum_i, checksum_line in enumerate(checksum_lines):
-            checksum = checksum_line.split(" ")[0].strip()
-            file_name = checksum_line.split(" ", 1)[1].strip()
-            checksums[file_name] = checksum
-        return checksums
+        workers = int(self._get_optional_parameter('remote_checksum_workers', 0))
+        return iter_remote_checksums(self._get_connection(), remote_paths, algorithm, workers)
 
     
-    def _copy_files(self, files, remote_addr, remote_path, ssh_identity_path):
+    def _copy_files(self, files, remote_addr, remote_path, ssh_identity_path, copied_count=0, extra_options=None):
         """
         Copies a list of files from the current server to the remote server.
-        Uses rsync to copy the files efficiently.
+        Uses rsync to copy the files efficiently. Returns the files that may not have been copied.
         """
-        paths = [f.path for f in files]
-        files_file = tempfile.NamedTemporaryFile(mode="w")
-        files_file.write('\n'.join(paths))
-        files_file.flush()
-        command = 'rsync -e "ssh -i {}" --files-from {} / {}:{}'.format(ssh_identity_path, files_file.name, remote_addr, remote_path)
-        os.system(command)
-        files_file.close()
+        return self._run_sharded_rsync(files, '/', '{}:{}'.format(remote_addr, remote_path), copied_count, extra_options or [])
 
     def _copy_remote_files(self, files, restore_path, remote_addr, remote_path, ssh_identity_path):
         """
         Copies a list of files from the remote server to the current server in the specified restore folder.
-        Uses rsync to copy the files efficiently.
+        Uses rsync to copy the files efficiently. Returns the files that may not have been copied.
+        """
+        return self._run_sharded_rsync(files, '{}:{}'.format(remote_addr, remote_path), restore_path)
+
+    def _run_sharded_rsync(self, files, source, destination, copied_count=0, extra_options=None):
+        """
+        Copies the given files from source to destination with one rsync process per shard, all running at once.
+        The files are split into 'rsync_shards' shards of about the same total size, and each shard
+        gets an equal part of the bandwidth limit. While they run, the progress of all shards
+        is summed up into the backup status.
+        Returns the files of the shards whose rsync failed, any of them may be missing or incomplete.
+        Modification times are always preserved: --link-dest only hardlinks a file if its size and mtime
+        match the previous snapshot, and restored files get back their original times.
+        """
+        shards = split_balanced(files, self._get_shard_count(), lambda f: f.file_size or 0)
+        options = ['--times'] + self._get_compression_options() + self._get_bandwidth_options(len(shards)) + (extra_options or []) + ['--out-format=%l %n']
+        connection = self._get_connection()
+        progress = RsyncProgress()
+        transfers = []
+        try:
+            for shard in shards:
+                files_file = tempfile.NamedTemporaryFile(mode="w")
+                files_file.write('\n'.join(f.path for f in shard))
+                files_file.flush()
+                process = connection.popen_rsync(options + ['--files-from', files_file.name, source, destination], stdout=subprocess.PIPE)
+                reader = threading.Thread(target=progress.read, args=(process.stdout,), daemon=True)
+                reader.start()
+                transfers.append((process, reader, files_file, shard))
+            for _, reader, _, _ in transfers:
+                while reader.is_alive():
+                    reader.join(timeout=RSYNC_STATUS_INTERVAL)
+                    self._report_rsync_progress(progress, copied_count, len(transfers))
+        finally:
+            failed_files = []
+            for process, reader, files_file, shard in transfers:
+                process.wait()
+                reader.join()
+                files_file.close()
+                if process.returncode != 0:
+                    self._log('ERROR', 'rsync exited with code {}, {} files of its shard are treated as failed.', process.returncode, len(shard))
+                    failed_files.extend(shard)
+        return failed_files
+
+    def _report_rsync_progress(self, progress, copied_count, shard_count):
+        files, transferred_bytes = progress.get()
+        self.backup_model.set_status('Copying files. \t Files copied so far {} ({} MB, {} rsync streams)'.format(copied_count + files, transferred_bytes // (1024 * 1024), shard_count), None, True)
+
+    def _get_shard_count(self):
+        return max(1, int(self._get_optional_parameter('rsync_shards', 1)))
+
+    def _get_compression_options(self):
+        """
+        Returns the rsync options for compressing the transfer, if compression is enabled.
+        rsync uses its own codecs, so only the level is passed on. Files that are already compressed are skipped.
         """
-        paths = [f.path for f in files]
-        files_file = tempfile.NamedTemporaryFile(mode="w")
-        files_file.write('\n'.join(paths))
-        files_file.flush()
-        command = 'rsync -e "ssh -i {}" --files-from {} {}:{} {}'.format(ssh_identity_path, files_file.name, remote_addr, remote_path, restore_path)
-        os.system(command)
-        files_file.close()
+        codec, level = self.backup_model.get_compression()
+        if codec == NO_COMPRESSION:
+            return []
+        options = ['--compress', '--skip-compress={}'.format('/'.join(sorted(extension.lstrip('.') for extension in COMPRESSED_EXTENSIONS)))]
+        if level is not None:
+            options.append('--compress-level={}'.format(level))
+        return options
+
+    def _get_bandwidth_options(self, shard_count=1):
+        """
+        Returns the rsync option for limiting the bandwidth, if a bandwidth limit is set.
+        The limit is split evenly between the given number of concurrent rsync processes.
+        rsync takes the limit in KiB per second.
+        """
+        bandwidth_limit = self.rate_limiter.get_bandwidth_limit()
+        if not bandwidth_limit:
+            return []
+        return ['--bwlimit={}'.format(max(1, bandwidth_limit // shard_count // 1024))]
 
     def _generate_output_path(self, file_in, copy_path):
         """
@@ -166,9 +347,37 @@ class DifferentialRemoteProvider(BaseProvider):
         # self._log('DEBUG', 'Output path for {} is {}'.format(file_in.path, file_out))
         return self.backup_model.create_backup_file_instance(file_out)
 
-    def _log(self, level, message):
+    def _log(self, level, message, *args):
         """
         Helper method to log events.
         Uses the logger provided on initialization to add logs.
+        Any extra arguments are formatted into the message only if the level is logged.
+        """
+        self.logger.log(message, self.tag, level, *args)
+
+
+class RsyncProgress:
+    """
+    Sums up the files and bytes reported by concurrent rsync processes run with --out-format='%l %n'.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+
+    def read(self, stream):
         """
-        self.logger.log(message=message, level=level, tag=self.tag)
+        Reads the output of one rsync process until it ends. Runs in its own thread.
+        """
+        for line in stream:
+            size, _, name = line.decode('utf-8', 'replace').rstrip('\n').partition(' ')
+            if not size.isdigit() or name.endswith('/'): # Directories aren't counted
+                continue
+            with self.lock:
+                self.files += 1
+                self.bytes += int(size)
+
+    def get(self):
+        with self.lock:
+            return self.files, self.bytes
@@ -7,43 +7,47 @@ from shutil import copyfile
 
 import backups.providers.exceptions as exceptions
 from backups.providers.base_provider import BaseProvider
-from logs.models import BackupLogger
 from becky.utils import remove_prefix, join_file_path, path_to_folders
 
 """
 A provider that can backup to and from any S3 compatible object storage server in a
 differential fashion.
+Transfers are limited by the 'bandwidth_limit' parameter (see backups.throttling) through
+s3cmd's --limit-rate, and every s3cmd call counts against the 'operation_limit' parameter.
 """
 class DifferentialS3Provider(BaseProvider):
     
+    supported_checksum_algorithms = ['md5'] # S3 only lists MD5 hashes of the objects
+
     def __init__(self, parameters, backup_model):
         self.parameters = parameters
         self.backup_model = backup_model
-        self.logger = BackupLogger(backup_model)
+        self.logger = backup_model.get_logger()
+        self.rate_limiter = backup_model.get_rate_limiter()
         self.tag = 'DifferentialS3Provider'
 
-    def backup_files(self, list_of_files):
+    def backup_files(self, files):
         """
-        Receives a list of files to be backed up. 
+        Receives an iterable of files to be backed up. 
+        Yields each file once it has been uploaded.
         TODO: Use rsync or something a bit more efficient than
         going through files one at a time.
         """
         self._log('INFO', 'Started backing up files.')
         bucket_name = self._get_parameter('bucket_name')
         self._log('DEBUG', 'Saving files to bucket {}'.format(bucket_name))
-        self._log('INFO', 'Files sorted, starting backing up {} files.'.format(len(list_of_files)))
-        self.backup_model.set_status('Starting to copy files. \t Files copied so far {}/{}'.format(0, len(list_of_files)), 0, True)
-        saved_files = []
-        for file_in_index, file_in in enumerate(list_of_files):
-            saved_files.append(file_in)
-            if file_in.file_type == 'directories': continue # We don't save directories
-            file_out = self._generate_output_path(file_in, bucket_name)
-            self._copy_file(file_in, file_out)
+        self.backup_model.set_status('Starting to copy files. \t Files copied so far {}'.format(0), 0, True)
+        file_in_index = 0
+        for file_in_index, file_in in enumerate(files, 1):
+            self.rate_limiter.refresh()
+            if file_in.file_type != 'directory': # We don't save directories
+                file_out = self._generate_output_path(file_in, bucket_name)
+                self._copy_file(file_in, file_out)
+            yield file_in
             if file_in_index % 100 == 0:
-                self._log('DEBUG', '{} new files backed up.'.format(file_in_index))
-                self.backup_model.set_status('Starting to copy files. \t Files copied so far {}/{}'.format(file_in_index, len(list_of_files)), int((file_in_index / len(list_of_files)) * 100), True)
-        self._log('INFO', '{} new files backed up.'.format(len(list_of_files)))
-        return saved_files
+                self._log('DEBUG', '{} new files backed up.', file_in_index)
+                self.backup_model.set_status('Copying files. \t Files copied so far {}'.format(file_in_index), None, True)
+        self._log('INFO', '{} new files backed up.'.format(file_in_index))
 
     def restore_files(self, files_to_restore, restore_path, **kwargs):
         """
@@ -55,6 +59,7 @@ class DifferentialS3Provider(BaseProvider):
         restored_files = []
         for selection_file in files_to_restore:
             if selection_file.file_type == 'directory': continue
+            self.rate_limiter.refresh()
             restored_file = self.backup_model.create_backup_file_instance(join_file_path(restore_path, selection_file.path))
             self._restore_file(selection_file, restored_file, bucket_name)
             restored_files.append(restored_file)
@@ -100,7 +105,7 @@ class DifferentialS3Provider(BaseProvider):
                 return
         if os.path.isdir(file_in.path): # No need to copy folders on s3 
             return
-        result, err = self._run_command(['put', file_in.path, file_out.path])
+        result, err = self._run_command(['put', file_in.path, file_out.path] + self._get_bandwidth_options())
 
     def _restore_file(self, backup_file, restored_file, bucket_name):
         """
@@ -110,7 +115,7 @@ class DifferentialS3Provider(BaseProvider):
         if backup_file.file_type == 'directory':
             os.makedirs(restored_file.path)
         else:
-            result, err = self._run_command(['get', backup_path.path, restored_file.path])
+            result, err = self._run_command(['get', backup_path.path, restored_file.path] + self._get_bandwidth_options())
 
     def _run_command(self, commands):
         """
@@ -121,11 +126,21 @@ class DifferentialS3Provider(BaseProvider):
         secret_key = self._get_parameter('secret_key')
         host = self._get_parameter('host')
         host_bucket = self._get_parameter('host_bucket')
+        self.rate_limiter.consume_operations()
         result = subprocess.run(['s3cmd'] + commands + ['--access_key', access_key, '--secret_key', secret_key, '--host', host, '--host-bucket', host_bucket], stdout=subprocess.PIPE)
         stdout = result.stdout.decode() if result.stdout else None
         stderr = result.stderr.decode() if result.stderr else None
         return stdout, stderr
 
+    def _get_bandwidth_options(self):
+        """
+        Returns the s3cmd option for limiting the transfer rate, if a bandwidth limit is set.
+        """
+        bandwidth_limit = self.rate_limiter.get_bandwidth_limit()
+        if not bandwidth_limit:
+            return []
+        return ['--limit-rate={}'.format(bandwidth_limit)]
+
     def _generate_output_path(self, file_in, bucket_name):
         """
         Generates an output path by concatenating copy_path and file_in.
@@ -133,9 +148,10 @@ class DifferentialS3Provider(BaseProvider):
         file_out =  join_file_path('s3://', bucket_name, file_in.path)
         return self.backup_model.create_backup_file_instance(file_out)
 
-    def _log(self, level, message):
+    def _log(self, level, message, *args):
         """
         Helper method to log events.
         Uses the logger provided on initialization to add logs.
+        Any extra arguments are formatted into the message only if the level is logged.
         """
-        self.logger.log(message=message, level=level, tag=self.tag)
+        self.logger.log(message, self.tag, level, *args)
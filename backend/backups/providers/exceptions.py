@@ -16,4 +16,14 @@ class DataVerificationFailedException(Exception):
 
     def __str__(self):
         return "{} -- {} files failed.".format(self.message, self.fail_count)
-        
+
+
+class UnsupportedStorageModeException(Exception):
+
+    def __init__(self, storage_mode, message="Attempted to use an unsupported storage mode."):
+        self.storage_mode = storage_mode
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return "{} -- Storage mode {} is not supported.".format(self.message, str(self.storage_mode))
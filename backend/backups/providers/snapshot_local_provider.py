@@ -0,0 +1,138 @@
+import os
+import errno
+from django.utils import timezone
+
+from backups.compression import NO_COMPRESSION
+from backups.providers.differential_local_provider import DifferentialLocalProvider
+from becky.utils import join_file_path
+
+"""
+A local backup provider that saves every backup run as a browsable snapshot of the backed up files.
+Each run creates a folder 'output_path/<timestamp>/' that mirrors the absolute paths of the backed up files.
+Files the differential scanner reports as changed are copied into the new snapshot,
+every other file is hardlinked from the previous snapshot, so an unchanged file takes no extra space.
+Files that no longer exist, or are no longer selected for backup, are left out of the new snapshot.
+
+Restoring a whole point in time is a plain copy of its snapshot folder and browsing one needs no catalog.
+Files are still recorded as BackupItems, so restore and verify work like with the differential provider.
+The last finished snapshot is saved to the backup metadata, a snapshot left unfinished by a failed run
+is never used as the base of the next one.
+Snapshots always use the flat layout, sharding the names would break the browsable tree.
+"""
+
+SNAPSHOT_NAME_FORMAT = '%Y-%m-%d_%H-%M-%S_%f'
+LAST_SNAPSHOT_KEY = 'last_snapshot'
+
+class SnapshotLocalProvider(DifferentialLocalProvider):
+
+    def __init__(self, parameters, backup_model):
+        super().__init__(parameters, backup_model)
+        self.layout = 'flat'
+        self.snapshot_name = None
+        self.tag = 'SnapshotBackupProvider'
+
+    def backup_files(self, files):
+        """
+        Receives an iterable of changed files to be backed up.
+        Yields each file once it has been copied into the new snapshot.
+        Once all changed files are copied, the rest of the previous snapshot is linked into the new one.
+        """
+        copy_path = self._get_parameter('output_path')
+        previous_snapshot = self._get_previous_snapshot(copy_path)
+        self.snapshot_name = timezone.now().strftime(SNAPSHOT_NAME_FORMAT)
+        os.makedirs(join_file_path(copy_path, self.snapshot_name))
+        self._log('INFO', 'Saving snapshot {}.'.format(self.snapshot_name))
+        yield from super().backup_files(files)
+        if previous_snapshot:
+            self._link_unchanged_files(join_file_path(copy_path, previous_snapshot), join_file_path(copy_path, self.snapshot_name))
+        self.backup_model.metadata.update_or_create(key=LAST_SNAPSHOT_KEY, defaults={'value': self.snapshot_name})
+
+    def migrate_layout(self):
+        """
+        Snapshots only have the flat layout, there is nothing to migrate.
+        """
+        return None
+
+    def _get_storage_mode(self):
+        """
+        Snapshots always hold plain copies of the files, the other storage modes don't apply.
+        """
+        return 'snapshot'
+
+    def _submit_file(self, executor, file_in, copy_path, *args):
+        """
+        Creates new directories in the snapshot, so empty ones show up as well.
+        """
+        if file_in.file_type == 'directory':
+            os.makedirs(join_file_path(copy_path, self.snapshot_name, file_in.path), exist_ok=True)
+        return super()._submit_file(executor, file_in, copy_path, *args)
+
+    def _store_file(self, file_in, copy_path, storage_mode, checksum_algorithm, compression, compression_level, cache, delta_base=None):
+        """
+        Copies a single file to its path in the snapshot, uncompressed so the snapshot can be browsed.
+        Runs in the worker threads.
+        """
+        self.rate_limiter.consume_operations()
+        file_in.compression = NO_COMPRESSION
+        file_in.savename = join_file_path(self.snapshot_name, file_in.path)
+        file_out = join_file_path(copy_path, file_in.savename)
+        self._create_folder(file_out)
+        self._copy_file(file_in, self.backup_model.create_backup_file_instance(file_out), checksum_algorithm, None, cache)
+
+    def _link_unchanged_files(self, previous_path, snapshot_path):
+        """
+        Hardlinks every file of the previous snapshot that still exists, is still selected
+        and wasn't copied in this run into the new snapshot.
+        """
+        selections = [selection.path.rstrip('/') for selection in self.backup_model.files.all()]
+        self._log('INFO', 'Linking unchanged files from the previous snapshot.')
+        self.backup_model.set_status('Linking unchanged files.', None, True)
+        linked_count = 0
+        for root, folders, filenames in os.walk(previous_path):
+            self.rate_limiter.refresh()
+            relative_root = os.path.relpath(root, previous_path)
+            original_root = '/' if relative_root == '.' else '/' + relative_root
+            folders[:] = [folder for folder in folders if self._is_selected(join_file_path(original_root, folder), selections, True) and os.path.isdir(join_file_path(original_root, folder))]
+            new_root = join_file_path(snapshot_path, original_root)
+            os.makedirs(new_root, exist_ok=True)
+            for filename in filenames:
+                new_path = join_file_path(new_root, filename)
+                original_path = join_file_path(original_root, filename)
+                if os.path.lexists(new_path) or not self._is_selected(original_path, selections) or not os.path.lexists(original_path):
+                    continue
+                self._link_file(join_file_path(root, filename), new_path)
+                linked_count += 1
+        self._log('INFO', '{} unchanged files linked from the previous snapshot.'.format(linked_count))
+
+    def _is_selected(self, path, selections, include_parents=False):
+        """
+        Returns whether the given path is one of the selected paths or inside one.
+        If include_parents is set, the folders leading to a selected path are accepted too.
+        """
+        for selection in selections:
+            if path == selection or path.startswith(selection + '/'):
+                return True
+            if include_parents and selection.startswith(path.rstrip('/') + '/'):
+                return True
+        return False
+
+    def _link_file(self, source_path, destination_path):
+        """
+        Hardlinks the given file, or copies it if it already has as many links as the file system allows.
+        """
+        self.rate_limiter.consume_operations()
+        try:
+            os.link(source_path, destination_path)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            self.copy_engine.copy(source_path, destination_path)
+
+    def _get_previous_snapshot(self, copy_path):
+        """
+        Returns the name of the last finished snapshot, or None if there isn't one.
+        """
+        metadata = self.backup_model.metadata.filter(key=LAST_SNAPSHOT_KEY).first()
+        if metadata is None or not os.path.isdir(join_file_path(copy_path, metadata.value)):
+            return None
+        return metadata.value
@@ -1,9 +1,18 @@
+import os
 import json
 from tempfile import TemporaryDirectory
 from django.test import TestCase
 from backups.models import Backup
+from backups.copying import COPY_STRATEGIES
+import backups.providers.exceptions as exceptions
 from backups.providers.tests.agnostic_tests import AgnosticTests
 
+def list_stored_files(folder):
+    """
+    Returns the paths of all files under the given folder, relative to it.
+    """
+    return sorted(os.path.relpath(os.path.join(root, name), folder) for root, _, names in os.walk(folder) for name in names)
+
 class LocalProviderTests(TestCase):
     def setUp(self):
         self.generic_tests = AgnosticTests()
@@ -58,4 +67,302 @@ class LocalProviderTests(TestCase):
         self.generic_tests._test_backup_model_file_verification(backup_model)
         backup_folder.cleanup()
 
+    def test_copy_strategies_are_recorded(self):
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        for i in range(0, 5):
+            open(os.path.join(test_directory.name, 'file_{}'.format(i)), 'wb').write(os.urandom(1000))
+        backup_model.add_backup_file(test_directory.name)
+        backup_info = backup_model.run_backup()
+        copy_strategies = backup_info['provider']['copy_strategies']
+        self.assertEqual(sum(copy_strategies.values()), 5)
+        self.assertTrue(set(copy_strategies).issubset(COPY_STRATEGIES)) # Plain copies go through the copy engine
+        backup_model.verify_files()
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_verify_files_other_checksum_algorithm(self):
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        backup_model.add_parameter('checksum_algorithm', 'blake2b')
+        self.generic_tests._test_backup_model_file_verification(backup_model)
+        algorithms = set(backup_model.backup_items.values_list('checksum_algorithm', flat=True))
+        self.assertSetEqual(algorithms, set(['blake2b']))
+        backup_folder.cleanup()
+
+    def test_verify_detects_corrupted_copies(self):
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        backup_model.add_parameter('providerSettings', json.dumps({'output_path': backup_folder.name}))
+        open(os.path.join(test_directory.name, 'file'), 'wb').write(os.urandom(1000))
+        backup_model.add_backup_file(test_directory.name)
+        backup_model.run_backup()
+        backup_model.verify_files()
+        stored_path = os.path.join(backup_folder.name, list_stored_files(backup_folder.name)[0])
+        with open(stored_path, 'r+b') as f:
+            f.write(b'corrupted')
+        with self.assertRaises(exceptions.DataVerificationFailedException):
+            backup_model.verify_files()
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_content_storage_mode(self):
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'storage_mode': 'content'})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        self.generic_tests._test_backup_model_single_differential_file(backup_model)
+        self.generic_tests._test_backup_model_file_verification(backup_model)
+        backup_folder.cleanup()
+
+    def test_content_storage_mode_deduplicates(self):
+        """
+        Files with the same content should share a single blob.
+        """
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'storage_mode': 'content'})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        for i in range(0, 3):
+            open(os.path.join(test_directory.name, 'file_{}'.format(i)), 'wb').write(b'same content')
+        backup_model.add_backup_file(test_directory.name)
+        backup_model.run_backup()
+        savenames = set(backup_model.backup_items.filter(file_type='file').values_list('savename', flat=True))
+        self.assertEqual(len(savenames), 1)
+        self.assertListEqual(list_stored_files(backup_folder.name), list(savenames))
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_chunked_storage_mode(self):
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'storage_mode': 'chunked', 'chunk_size': 4096})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        self.generic_tests._test_backup_model_single_file(backup_model)
+        self.generic_tests._test_backup_model_file_verification(backup_model)
+        backup_folder.cleanup()
+
+    def test_chunked_storage_mode_stores_changed_chunks(self):
+        """
+        Changing a few bytes in the middle of a large file should only store the chunks around the change,
+        and both versions should still restore to their original content.
+        """
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'storage_mode': 'chunked', 'chunk_size': 4096})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        path = os.path.join(test_directory.name, 'large_file')
+        original_content = os.urandom(256 * 1024)
+        changed_content = original_content[:100000] + b'changed' + original_content[100000:]
+        open(path, 'wb').write(original_content)
+        backup_model.add_backup_file(path)
+        first_backup_info = backup_model.run_backup()
+        chunk_count = len(list_stored_files(os.path.join(backup_folder.name, 'chunks')))
+        open(path, 'wb').write(changed_content)
+        os.utime(path, (os.stat(path).st_atime, os.stat(path).st_mtime + 10)) # Modification times are compared with a second precision
+        second_backup_info = backup_model.run_backup()
+        new_chunk_count = len(list_stored_files(os.path.join(backup_folder.name, 'chunks'))) - chunk_count
+        self.assertGreater(new_chunk_count, 0)
+        self.assertLess(new_chunk_count, 4)
+        for backup_info, content in [(first_backup_info, original_content), (second_backup_info, changed_content)]:
+            restore_directory = TemporaryDirectory()
+            backup_model.restore_files([path], restore_directory.name, timestamp=backup_info['timestamp'])
+            self.assertEqual(open(restore_directory.name + path, 'rb').read(), content)
+            restore_directory.cleanup()
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_compressed_storage(self):
+        """
+        Compressible files should be stored compressed and restored to their original content,
+        while random data and already compressed file types are stored as is.
+        """
+        for storage_mode in ['file', 'content', 'chunked']:
+            backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+            backup_model.save()
+            backup_folder = TemporaryDirectory()
+            test_directory = TemporaryDirectory()
+            provider_settings = json.dumps({'output_path': backup_folder.name, 'storage_mode': storage_mode, 'chunk_size': 4096})
+            backup_model.add_parameter('providerSettings', provider_settings)
+            backup_model.add_parameter('compression', 'lzma')
+            contents = {
+                os.path.join(test_directory.name, 'log.txt'): b'INFO Backup done.\n' * 10000,
+                os.path.join(test_directory.name, 'random'): os.urandom(100000),
+                os.path.join(test_directory.name, 'archive.gz'): b'not really gzip' * 1000,
+            }
+            for path, content in contents.items():
+                open(path, 'wb').write(content)
+            backup_model.add_backup_file(test_directory.name)
+            backup_info = backup_model.run_backup()
+            compressions = dict(backup_model.backup_items.filter(file_type='file').values_list('path', 'compression'))
+            self.assertDictEqual(compressions, {
+                os.path.join(test_directory.name, 'log.txt'): 'lzma',
+                os.path.join(test_directory.name, 'random'): 'none',
+                os.path.join(test_directory.name, 'archive.gz'): 'none',
+            })
+            restore_directory = TemporaryDirectory()
+            backup_model.restore_files(list(contents.keys()), restore_directory.name, timestamp=backup_info['timestamp'])
+            for path, content in contents.items():
+                self.assertEqual(open(restore_directory.name + path, 'rb').read(), content)
+            backup_model.verify_files()
+            restore_directory.cleanup()
+            test_directory.cleanup()
+            backup_folder.cleanup()
+
+    def test_packed_small_files(self):
+        """
+        Small files should be appended to a shared pack segment and restored by their offsets.
+        """
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'pack_threshold': 4096})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        backup_model.add_parameter('compression', 'zlib')
+        contents = {}
+        for i in range(0, 20):
+            contents[os.path.join(test_directory.name, 'small_{}'.format(i))] = os.urandom(i * 100)
+        contents[os.path.join(test_directory.name, 'small.txt')] = b'small text file' * 10
+        contents[os.path.join(test_directory.name, 'large')] = os.urandom(10000)
+        for path, content in contents.items():
+            open(path, 'wb').write(content)
+        backup_model.add_backup_file(test_directory.name)
+        backup_info = backup_model.run_backup()
+        storage_formats = dict(backup_model.backup_items.filter(file_type='file').values_list('path', 'storage_format'))
+        self.assertEqual(list(storage_formats.values()).count('packed'), 21)
+        self.assertEqual(storage_formats[os.path.join(test_directory.name, 'large')], 'file')
+        self.assertEqual(len(os.listdir(os.path.join(backup_folder.name, 'packs'))), 1)
+        restore_directory = TemporaryDirectory()
+        backup_model.restore_files(list(contents.keys()), restore_directory.name, timestamp=backup_info['timestamp'])
+        for path, content in contents.items():
+            self.assertEqual(open(restore_directory.name + path, 'rb').read(), content)
+        backup_model.verify_files()
+        restore_directory.cleanup()
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_delta_storage_mode(self):
+        """
+        Modified versions should be stored as deltas until the chain gets too long,
+        fully rewritten files as full copies, and every version should restore to its original content.
+        """
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'storage_mode': 'delta', 'delta_max_chain': 2})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        backup_model.add_parameter('compression', 'zlib')
+        path = os.path.join(test_directory.name, 'mailbox')
+        content = os.urandom(200 * 1024)
+        versions = [content, content[:50000] + b'new mail' + content[50000:], content[::-1], content[::-1] + b'x', content[::-1] + b'xy', content[::-1] + b'xyz']
+        backup_infos = []
+        for i, version in enumerate(versions):
+            open(path, 'wb').write(version)
+            os.utime(path, (i * 10, i * 10)) # Modification times are compared with a second precision
+            backup_model.add_backup_file(path)
+            backup_infos.append(backup_model.run_backup())
+        storage_formats = list(backup_model.backup_items.filter(path=path).order_by('creation_time').values_list('storage_format', 'delta_chain'))
+        self.assertListEqual(storage_formats, [('file', 0), ('delta', 1), ('file', 0), ('delta', 1), ('delta', 2), ('file', 0)])
+        for backup_info, version in zip(backup_infos, versions):
+            restore_directory = TemporaryDirectory()
+            backup_model.restore_files([path], restore_directory.name, timestamp=backup_info['timestamp'])
+            self.assertEqual(open(restore_directory.name + path, 'rb').read(), version)
+            restore_directory.cleanup()
+        backup_model.verify_files()
+        self.assertListEqual([name for name in os.listdir(backup_folder.name) if name.startswith('.tmp')], [])
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_parallel_copies(self):
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'parallelism': 4})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        self.generic_tests._test_backup_model_single_folder(backup_model)
+        self.generic_tests._test_backup_model_file_verification(backup_model)
+        backup_folder.cleanup()
+
+    def test_parallel_copies_capture_errors(self):
+        """
+        A file that can't be copied should be left out without stopping the other files,
+        and the rest should be yielded in the order they were received.
+        """
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        provider_settings = json.dumps({'output_path': backup_folder.name, 'parallelism': 3})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        paths = []
+        for i in range(0, 20):
+            path = os.path.join(test_directory.name, 'file_{}'.format(i))
+            open(path, 'wb').write(os.urandom(i * 1000))
+            paths.append(path)
+        backup_items = [backup_model.create_backup_file_instance(path) for path in paths]
+        missing_path = os.path.join(test_directory.name, 'missing')
+        missing_item = backup_model.create_backup_file_instance(paths[0])
+        missing_item.path = missing_path
+        backup_items.insert(10, missing_item)
+        provider = backup_model.get_backup_provider()
+        stored_items = list(provider.backup_files(iter(backup_items)))
+        self.assertListEqual([item.path for item in stored_items], paths)
+        self.assertListEqual(provider.get_failed_files(), [missing_path])
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_migrate_flat_layout(self):
+        """
+        Files backed up with the flat layout should be moved to the sharded layout and back,
+        and stay restorable and verifiable before, during and after the move.
+        """
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        backup_model.add_parameter('providerSettings', json.dumps({'output_path': backup_folder.name, 'layout': 'flat'}))
+        contents = {}
+        for i in range(0, 10):
+            contents[os.path.join(test_directory.name, 'file_{}'.format(i))] = os.urandom(1000)
+        for path, content in contents.items():
+            open(path, 'wb').write(content)
+        backup_model.add_backup_file(test_directory.name)
+        backup_info = backup_model.run_backup()
+        self.assertTrue(all('/' not in name for name in list_stored_files(backup_folder.name)))
+        backup_model.add_parameter('providerSettings', json.dumps({'output_path': backup_folder.name}))
+        backup_model.verify_files()
+        self.assertEqual(backup_model.get_backup_provider().migrate_layout(), 10)
+        self.assertEqual(backup_model.get_backup_provider().migrate_layout(), 0)
+        stored_files = list_stored_files(backup_folder.name)
+        self.assertSetEqual(set(stored_files), set(backup_model.backup_items.filter(file_type='file').values_list('savename', flat=True)))
+        self.assertTrue(all(name.count('/') == 2 for name in stored_files))
+        backup_model.verify_files()
+        restore_directory = TemporaryDirectory()
+        backup_model.restore_files(list(contents.keys()), restore_directory.name, timestamp=backup_info['timestamp'])
+        for path, content in contents.items():
+            self.assertEqual(open(restore_directory.name + path, 'rb').read(), content)
+        restore_directory.cleanup()
+        backup_model.add_parameter('providerSettings', json.dumps({'output_path': backup_folder.name, 'layout': 'flat'}))
+        self.assertEqual(backup_model.get_backup_provider().migrate_layout(), 10) # Back to the flat layout
+        self.assertTrue(all('/' not in name for name in list_stored_files(backup_folder.name)))
+        backup_model.verify_files()
+        test_directory.cleanup()
+        backup_folder.cleanup()
 
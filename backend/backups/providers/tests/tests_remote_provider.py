@@ -1,4 +1,6 @@
+import os
 import json
+import time
 from tempfile import TemporaryDirectory
 from django.test import TestCase
 from backups.models import Backup
@@ -57,4 +59,34 @@ class RemoteProviderTests(TestCase):
         self.generic_tests._test_backup_model_file_verification(backup_model)
         backup_folder.cleanup()
 
+    def test_sharded_transfers(self):
+        backup_model = Backup(name='_test_backup', provider='remote+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        provider_settings = json.dumps({'remote_path': backup_folder.name, 'remote_addr': 'localhost', 'ssh_id_path': '~/.ssh/id_rsa', 'rsync_shards': 3})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        self.generic_tests._test_backup_model_single_folder(backup_model)
+        backup_folder.cleanup()
 
+    def test_versioned_layout(self):
+        backup_model = Backup(name='_test_backup', provider='remote+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_folder = TemporaryDirectory()
+        provider_settings = json.dumps({'remote_path': backup_folder.name, 'remote_addr': 'localhost', 'ssh_id_path': '~/.ssh/id_rsa', 'layout': 'versioned'})
+        backup_model.add_parameter('providerSettings', provider_settings)
+        self.generic_tests._test_backup_model_single_differential_file(backup_model)
+        self.assertEqual(len(os.listdir(backup_folder.name)), 2) # One snapshot per run
+        test_directory = TemporaryDirectory()
+        open(os.path.join(test_directory.name, 'unchanged'), 'wb').write(os.urandom(1000))
+        backup_model.add_backup_file(test_directory.name)
+        backup_model.run_backup()
+        first_snapshot = backup_model.metadata.get(key='last_snapshot').value
+        open(os.path.join(test_directory.name, 'changed'), 'wb').write(os.urandom(1000))
+        os.utime(os.path.join(test_directory.name, 'changed'), (time.time() + 10, time.time() + 10))
+        backup_model.run_backup()
+        second_snapshot = backup_model.metadata.get(key='last_snapshot').value
+        first_path = os.path.join(backup_folder.name, first_snapshot + test_directory.name, 'unchanged')
+        second_path = os.path.join(backup_folder.name, second_snapshot + test_directory.name, 'unchanged')
+        self.assertEqual(os.stat(first_path).st_ino, os.stat(second_path).st_ino) # Hardlinked, not transferred again
+        test_directory.cleanup()
+        backup_folder.cleanup()
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+from tempfile import TemporaryDirectory
+from django.test import TestCase
+from backups.models import Backup
+from backups.providers.tests.agnostic_tests import AgnosticTests
+
+class SnapshotProviderTests(TestCase):
+    def setUp(self):
+        self.generic_tests = AgnosticTests()
+
+    def _create_backup_model(self, backup_folder):
+        backup_model = Backup(name='_test_backup', provider='local+snapshot', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_model.add_parameter('providerSettings', json.dumps({'output_path': backup_folder.name}))
+        return backup_model
+
+    def test_single_file(self):
+        backup_folder = TemporaryDirectory()
+        self.generic_tests._test_backup_model_single_file(self._create_backup_model(backup_folder))
+        backup_folder.cleanup()
+
+    def test_single_folder(self):
+        backup_folder = TemporaryDirectory()
+        self.generic_tests._test_backup_model_single_folder(self._create_backup_model(backup_folder))
+        backup_folder.cleanup()
+
+    def test_single_differential_file(self):
+        backup_folder = TemporaryDirectory()
+        self.generic_tests._test_backup_model_single_differential_file(self._create_backup_model(backup_folder))
+        backup_folder.cleanup()
+
+    def test_verify_files(self):
+        backup_folder = TemporaryDirectory()
+        self.generic_tests._test_backup_model_file_verification(self._create_backup_model(backup_folder))
+        backup_folder.cleanup()
+
+    def test_unchanged_files_are_linked(self):
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        backup_model = self._create_backup_model(backup_folder)
+        for name in ['unchanged', 'changed', 'deleted']:
+            open(os.path.join(test_directory.name, name), 'wb').write(os.urandom(1000))
+        backup_model.add_backup_file(test_directory.name)
+        backup_model.run_backup()
+        first_snapshot = backup_model.metadata.get(key='last_snapshot').value
+        open(os.path.join(test_directory.name, 'changed'), 'wb').write(os.urandom(1000))
+        os.utime(os.path.join(test_directory.name, 'changed'), (time.time() + 10, time.time() + 10))
+        os.remove(os.path.join(test_directory.name, 'deleted'))
+        backup_model.run_backup()
+        second_snapshot = backup_model.metadata.get(key='last_snapshot').value
+        self.assertNotEqual(first_snapshot, second_snapshot)
+        first_folder = os.path.join(backup_folder.name, first_snapshot + test_directory.name)
+        second_folder = os.path.join(backup_folder.name, second_snapshot + test_directory.name)
+        self.assertEqual(sorted(os.listdir(second_folder)), ['changed', 'unchanged'])
+        self.assertEqual(os.stat(os.path.join(first_folder, 'unchanged')).st_ino, os.stat(os.path.join(second_folder, 'unchanged')).st_ino)
+        self.assertNotEqual(os.stat(os.path.join(first_folder, 'changed')).st_ino, os.stat(os.path.join(second_folder, 'changed')).st_ino)
+        self.assertEqual(open(os.path.join(second_folder, 'changed'), 'rb').read(), open(os.path.join(test_directory.name, 'changed'), 'rb').read())
+        backup_model.verify_files()
+        test_directory.cleanup()
+        backup_folder.cleanup()
+
+    def test_layout_is_never_migrated(self):
+        """
+        Snapshots should stay browsable, even if the sharded layout is asked for or the layout is migrated.
+        """
+        backup_folder = TemporaryDirectory()
+        test_directory = TemporaryDirectory()
+        backup_model = self._create_backup_model(backup_folder)
+        backup_model.add_parameter('providerSettings', json.dumps({'output_path': backup_folder.name, 'layout': 'sharded'}))
+        open(os.path.join(test_directory.name, 'report-final.txt'), 'wb').write(os.urandom(1000))
+        backup_model.add_backup_file(test_directory.name)
+        backup_model.run_backup()
+        snapshot = backup_model.metadata.get(key='last_snapshot').value
+        self.assertIsNone(backup_model.get_backup_provider().migrate_layout())
+        self.assertTrue(os.path.isfile(os.path.join(backup_folder.name, snapshot + test_directory.name, 'report-final.txt')))
+        backup_model.verify_files()
+        test_directory.cleanup()
+        backup_folder.cleanup()
@@ -0,0 +1,132 @@
+import shlex
+import threading
+import subprocess
+
+"""
+Calculating checksums of files on a remote server.
+The paths are streamed to a small Python helper on the remote server over the stdin of a single ssh call,
+separated by NUL bytes so any file name works. The helper hashes the files with a pool of threads
+and streams '<checksum>\\t<path>\\0' records back, which are parsed as they arrive.
+No files are written on either end.
+
+The helper uses hashlib like the local checksum engine (becky.utils.get_hasher), so every algorithm
+the engine supports can be verified remotely. xxhash needs the xxhash package on the remote server as well.
+Files that can't be read are left out of the results. Only a few files per thread are hashed or waiting
+to be written out at a time, so the memory use of the helper doesn't grow with the number of paths.
+If the helper can't run at all, f.ex. python3 is missing on the remote server or it can't
+use the algorithm, RemoteChecksumException is raised with the error output of the helper.
+"""
+
+READ_SIZE = 64 * 1024
+
+REMOTE_CHECKSUM_HELPER = '''
+import os, sys, hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+algorithm, workers = sys.argv[1], int(sys.argv[2]) or os.cpu_count() or 1
+def new_hasher():
+    if algorithm == 'xxhash':
+        import xxhash
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+try:
+    new_hasher()
+except (ImportError, ValueError) as e:
+    sys.exit('Checksum algorithm {} is not available: {}'.format(algorithm, e))
+def read_paths():
+    buffer = b''
+    while True:
+        data = sys.stdin.buffer.read1(65536)
+        if not data:
+            break
+        *paths, buffer = (buffer + data).split(b'\\0')
+        yield from (path for path in paths if path)
+    if buffer:
+        yield buffer
+def checksum(path):
+    try:
+        hasher = new_hasher()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                hasher.update(chunk)
+    except OSError:
+        return b''
+    return hasher.hexdigest().encode() + b'\\t' + path + b'\\0'
+with ThreadPoolExecutor(workers) as executor:
+    in_flight = deque()
+    for path in read_paths():
+        in_flight.append(executor.submit(checksum, path))
+        if len(in_flight) >= workers * 4:
+            sys.stdout.buffer.write(in_flight.popleft().result())
+    while in_flight:
+        sys.stdout.buffer.write(in_flight.popleft().result())
+'''
+
+
+def get_remote_checksum_command(algorithm, workers=0):
+    """
+    Returns the shell command that runs the checksum helper on the remote server.
+    With 0 workers, the helper uses one thread per CPU of the remote server.
+    """
+    return 'python3 -c {} {} {}'.format(shlex.quote(REMOTE_CHECKSUM_HELPER), shlex.quote(algorithm), int(workers))
+
+def iter_remote_checksums(connection, paths, algorithm, workers=0):
+    """
+    Yields (path, checksum) pairs for the given remote paths as the remote server calculates them.
+    The connection is an SSHConnection (see backups.ssh).
+    Raises RemoteChecksumException once the output is read if the helper failed.
+    """
+    process = connection.popen(get_remote_checksum_command(algorithm, workers), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    writer = threading.Thread(target=_write_paths, args=(process.stdin, paths), daemon=True)
+    writer.start()
+    errors = []
+    error_reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    error_reader.start()
+    finished = False
+    try:
+        buffer = b''
+        while True:
+            data = process.stdout.read1(READ_SIZE)
+            if not data:
+                break
+            *records, buffer = (buffer + data).split(b'\0')
+            for record in records:
+                checksum, _, path = record.partition(b'\t')
+                yield path.decode('utf-8', 'surrogateescape'), checksum.decode('ascii')
+        finished = True
+    finally:
+        process.stdout.close()
+        process.wait()
+        writer.join()
+        error_reader.join()
+        process.stderr.close()
+    if finished and process.returncode != 0:
+        raise RemoteChecksumException(process.returncode, b''.join(errors).decode('utf-8', 'replace').strip())
+
+def _write_paths(stdin, paths):
+    """
+    Writes the given paths to the stdin of the helper. Runs in its own thread,
+    so the helper never blocks on a full stdout while we're still writing.
+    """
+    try:
+        for path in paths:
+            stdin.write(path.encode('utf-8', 'surrogateescape') + b'\0')
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+class RemoteChecksumException(Exception):
+
+    def __init__(self, returncode, errors, message="Calculating checksums on the remote server failed."):
+        self.returncode = returncode
+        self.errors = errors
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return "{} -- The checksum helper exited with code {}: {}".format(self.message, self.returncode, self.errors or 'no error output')
@@ -1,11 +1,70 @@
+import os
 from abc import ABC, abstractmethod
 
+from backups.scanners.walker import ParallelWalker
+from backups.scanners.scanned_file import ScannedFile
+from becky.utils import path_to_folders
+
+SCAN_BATCH_SIZE = 500 # How many scanned files are compared against the database at once
+
 class BaseScanner(ABC):
 
     @abstractmethod
-    def scan_files(self):
+    def scan_files(self, backup_files, current_timestamp=None):
         """
         Scans for files, save results to DB for later.
+        Yields the files that should be backed up as they are found,
+        so the provider can start backing them up while the scan is still running.
         """
         raise NotImplementedError
 
+    def _create_backup_items(self, scanned_files, current_timestamp):
+        """
+        Turns the given ScannedFiles into BackupItems.
+        This should only be called for files that will actually be backed up.
+        """
+        return [self.backup_model.create_backup_file_instance(f.path, current_timestamp, f) for f in scanned_files]
+
+    def _get_walker(self, progress_callback=None):
+        """
+        Returns a directory walker that uses as many threads
+        as set in the 'scan_workers' parameter.
+        """
+        workers = self.backup_model.get_parameter_value('scan_workers', 8)
+        return ParallelWalker(workers=int(workers), progress_callback=progress_callback)
+
+    def _get_selections(self, backup_files):
+        """
+        Returns the paths of the given backup files, leaving out any
+        path that is inside another selected folder. Those would be found by
+        walking the parent folder anyway, so scanning them again would only yield duplicates.
+        """
+        paths = sorted(set([backup_file.path.rstrip('/') or '/' for backup_file in backup_files]))
+        selections = []
+        for path in paths:
+            if any(path.startswith(selection.rstrip('/') + '/') for selection in selections):
+                continue
+            selections.append(path)
+        return selections
+
+    def _iter_local_files(self, backup_files, progress_callback=None):
+        """
+        Yields a ScannedFile of every file and folder in the given selections,
+        as well as the folders leading up to each selection.
+        Each path is yielded only once.
+        """
+        implicit_folders = set()
+        selections = self._get_selections(backup_files)
+        for selection_i, selection in enumerate(selections):
+            if not os.path.exists(selection):
+                continue
+            self.backup_model.set_status(status_message='Scanning for files from {}...'.format(selection), percentage=int((selection_i / len(selections))*100), running=True)
+            self._log('DEBUG', 'Scanning for files from selected path {}'.format(selection))
+            for folder in path_to_folders(selection)[1:]:
+                if folder not in implicit_folders:
+                    implicit_folders.add(folder)
+                    yield ScannedFile(folder, os.stat(folder))
+            if os.path.isdir(selection):
+                yield from self._get_walker(progress_callback).walk(selection)
+            else:
+                yield ScannedFile(selection, os.stat(selection))
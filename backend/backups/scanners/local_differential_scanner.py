@@ -7,10 +7,9 @@ import datetime
 from django.db import models, transaction
 from django.utils.timezone import make_aware
 
-from backups.scanners.base_scanner import BaseScanner
+from backups.scanners.base_scanner import BaseScanner, SCAN_BATCH_SIZE
 from backups.models import DifferentialInformation
-from logs.models import BackupLogger
-from becky.utils import remove_prefix, path_to_folders
+from becky.utils import remove_prefix, path_to_folders, batched
 
 """
 Scanner to scan files from the own local system.
@@ -19,11 +18,13 @@ has changed since previous scan will be flagged for
 copying.
 """
 
+DIFF_BATCH_SIZE = SCAN_BATCH_SIZE # Rows per query when reading and writing DifferentialInformation
+
 class LocalDifferentialScanner(BaseScanner):
     
         def __init__(self, parameters, backup_model):
             self.parameters = parameters
-            self.logger = BackupLogger(backup_model)
+            self.logger = backup_model.get_logger()
             self.backup_model = backup_model
             self.tag = 'LocalDifferentialScanner'
 
@@ -34,86 +35,87 @@ class LocalDifferentialScanner(BaseScanner):
             it should start scanning for files to be backed up.
             Checks the previous modified date of a file to see if 
             it needs to be backed up again.
+            Scanned files are compared in batches while the walk is still running
+            and the new or changed files are yielded as soon as they are found.
             """
             self._log('INFO', 'Started file scanning.')
-            scanned_files = []
-            for backup_file_i, backup_file in enumerate(backup_files):
-                self.backup_model.set_status(status_message='Scanning for files from {} \t {} files found so far...'.format(backup_file.path, len(scanned_files)), percentage=int((backup_file_i / len(backup_files))*100), running=True)
-                self._log('DEBUG', 'Scanning for files from selected path {}'.format(backup_file.path))
-                scanned_files += self._scan_local_files(backup_file)
-            scanned_files = list(set(scanned_files))
-            diff_info = self._get_differential_information(scanned_files)
-            self.backup_model.set_status(status_message='Files found in total {}...'.format(len(scanned_files)), percentage=100, running=True)
-            scanned_files = self.backup_model.create_backup_file_instances(scanned_files, current_timestamp)
-            current_files = self.backup_model.get_all_backup_items()
+            known_diffs = self._load_differential_information()
+            scanned_count = 0
+            new_count = 0
+            for batch in batched(self._iter_local_files(backup_files, self._report_walk_progress), SCAN_BATCH_SIZE):
+                scanned_count += len(batch)
+                modified_paths = self._get_differential_information(batch, known_diffs)
+                new_files = self._compare_scanned_files(batch, modified_paths)
+                for new_file in self._create_backup_items(new_files, current_timestamp):
+                    new_count += 1
+                    yield new_file
+                self.backup_model.set_status(status_message='Comparing found files with backed up files. \t {} files scanned, {} new files have been found so far.'.format(scanned_count, new_count), percentage=None, running=True)
             self._log('INFO', 'Finished file scanning.')
-            self._log('INFO', 'Starting file comparisions.')
-            return self._compare_scanned_files(scanned_files, diff_info)
+            self._log('INFO', 'Found {} new files out of {} scanned files.'.format(new_count, scanned_count))
 
 
-        def _get_differential_information(self, files):
-            diffs = []
+        def _get_differential_information(self, files, known_diffs):
+            """
+            Updates the modified timestamps of the given files and returns the set of paths
+            that are new or have been modified since the previous scan.
+            Files is a list of ScannedFiles, so the modified timestamps
+            are read from the stat results found while scanning.
+            Known_diffs is the in-memory map of rows loaded with '_load_differential_information',
+            only new or changed rows are written back to the database in batches.
+            """
+            new_diffs = []
+            changed_diffs = []
+            modified_paths = set()
+            for f in files:
+                current_modified = make_aware(datetime.datetime.fromtimestamp(f.st_mtime_ns // 1000000000))
+                known_diff = known_diffs.get(f.path)
+                if known_diff is None: # First time seeing this file
+                    new_diffs.append(DifferentialInformation(backup=self.backup_model, path=f.path, previous_modified=None, current_modified=current_modified))
+                    modified_paths.add(f.path)
+                    continue
+                diff_id, previous_modified, stored_modified = known_diff
+                if stored_modified != current_modified:
+                    modified_paths.add(f.path)
+                if previous_modified != stored_modified or stored_modified != current_modified:
+                    changed_diffs.append(DifferentialInformation(id=diff_id, previous_modified=stored_modified, current_modified=current_modified))
             with transaction.atomic():
-                for f in files:
-                    found_diff, created = DifferentialInformation.objects.get_or_create(backup=self.backup_model, path=f)
-                    current_modified = int(os.path.getmtime(f))
-                    current_modified = make_aware(datetime.datetime.fromtimestamp(current_modified))
-                    found_diff.previous_modified = found_diff.current_modified
-                    found_diff.current_modified = current_modified
-                    found_diff.save()
-                    diffs.append(found_diff)
-            return diffs
+                DifferentialInformation.objects.bulk_create(new_diffs, batch_size=DIFF_BATCH_SIZE)
+                DifferentialInformation.objects.bulk_update(changed_diffs, ['previous_modified', 'current_modified'], batch_size=DIFF_BATCH_SIZE)
+            self._log('DEBUG', 'Saved {} new and {} changed modified timestamps.', len(new_diffs), len(changed_diffs))
+            return modified_paths
 
-        def _scan_local_files(self, backup_file):
+        def _load_differential_information(self):
             """
-            Uses glob to recursively find all files from the starting_path.
-            TODO: What if the the glob output becomes massive?
+            Streams all DifferentialInformation rows of the current backup
+            into a dictionary of path -> (id, previous_modified, current_modified).
             """
-            if not os.path.exists(backup_file.path):
-                return []
-            if os.path.isfile(backup_file.path): # Starting_path is not a folder, but a file
-                scanned_files = path_to_folders(backup_file.path) + [backup_file.path]
-            else:
-                scanned_files = path_to_folders(backup_file.path) + self._walk_folders(backup_file.path)
-                scanned_files = scanned_files
-            return scanned_files
+            rows = DifferentialInformation.objects.filter(backup=self.backup_model).values_list('id', 'path', 'previous_modified', 'current_modified')
+            known_diffs = {}
+            for diff_id, path, previous_modified, current_modified in rows.iterator(chunk_size=DIFF_BATCH_SIZE):
+                known_diffs[path] = (diff_id, previous_modified, current_modified)
+            return known_diffs
 
-        def _compare_scanned_files(self, scanned_files, diff_info):
+        def _compare_scanned_files(self, scanned_files, modified_paths):
             """
             Compares the scanned files with the files from the database.
-            Uses diff info to see if the scanned file has been modified since last scan
-            and thus would require re-backing up.
+            Uses the modified paths from the differential information to see if the scanned
+            file has been modified since last scan and thus would require re-backing up.
+            Works on ScannedFiles, so nothing is allocated for unchanged files.
             """
-            new_files = []
-            for i, diff in enumerate(diff_info):
-                if diff.previous_modified == None: # First time seeing this file
-                    new_files.append(scanned_files[i])
-                else:
-                    if diff.previous_modified != diff.current_modified:
-                        new_files.append(scanned_files[i])
-                if i % 100 == 0:
-                    self.backup_model.set_status(status_message='Comparing found files with backed up files. \t {} new files have been found so far.'.format(len(new_files)), percentage=int((i / len(scanned_files))*100), running=True)
-            self._log('INFO', 'Found {} new files.'.format(len(new_files)))
-            return new_files
+            return [scanned_file for scanned_file in scanned_files if scanned_file.path in modified_paths]
 
-        def _log(self, level, message):
+        def _log(self, level, message, *args):
             """
             Helper method to log events.
             Uses the logger provided on initialization to add logs.
+            Any extra arguments are formatted into the message only if the level is logged.
             """
-            self.logger.log(message=message, level=level, tag=self.tag)
+            self.logger.log(message, self.tag, level, *args)
 
 
-        def _walk_folders(self, path):
+        def _report_walk_progress(self, path, found_count):
             """
-            Uses os.walk to get all files in the given path.
+            Called by the walker whenever it has finished listing directories.
             """
-            files = set()
-            for root, directories, dir_files in os.walk(path):
-                files.add(root)
-                for f in dir_files:
-                    files.add(os.path.join(root, f))
-                    self.backup_model.set_status(status_message='Scanning for files from {} \t {} files found so far...'.format(path, len(files)), percentage=None, running=True)
-                    if len(files) % 100 == 0:
-                        self._log('DEBUG', 'Found {} new files from {}.'.format(len(files), path))
-            return list(files)
+            self.backup_model.set_status(status_message='Scanning for files from {} \t {} files found so far...'.format(path, found_count), percentage=None, running=True)
+            self._log('DEBUG', 'Found {} new files from {}.', found_count, path)
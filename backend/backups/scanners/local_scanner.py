@@ -2,9 +2,8 @@ import os
 import glob
 import shelve
 
-from backups.scanners.base_scanner import BaseScanner
-from logs.models import BackupLogger
-from becky.utils import remove_prefix, path_to_folders
+from backups.scanners.base_scanner import BaseScanner, SCAN_BATCH_SIZE
+from becky.utils import remove_prefix, path_to_folders, batched
 
 """
 Scanner to scan files from the own local system.
@@ -16,76 +15,52 @@ class LocalFilesScanner(BaseScanner):
     
         def __init__(self, parameters, backup_model):
             self.parameters = parameters
-            self.logger = BackupLogger(backup_model)
+            self.logger = backup_model.get_logger()
             self.backup_model = backup_model
             self.tag = 'LocalFilesScanner'
 
-        def scan_files(self, backup_files):
+        def scan_files(self, backup_files, current_timestamp=None):
             """
             Starts the file scanning procedure.
             Looks at the path from the parameters to see where 
             it should start scanning for files to be backed up.
+            Scanned files are compared in batches while the walk is still running
+            and the new files are yielded as soon as they are found.
             """
             self._log('INFO', 'Started file scanning.')
-            scanned_files = []
-            for backup_file_i, backup_file in enumerate(backup_files):
-                self.backup_model.set_status(status_message='Scanning for files from {} \t {} files found so far...'.format(backup_file.path, len(scanned_files)), percentage=int((backup_file_i / len(backup_files))*100), running=True)
-                self._log('DEBUG', 'Scanning for files from selected path {}'.format(backup_file.path))
-                scanned_files += self._scan_local_files(backup_file)
-            self.backup_model.set_status(status_message='Files found in total {}...'.format(len(scanned_files)), percentage=100, running=True)
-            scanned_files = list(set(scanned_files))
-            scanned_files = self.backup_model.create_backup_file_instances(scanned_files)
-            current_files = self.backup_model.get_all_backup_items()
+            backed_up_paths = self._load_backed_up_paths()
+            scanned_count = 0
+            new_count = 0
+            for batch in batched(self._iter_local_files(backup_files), SCAN_BATCH_SIZE):
+                scanned_count += len(batch)
+                new_files = self._compare_scanned_files(batch, backed_up_paths)
+                for new_file in self._create_backup_items(new_files, current_timestamp):
+                    new_count += 1
+                    yield new_file
+                self.backup_model.set_status(status_message='Comparing found files with backed up files. \t {} files scanned, {} new files have been found so far.'.format(scanned_count, new_count), percentage=None, running=True)
             self._log('INFO', 'Finished file scanning.')
-            self._log('INFO', 'Starting file comparisions.')
-            return self._compare_scanned_files(scanned_files, current_files)
+            self._log('INFO', 'Found {} new files out of {} scanned files.'.format(new_count, scanned_count))
 
-        def _scan_local_files(self, backup_file):
+        def _load_backed_up_paths(self):
             """
-            Uses glob to recursively find all files from the starting_path.
-            TODO: What if the the glob output becomes massive?
+            Streams the paths of all backed up items into a set.
             """
-            if os.path.isfile(backup_file.path): # Starting_path is not a folder, but a file
-                implicit_folders = path_to_folders(backup_file.path)
-                scanned_files = implicit_folders
-            else:
-                scanned_files = self._walk_folders(backup_file.path)
-                implicit_folders = path_to_folders(backup_file.path)
-                scanned_files  = implicit_folders + scanned_files
-            return scanned_files
+            paths = self.backup_model.backup_items.values_list('path', flat=True)
+            return set(paths.iterator(chunk_size=SCAN_BATCH_SIZE))
 
-        def _compare_scanned_files(self, scanned_files, current_files):
+        def _compare_scanned_files(self, scanned_files, backed_up_paths):
             """
             Compares the scanned files with the files from the database.
             For now, only checks whether there are any files that are NOT
             present in the database. Any changes to previously backed up files
             would therefore not be backed up, ever.
             """
-            backed_up_paths = set([f.path for f in current_files])
-            new_files = []
-            for new_file_i, new_file in enumerate(scanned_files):
-                if new_file.path not in backed_up_paths:
-                    new_files.append(new_file)
-                if new_file_i % 100 == 0:
-                    self.backup_model.set_status(status_message='Comparing found files with backed up files. \t {} new files have been found so far.'.format(len(new_files)), percentage=int((new_file_i / len(scanned_files))*100), running=True)
-            self._log('INFO', 'Found {} new files.'.format(len(new_files)))
-            return new_files
+            return [scanned_file for scanned_file in scanned_files if scanned_file.path not in backed_up_paths]
 
-        def _log(self, level, message):
+        def _log(self, level, message, *args):
             """
             Helper method to log events.
             Uses the logger provided on initialization to add logs.
+            Any extra arguments are formatted into the message only if the level is logged.
             """
-            self.logger.log(message=message, level=level, tag=self.tag)
-
-
-        def _walk_folders(self, path):
-            """
-            Uses os.walk to get all files in the given path.
-            """
-            files = set()
-            for root, directories, dir_files in os.walk(path):
-                files.add(root)
-                for f in dir_files:
-                    files.add(os.path.join(root, f))
-            return list(files)
+            self.logger.log(message, self.tag, level, *args)
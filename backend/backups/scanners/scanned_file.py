@@ -0,0 +1,32 @@
+import stat
+
+"""
+A lightweight record of a single scanned path.
+Scanners keep one of these per found file instead of a full BackupItem,
+and only the files that actually have to be backed up are turned into BackupItems.
+The attribute names follow os.stat_result, so a ScannedFile can be
+used anywhere a stat result is expected.
+"""
+
+class ScannedFile:
+
+    __slots__ = ('path', 'st_mode', 'st_size', 'st_mtime_ns', 'st_ctime_ns', 'st_ino', 'st_dev')
+
+    def __init__(self, path, file_stat):
+        self.path = path
+        self.st_mode = file_stat.st_mode
+        self.st_size = file_stat.st_size
+        self.st_mtime_ns = file_stat.st_mtime_ns
+        self.st_ctime_ns = file_stat.st_ctime_ns
+        self.st_ino = file_stat.st_ino
+        self.st_dev = file_stat.st_dev
+
+    @property
+    def st_mtime(self):
+        return self.st_mtime_ns / 1e9
+
+    def is_directory(self):
+        return stat.S_ISDIR(self.st_mode)
+
+    def __repr__(self):
+        return 'ScannedFile({!r})'.format(self.path)
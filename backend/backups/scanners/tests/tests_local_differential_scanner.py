@@ -5,8 +5,8 @@ from tempfile import TemporaryDirectory
 from django.test import TestCase
 from django.utils import timezone
 
-from backups.models import Backup
-from becky.utils import path_to_folders, join_file_path
+from backups.models import Backup, DifferentialInformation
+from becky.utils import path_to_folders, join_file_path, create_test_files
 
 class LocalDifferentialScannerTests(TestCase):
 
@@ -77,5 +77,40 @@ class LocalDifferentialScannerTests(TestCase):
         backup_file = self.backup_model.add_backup_file(folder_to_scan.name)
         folder_to_scan.cleanup()
         backup_info = self.backup_model.run_backup()
-        self.assertSetEqual(set(backup_info['new_files']), set()) # No file should've been found
+        self.assertEqual(backup_info['new_files'], 0) # No file should've been found
 
+    def test_scan_unchanged_files(self):
+        """
+        Makes sure a scan without any changes flags nothing and doesn't create duplicate differential rows.
+        """
+        folder_to_scan = TemporaryDirectory()
+        create_test_files(folder_to_scan.name, 50)
+        backup_file = self.backup_model.add_backup_file(folder_to_scan.name)
+        first_found_files = list(self.scanner.scan_files([backup_file], timezone.now()))
+        diff_count = DifferentialInformation.objects.filter(backup=self.backup_model).count()
+        self.assertEqual(diff_count, len(first_found_files)) # Everything is new on the first scan
+        for i in range(0, 2):
+            found_files = list(self.scanner.scan_files([backup_file], timezone.now()))
+            self.assertListEqual(found_files, [])
+            self.assertEqual(DifferentialInformation.objects.filter(backup=self.backup_model).count(), diff_count)
+        folder_to_scan.cleanup()
+
+    def test_scan_nested_selections(self):
+        """
+        Makes sure selecting both a folder and something inside it yields every file only once.
+        """
+        folder_to_scan = TemporaryDirectory()
+        folder = os.path.join(folder_to_scan.name, 'folder')
+        files = [
+            join_file_path(folder_to_scan.name, 'folder', 'normal_file'),
+            join_file_path(folder_to_scan.name, 'other_file'),
+        ]
+        os.mkdir(folder)
+        open(files[0], "w").write('normal_data')
+        open(files[1], "w").write('other_data')
+        backup_files = [self.backup_model.add_backup_file(p) for p in [folder, files[0], folder_to_scan.name]]
+        found_files = self.scanner.scan_files(backup_files, timezone.now())
+        found_files_paths = [f.path for f in found_files]
+        self.assertEqual(len(found_files_paths), len(set(found_files_paths)))
+        self.assertSetEqual(set(found_files_paths), set(path_to_folders(folder) + files))
+        folder_to_scan.cleanup()
@@ -0,0 +1,45 @@
+import os
+from tempfile import TemporaryDirectory
+from django.test import TestCase
+
+from backups.scanners.walker import ParallelWalker
+from becky.utils import create_test_files
+
+class ParallelWalkerTests(TestCase):
+
+    def test_walk_matches_os_walk(self):
+        """
+        Makes sure the parallel walker finds exactly the same files and folders as os.walk does
+        and that the stat results kept with the paths are correct.
+        """
+        folder_to_scan = TemporaryDirectory()
+        for i in range(0, 5):
+            create_test_files(folder_to_scan.name, 50)
+        expected_files = set()
+        for root, directories, files in os.walk(folder_to_scan.name):
+            expected_files.add(root)
+            for f in files:
+                expected_files.add(os.path.join(root, f))
+        walker = ParallelWalker(workers=4)
+        found_files = list(walker.walk(folder_to_scan.name))
+        self.assertSetEqual(set([f.path for f in found_files]), expected_files)
+        self.assertEqual(len(found_files), len(expected_files)) # No path should be found twice
+        for f in found_files:
+            self.assertEqual(f.st_size, os.stat(f.path).st_size)
+            self.assertEqual(f.st_mtime_ns, os.stat(f.path).st_mtime_ns)
+            self.assertEqual(f.is_directory(), os.path.isdir(f.path))
+        folder_to_scan.cleanup()
+
+    def test_walk_skips_symlinked_folders(self):
+        """
+        Symlinked folders should not be followed nor listed, same as with os.walk.
+        """
+        folder_to_scan = TemporaryDirectory()
+        other_folder = TemporaryDirectory()
+        open(os.path.join(other_folder.name, 'outside_file'), 'w').write('outside')
+        os.symlink(other_folder.name, os.path.join(folder_to_scan.name, 'link'))
+        open(os.path.join(folder_to_scan.name, 'inside_file'), 'w').write('inside')
+        found_files = list(ParallelWalker(workers=2).walk(folder_to_scan.name))
+        self.assertSetEqual(set([f.path for f in found_files]), set([folder_to_scan.name, os.path.join(folder_to_scan.name, 'inside_file')]))
+        other_folder.cleanup()
+        folder_to_scan.cleanup()
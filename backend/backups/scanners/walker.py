@@ -0,0 +1,72 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from backups.scanners.scanned_file import ScannedFile
+
+"""
+A directory walker built on os.scandir.
+Each directory is listed in its own task, so subdirectories
+are spread over a thread pool instead of walked one at a time.
+The stat result of every found path is kept with the path as a ScannedFile,
+so later stages don't have to stat the same file again.
+Results are yielded as soon as a directory has been listed. Only a bounded
+amount of directory listings is kept in flight, so a slow consumer
+pauses the walk instead of letting the results pile up in memory.
+"""
+
+class ParallelWalker:
+
+    def __init__(self, workers=8, progress_callback=None):
+        self.workers = max(1, int(workers))
+        self.max_pending = self.workers * 2
+        self.progress_callback = progress_callback
+
+    def walk(self, path):
+        """
+        Walks through the given path and yields a ScannedFile
+        of every file and folder inside it, including the path itself.
+        Symlinked folders are not followed, same as with os.walk.
+        """
+        yield ScannedFile(path, os.stat(path))
+        found_count = 1
+        directories = deque([path])
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            while directories or pending:
+                while directories and len(pending) < self.max_pending:
+                    pending.add(executor.submit(self._scan_directory, directories.popleft()))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entries, subdirectories = future.result()
+                    directories.extend(subdirectories)
+                    found_count += len(entries)
+                    yield from entries
+                if self.progress_callback:
+                    self.progress_callback(path, found_count)
+
+    def _scan_directory(self, path):
+        """
+        Lists a single directory.
+        Returns the found entries as ScannedFiles and the
+        subdirectories that still have to be walked.
+        Entries that disappear or can't be read while scanning are skipped.
+        """
+        entries = []
+        directories = []
+        try:
+            with os.scandir(path) as iterator:
+                for entry in iterator:
+                    try:
+                        is_directory = entry.is_dir()
+                        if is_directory and entry.is_symlink():
+                            continue
+                        entry_stat = entry.stat()
+                    except OSError:
+                        continue
+                    if is_directory:
+                        directories.append(entry.path)
+                    entries.append(ScannedFile(entry.path, entry_stat))
+        except OSError:
+            pass
+        return entries, directories
@@ -0,0 +1,156 @@
+import os
+import shlex
+import shutil
+import tempfile
+import threading
+import subprocess
+import time
+
+"""
+Multiplexed SSH connections to remote servers.
+One master connection (an OpenSSH ControlMaster) is kept open per remote address and identity,
+and every ssh, scp and rsync call is run through its control socket, so only the master pays for the handshake.
+Connections are shared through get_connection() and closed by release_connection() once nobody uses them anymore.
+If the master can't be started, the calls simply fall back to connecting on their own.
+"""
+
+MASTER_START_TIMEOUT = 30 # Seconds to wait for the master connection to come up
+SERVER_ALIVE_INTERVAL = 30
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(remote_addr, identity_path):
+    """
+    Returns the open SSHConnection to the given address with the given identity, opening it if needed.
+    Every call has to be paired with a call to release_connection().
+    """
+    key = (remote_addr, identity_path)
+    with _connections_lock:
+        connection = _connections.get(key)
+        if connection is None:
+            connection = SSHConnection(remote_addr, identity_path)
+            _connections[key] = connection
+        connection.users += 1
+    connection.open()
+    return connection
+
+def release_connection(connection):
+    """
+    Stops using the given connection. The master is closed once the last user has released it.
+    """
+    with _connections_lock:
+        connection.users -= 1
+        if connection.users > 0:
+            return
+        _connections.pop((connection.remote_addr, connection.identity_path), None)
+    connection.close()
+
+
+class SSHConnection:
+
+    def __init__(self, remote_addr, identity_path):
+        self.remote_addr = remote_addr
+        self.identity_path = identity_path
+        self.users = 0
+        self.lock = threading.Lock()
+        self.master = None
+        self.socket_folder = None
+
+    def open(self):
+        """
+        Starts the master connection, unless it is already running.
+        Returns whether the master is up.
+        """
+        with self.lock:
+            if self.is_open():
+                return True
+            self._close_master()
+            self.socket_folder = tempfile.mkdtemp(prefix='becky-ssh-')
+            try:
+                self.master = subprocess.Popen(['ssh'] + self.get_options(master=True) + ['-N', self.remote_addr], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                self._close_master()
+                return False
+            started_at = time.monotonic()
+            while self.master.poll() is None and time.monotonic() - started_at < MASTER_START_TIMEOUT:
+                if os.path.exists(self.get_socket_path()):
+                    return True
+                time.sleep(0.05)
+            if not self.is_open():
+                self._close_master()
+                return False
+            return True
+
+    def is_open(self):
+        return self.master is not None and self.master.poll() is None and os.path.exists(self.get_socket_path())
+
+    def close(self):
+        with self.lock:
+            self._close_master()
+
+    def get_socket_path(self):
+        return os.path.join(self.socket_folder, 'master') if self.socket_folder else None
+
+    def get_options(self, master=False):
+        """
+        Returns the ssh options for connecting through the master, or for being the master.
+        """
+        options = ['-i', self.identity_path]
+        if self.socket_folder:
+            options += ['-o', 'ControlPath={}'.format(self.get_socket_path())]
+            options += ['-o', 'ControlMaster=yes', '-o', 'BatchMode=yes', '-o', 'ServerAliveInterval={}'.format(SERVER_ALIVE_INTERVAL)] if master else ['-o', 'ControlMaster=no']
+        return options
+
+    def get_ssh_command(self):
+        """
+        Returns the ssh command line for tools that take one, like rsync -e.
+        """
+        return ' '.join(shlex.quote(part) for part in ['ssh'] + self.get_options())
+
+    def run(self, remote_command, **kwargs):
+        """
+        Runs the given shell command on the remote server and returns the CompletedProcess.
+        Keyword arguments are passed on to subprocess.run.
+        """
+        return subprocess.run(['ssh'] + self.get_options() + [self.remote_addr, remote_command], **kwargs)
+
+    def popen(self, remote_command, **kwargs):
+        """
+        Starts the given shell command on the remote server and returns the Popen object,
+        for streaming data to and from it.
+        """
+        return subprocess.Popen(['ssh'] + self.get_options() + [self.remote_addr, remote_command], **kwargs)
+
+    def rsync(self, arguments, **kwargs):
+        """
+        Runs rsync with the given arguments over this connection. Remote paths are given as 'remote_addr:path'.
+        """
+        return subprocess.run(['rsync', '-e', self.get_ssh_command()] + arguments, **kwargs)
+
+    def popen_rsync(self, arguments, **kwargs):
+        """
+        Starts rsync with the given arguments over this connection and returns the Popen object.
+        """
+        return subprocess.Popen(['rsync', '-e', self.get_ssh_command()] + arguments, **kwargs)
+
+    def copy_to(self, local_path, remote_path, **kwargs):
+        return subprocess.run(['scp'] + self.get_options() + [local_path, '{}:{}'.format(self.remote_addr, remote_path)], **kwargs)
+
+    def copy_from(self, remote_path, local_path, **kwargs):
+        return subprocess.run(['scp'] + self.get_options() + ['{}:{}'.format(self.remote_addr, remote_path), local_path], **kwargs)
+
+    def _close_master(self):
+        if self.master is not None:
+            if self.master.poll() is None:
+                subprocess.run(['ssh'] + self.get_options() + ['-O', 'exit', self.remote_addr], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    self.master.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self.master.kill()
+                    self.master.wait()
+            self.master = None
+        if self.socket_folder:
+            shutil.rmtree(self.socket_folder, ignore_errors=True)
+            self.socket_folder = None
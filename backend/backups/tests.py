@@ -1,3 +1,456 @@
+import os
+import json
+import time
+import errno
+import subprocess
+from types import SimpleNamespace
+import datetime
+from tempfile import TemporaryDirectory
 from django.test import TestCase
+from django.utils import timezone
 
-# Create your tests here.
+from backups.models import Backup, BackupItem, BackupStatus, ChecksumCache, ChecksumCacheEntry
+from backups.pipeline import ChecksumStage
+from backups import chunking
+from backups.copying import CopyEngine
+from backups.packs import PackWriter, read_pack_slice
+from backups.compression import ProbingCompressor, InvalidCompressionLevelException, compress_bytes, decompress_bytes, is_compressible
+from backups.remote_checksums import iter_remote_checksums, RemoteChecksumException
+from backups.providers.differential_remote_provider import RsyncProgress, RsyncFile
+from backups.ssh import get_connection, release_connection, _connections
+from backups.throttling import TokenBucket, SharedTokenBucket, parse_rate
+from settings.models import GlobalParameter
+from becky.utils import calculate_checksum
+
+class ProgressReporterTests(TestCase):
+
+    def setUp(self):
+        self.backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        self.backup_model.save()
+        self.backup_model.add_parameter('status_interval_ms', '60000')
+
+    def test_status_writes_are_rate_limited(self):
+        """
+        Makes sure frequent status updates are kept in memory and only the first one
+        of the interval hits the database.
+        """
+        for i in range(0, 100):
+            self.backup_model.set_status('Scanning {}'.format(i), i, True)
+        self.assertEqual(BackupStatus.objects.filter(backup=self.backup_model).count(), 1)
+        self.assertEqual(BackupStatus.objects.get(backup=self.backup_model).message, 'Scanning 0')
+        self.assertEqual(self.backup_model.get_status(), {'status_message': 'Scanning 99', 'percentage': 99, 'running': True})
+
+    def test_status_is_written_when_stopping(self):
+        """
+        Stopping the backup (or forcing the write) should always update the database right away.
+        """
+        self.backup_model.set_status('Scanning', 10, True)
+        self.backup_model.set_status('Copying', 50, True, force=True)
+        self.assertEqual(BackupStatus.objects.get(backup=self.backup_model).message, 'Copying')
+        self.backup_model.set_status('Idle', 0, False)
+        status = BackupStatus.objects.get(backup=self.backup_model)
+        self.assertEqual(status.to_json(), {'status_message': 'Idle', 'percentage': 0, 'running': False})
+
+    def test_percentage_is_kept(self):
+        """
+        A status update without a percentage should keep the previous percentage.
+        """
+        self.backup_model.set_status('Scanning', 42, True)
+        self.backup_model.set_status('Still scanning', None, True, force=True)
+        self.assertEqual(BackupStatus.objects.get(backup=self.backup_model).percentage, 42)
+
+
+class ChecksumStageTests(TestCase):
+
+    def setUp(self):
+        self.backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        self.backup_model.save()
+
+    def test_checksums_in_order(self):
+        """
+        Makes sure both thread and process pools hash every item and yield the items in their original order.
+        """
+        test_directory = TemporaryDirectory()
+        paths = [test_directory.name]
+        for i in range(0, 50):
+            path = os.path.join(test_directory.name, 'file_{}'.format(i))
+            open(path, 'wb').write(os.urandom(i * 100))
+            paths.append(path)
+        for pool in ['thread', 'process']:
+            backup_items = [self.backup_model.create_backup_file_instance(path) for path in paths]
+            stage = ChecksumStage(algorithm='sha256', workers=3, pool=pool)
+            hashed_items = list(stage.process(iter(backup_items)))
+            self.assertListEqual([item.path for item in hashed_items], paths)
+            for item in hashed_items:
+                self.assertEqual(item.checksum, calculate_checksum(item.path, 'sha256'))
+                self.assertEqual(item.checksum_algorithm, 'sha256')
+        test_directory.cleanup()
+
+
+class ChecksumCacheTests(TestCase):
+
+    def test_unchanged_file_is_not_hashed_again(self):
+        """
+        A file with the same stat fingerprint should get its checksum from the cache,
+        while a modified file should be hashed again.
+        """
+        test_directory = TemporaryDirectory()
+        path = os.path.join(test_directory.name, 'file')
+        open(path, 'wb').write(b'original')
+        cache = ChecksumCache()
+        checksum = calculate_checksum(path, 'sha256', cache=cache)
+        cache.flush()
+        self.assertEqual(ChecksumCacheEntry.objects.count(), 1)
+        ChecksumCacheEntry.objects.update(checksum='cached')
+        self.assertEqual(calculate_checksum(path, 'sha256', cache=ChecksumCache()), 'cached')
+        self.assertEqual(calculate_checksum(path, 'md5', cache=ChecksumCache()), calculate_checksum(path, 'md5'))
+        file_stat = os.stat(path)
+        os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1000))
+        self.assertEqual(calculate_checksum(path, 'sha256', cache=ChecksumCache()), checksum)
+        test_directory.cleanup()
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """
+        The cache should never hold more entries than its maximum size after flushing,
+        and the entries that go should be the ones that were used least recently.
+        """
+        cache = ChecksumCache(max_entries=3)
+        for i in range(0, 3):
+            cache.put((1, i, 1, 1, 1), 'md5', str(i))
+        cache.flush()
+        self.assertEqual(cache.get((1, 0, 1, 1, 1), 'md5'), '0')
+        for i in range(3, 5):
+            cache.put((1, i, 1, 1, 1), 'md5', str(i))
+        cache.flush()
+        self.assertEqual(sorted(ChecksumCacheEntry.objects.values_list('checksum', flat=True)), ['0', '3', '4'])
+
+
+class ChunkingTests(TestCase):
+
+    def test_vectorized_cuts_match_the_loop(self):
+        """
+        The numpy rolling hash has to cut files at exactly the same places as the plain loop,
+        otherwise chunks stored with one would never be reused with the other.
+        """
+        if chunking.GEAR_ARRAY is None:
+            self.skipTest('numpy is not installed.')
+        test_directory = TemporaryDirectory()
+        path = os.path.join(test_directory.name, 'file')
+        open(path, 'wb').write(os.urandom(300 * 1024) + bytes(100 * 1024) + os.urandom(300 * 1024))
+        chunker = chunking.ContentDefinedChunker(average_size=16 * 1024)
+        vectorized_chunks = list(chunker.chunks(path))
+        gear_array, chunking.GEAR_ARRAY = chunking.GEAR_ARRAY, None
+        try:
+            looped_chunks = list(chunker.chunks(path))
+        finally:
+            chunking.GEAR_ARRAY = gear_array
+        self.assertEqual([len(chunk) for chunk in vectorized_chunks], [len(chunk) for chunk in looped_chunks])
+        self.assertEqual(b''.join(vectorized_chunks), open(path, 'rb').read())
+        test_directory.cleanup()
+
+
+class PackWriterTests(TestCase):
+
+    def test_failed_append_keeps_offsets_right(self):
+        """
+        A write that fails halfway should not shift the offsets of the entries appended after it.
+        """
+        test_directory = TemporaryDirectory()
+        writer = PackWriter(test_directory.name)
+        writer.append(b'first')
+        segment_write = writer.segment.write
+        def fail_after_short_write(data):
+            segment_write(bytes(data[:3]))
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        writer.segment.write = fail_after_short_write
+        with self.assertRaises(OSError):
+            writer.append(b'second')
+        writer.segment.write = segment_write
+        segment_name, offset = writer.append(b'third')
+        writer.close()
+        self.assertEqual(read_pack_slice(os.path.join(test_directory.name, segment_name), offset, 5), b'third')
+        test_directory.cleanup()
+
+
+class CompressionTests(TestCase):
+
+    def test_codecs_roundtrip(self):
+        data = b'Some very compressible data. ' * 1000
+        for codec in ['zlib', 'lzma', 'bz2']:
+            compressed = compress_bytes(data, codec, 6)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(decompress_bytes(compressed, codec), data)
+
+    def test_compressed_content_is_detected(self):
+        """
+        Files should be skipped by their extension or by the entropy of their first block.
+        """
+        self.assertTrue(is_compressible('/data.csv', first_block=b'1,2,3\n' * 1000))
+        self.assertFalse(is_compressible('/data.bin', first_block=os.urandom(100000)))
+        self.assertFalse(is_compressible('/photo.JPG', first_block=b'a' * 100))
+
+    def test_probing_compressor_decides_on_the_first_chunk(self):
+        compressor = ProbingCompressor('zlib', 6)
+        data = compressor.compress(b'1,2,3\n' * 1000) + compressor.flush()
+        self.assertEqual(compressor.codec, 'zlib')
+        self.assertEqual(decompress_bytes(data, 'zlib'), b'1,2,3\n' * 1000)
+        random_data = os.urandom(100000)
+        compressor = ProbingCompressor('zlib', 6)
+        data = compressor.compress(random_data) + compressor.compress(b'a' * 1000) + compressor.flush()
+        self.assertEqual(compressor.codec, 'none')
+        self.assertEqual(data, random_data + b'a' * 1000)
+
+    def test_compression_level_is_validated(self):
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_model.add_parameter('compression', 'zlib')
+        backup_model.add_parameter('compression_level', '6')
+        self.assertEqual(backup_model.get_compression(), ('zlib', 6))
+        for level in ['fast', '10']:
+            backup_model.add_parameter('compression_level', level)
+            with self.assertRaises(InvalidCompressionLevelException):
+                backup_model.get_compression()
+
+
+class CopyEngineTests(TestCase):
+
+    def test_every_strategy_copies(self):
+        """
+        Each strategy should either copy the file or fall back to the next one, ending with a buffered copy.
+        """
+        test_directory = TemporaryDirectory()
+        source_path = os.path.join(test_directory.name, 'source')
+        content = os.urandom(3 * 1024 * 1024 + 123)
+        open(source_path, 'wb').write(content)
+        for strategy in ['clone', 'copy_file_range', 'sendfile', 'buffered']:
+            engine = CopyEngine([strategy])
+            destination_path = os.path.join(test_directory.name, strategy)
+            used_strategy = engine.copy(source_path, destination_path)
+            self.assertIn(used_strategy, [strategy, 'buffered'])
+            self.assertEqual(open(destination_path, 'rb').read(), content)
+            self.assertEqual(sum(engine.statistics.values()), 1)
+        test_directory.cleanup()
+
+    def test_failing_buffered_copy_raises(self):
+        """
+        An error in the buffered copy should be raised every time, never hidden as an unsupported strategy.
+        """
+        test_directory = TemporaryDirectory()
+        source_path = os.path.join(test_directory.name, 'source')
+        open(source_path, 'wb').write(b'data')
+        engine = CopyEngine(['buffered'])
+        def fail(source, destination, size):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        engine._copy_buffered = fail
+        for _ in range(0, 2):
+            with self.assertRaises(OSError):
+                engine.copy(source_path, os.path.join(test_directory.name, 'destination'))
+        self.assertEqual(len(engine.unsupported), 0)
+        test_directory.cleanup()
+
+
+class ThrottlingTests(TestCase):
+
+    def setUp(self):
+        self.backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        self.backup_model.save()
+
+    def tearDown(self):
+        GlobalParameter.objects.filter(key='bandwidth_limit').delete()
+        self.backup_model.get_rate_limiter().refresh(force=True)
+
+    def test_rates_are_parsed(self):
+        self.assertEqual(parse_rate(''), 0)
+        self.assertEqual(parse_rate('500'), 500)
+        self.assertEqual(parse_rate('2k'), 2048)
+        self.assertEqual(parse_rate('1.5M'), 1.5 * 1024 * 1024)
+
+    def test_bucket_limits_rate(self):
+        bucket = TokenBucket(1000)
+        started_at = time.monotonic()
+        for i in range(0, 5):
+            bucket.consume(100)
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.45)
+        bucket.set_rate(0)
+        started_at = time.monotonic()
+        bucket.consume(10 ** 9)
+        self.assertLess(time.monotonic() - started_at, 0.1)
+
+    def test_shared_buckets_share_tokens(self):
+        """
+        Buckets in different processes share their tokens through the same file.
+        """
+        test_directory = TemporaryDirectory()
+        path = os.path.join(test_directory.name, 'bucket')
+        first_bucket, second_bucket = SharedTokenBucket(path, 1000), SharedTokenBucket(path, 1000)
+        started_at = time.monotonic()
+        first_bucket.consume(250)
+        second_bucket.consume(250)
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.45)
+        test_directory.cleanup()
+
+    def test_invalid_limits_are_ignored(self):
+        self.backup_model.add_parameter('bandwidth_limit', '10MB')
+        limiter = self.backup_model.get_rate_limiter()
+        limiter.refresh(force=True)
+        self.assertEqual(limiter.get_bandwidth_limit(), 0)
+
+    def test_limits_are_refreshed(self):
+        """
+        The backup's own limit and the global one should both apply, and changes should be picked up by refresh.
+        """
+        limiter = self.backup_model.get_rate_limiter()
+        self.assertEqual(limiter.get_bandwidth_limit(), 0)
+        self.backup_model.add_parameter('bandwidth_limit', '10M')
+        GlobalParameter.save_parameter('bandwidth_limit', '1M')
+        limiter.refresh()
+        self.assertEqual(limiter.get_bandwidth_limit(), 0) # Refreshed too recently
+        limiter.refresh(force=True)
+        self.assertEqual(limiter.get_bandwidth_limit(), 1024 * 1024)
+        GlobalParameter.save_parameter('bandwidth_limit', '')
+        limiter.refresh(force=True)
+        self.assertEqual(limiter.get_bandwidth_limit(), 10 * 1024 * 1024)
+
+    def test_copies_are_throttled(self):
+        test_directory = TemporaryDirectory()
+        source_path = os.path.join(test_directory.name, 'source')
+        content = os.urandom(512 * 1024)
+        open(source_path, 'wb').write(content)
+        self.backup_model.add_parameter('bandwidth_limit', '1M')
+        limiter = self.backup_model.get_rate_limiter()
+        limiter.refresh(force=True)
+        engine = CopyEngine(['copy_file_range', 'buffered'], limiter)
+        started_at = time.monotonic()
+        engine.copy(source_path, os.path.join(test_directory.name, 'destination'))
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.4)
+        self.assertEqual(open(os.path.join(test_directory.name, 'destination'), 'rb').read(), content)
+        test_directory.cleanup()
+
+
+class SSHConnectionTests(TestCase):
+
+    def test_connections_are_shared(self):
+        """
+        The same address and identity should share one connection until its last user releases it.
+        Without a reachable server the connection stays closed and commands connect on their own.
+        """
+        first = get_connection('_test@localhost', '/nonexistent/id_rsa')
+        second = get_connection('_test@localhost', '/nonexistent/id_rsa')
+        self.assertIs(first, second)
+        self.assertEqual(first.users, 2)
+        release_connection(first)
+        self.assertIn(('_test@localhost', '/nonexistent/id_rsa'), _connections)
+        release_connection(second)
+        self.assertNotIn(('_test@localhost', '/nonexistent/id_rsa'), _connections)
+        self.assertFalse(first.is_open())
+        self.assertNotIn('ControlPath', ' '.join(first.get_options()))
+
+
+class LocalConnection:
+    """
+    Runs 'remote' commands on the local machine, in place of an SSHConnection.
+    """
+
+    def popen(self, remote_command, **kwargs):
+        return subprocess.Popen(['sh', '-c', remote_command], **kwargs)
+
+
+class RemoteChecksumTests(TestCase):
+
+    def test_checksums_are_streamed_back(self):
+        """
+        Every readable file should come back with the same checksum the local engine calculates,
+        whatever its name. Missing files are left out.
+        """
+        test_directory = TemporaryDirectory()
+        paths = []
+        for name in ['plain', 'with space', 'with\nnewline', 'with\ttab', 'ä']:
+            path = os.path.join(test_directory.name, name)
+            open(path, 'wb').write(os.urandom(100000))
+            paths.append(path)
+        for algorithm in ['md5', 'sha256', 'blake2b']:
+            checksums = dict(iter_remote_checksums(LocalConnection(), paths + [os.path.join(test_directory.name, 'missing')], algorithm, workers=3))
+            self.assertEqual(checksums, {path: calculate_checksum(path, algorithm) for path in paths})
+        test_directory.cleanup()
+
+    def test_failing_helper_raises(self):
+        """
+        An algorithm the remote server can't use should raise with the reason, not report every file as missing.
+        """
+        with self.assertRaises(RemoteChecksumException) as context:
+            list(iter_remote_checksums(LocalConnection(), ['/etc/hostname'], 'no-such-algorithm'))
+        self.assertIn('no-such-algorithm', str(context.exception))
+
+
+class FailingRsyncConnection:
+    """
+    Stands in for an SSHConnection, every rsync call fails if its file list contains a path with 'bad' in it.
+    """
+
+    def popen_rsync(self, arguments, **kwargs):
+        files_from = open(arguments[arguments.index('--files-from') + 1]).read()
+        return subprocess.Popen(['sh', '-c', 'exit 23' if 'bad' in files_from else 'exit 0'], **kwargs)
+
+
+class RsyncShardTests(TestCase):
+
+    def test_files_of_failed_shards_are_returned(self):
+        backup_model = Backup(name='_test_backup', provider='remote+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_model.add_parameter('providerSettings', json.dumps({'remote_path': '/backups', 'remote_addr': 'localhost', 'ssh_id_path': '~/.ssh/id_rsa', 'rsync_shards': 2}))
+        provider = backup_model.get_backup_provider()
+        provider.connection = FailingRsyncConnection()
+        files = [RsyncFile('/data/good', 100), RsyncFile('/data/bad', 100)]
+        self.assertEqual(provider._run_sharded_rsync(files, '/', 'localhost:/backups'), [RsyncFile('/data/bad', 100)])
+        self.assertEqual(provider._run_sharded_rsync(files[:1], '/', 'localhost:/backups'), [])
+
+    def test_incomplete_snapshot_is_not_recorded(self):
+        """
+        Files of a failed shard should be left out, and a snapshot with failed files should never become the base of the next run.
+        """
+        backup_model = Backup(name='_test_backup', provider='remote+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        backup_model.add_parameter('providerSettings', json.dumps({'remote_path': '/backups', 'remote_addr': 'localhost', 'ssh_id_path': '~/.ssh/id_rsa', 'layout': 'versioned', 'rsync_shards': 2}))
+        provider = backup_model.get_backup_provider()
+        provider.connection = FailingRsyncConnection()
+        files = [SimpleNamespace(path='/data/good', file_size=100), SimpleNamespace(path='/data/bad', file_size=100)]
+        backed_up_files = list(provider.backup_files(files))
+        self.assertEqual([file_in.path for file_in in backed_up_files], ['/data/good'])
+        self.assertEqual(backed_up_files[0].storage_format, 'snapshot')
+        self.assertEqual(provider.get_failed_files(), ['/data/bad'])
+        self.assertFalse(backup_model.metadata.filter(key='last_snapshot').exists())
+        list(provider.backup_files(files[:1]))
+        self.assertTrue(backup_model.metadata.filter(key='last_snapshot').exists())
+
+
+class RsyncProgressTests(TestCase):
+
+    def test_output_of_shards_is_summed(self):
+        progress = RsyncProgress()
+        progress.read([b'100 home/user/a\n', b'0 home/user/\n', b'250 home/user/with space\n'])
+        progress.read([b'50 home/b\n', b'sending incremental file list\n'])
+        self.assertEqual(progress.get(), (3, 400))
+
+
+class RestoreItemTests(TestCase):
+
+    def test_restore_items_come_from_the_catalog(self):
+        """
+        The newest version of each selected item at the given time should be resolved with a single query,
+        without matching folders that merely share a prefix with the selection.
+        """
+        backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        backup_model.save()
+        now = timezone.now()
+        def add_item(path, file_type, age):
+            BackupItem(backup=backup_model, path=path, directory=path.rsplit('/', 1)[0] or '/', filename=path.rsplit('/', 1)[1], file_type=file_type, checksum=str(age), creation_time=now - datetime.timedelta(days=age)).save()
+        add_item('/data', 'directory', 3)
+        add_item('/data/a', 'file', 3)
+        add_item('/data/a', 'file', 2)
+        add_item('/data/a', 'file', 0)
+        add_item('/data/sub/b', 'file', 3)
+        add_item('/database/c', 'file', 3)
+        add_item('/Data/sub/d', 'file', 3)
+        with self.assertNumQueries(1):
+            items = backup_model.get_restore_items(['/data/'], now - datetime.timedelta(days=1))
+        self.assertEqual([(item.path, item.checksum) for item in items], [('/data', '3'), ('/data/a', '2'), ('/data/sub/b', '3')])
@@ -0,0 +1,191 @@
+import os
+import time
+import fcntl
+import tempfile
+import threading
+
+from settings.models import GlobalParameter
+
+"""
+Token bucket rate limiting of the I/O done by backups.
+The limits are the 'bandwidth_limit' (bytes per second) and 'operation_limit' (files per second) parameters.
+Set on a backup, a limit applies to that backup. Set as a global parameter, it applies to all backups
+running on this machine together, whichever process runs them (the cron jobs start a new process every minute).
+The tokens of the global limits are kept in files in GLOBAL_BUCKET_FOLDER, which each process locks while taking tokens.
+Both limits are enforced if both are set.
+Values can have a K, M or G suffix (powers of 1024). An empty value or 0 means no limit.
+A value that can't be parsed is logged and treated as no limit, so it never stops a backup, restore or verify.
+
+The limits are read again from the database every REFRESH_INTERVAL seconds while a run is in progress,
+so they can be changed without restarting it. Reading them is done by refresh(), which has to be called
+from the thread that owns the database connection. Consuming tokens is safe from any thread.
+"""
+
+BANDWIDTH_LIMIT = 'bandwidth_limit'
+OPERATION_LIMIT = 'operation_limit'
+LIMITS = [BANDWIDTH_LIMIT, OPERATION_LIMIT]
+REFRESH_INTERVAL = 5
+THROTTLED_SLICE_SIZE = 256 * 1024 # How much data is moved at a time when bandwidth is limited
+RATE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+GLOBAL_BUCKET_FOLDER = os.path.join(tempfile.gettempdir(), 'becky-rate-limits')
+
+
+class TokenBucket:
+    """
+    A token bucket that refills at rate tokens per second and holds up to a second worth of tokens.
+    Consuming more tokens than there are puts the bucket into debt, and the caller sleeps until the debt is paid.
+    This way a single large consume never gets stuck and concurrent consumers are served in turn.
+    """
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Changes the rate of the bucket. A rate of 0 disables limiting.
+        """
+        with self.lock:
+            self._refill()
+            self.rate = max(float(rate), 0)
+            self.tokens = min(self.tokens, self.rate)
+
+    def consume(self, amount):
+        """
+        Takes the given amount of tokens from the bucket, sleeping until they have been refilled if needed.
+        """
+        with self.lock:
+            if self.rate <= 0:
+                return
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A token bucket whose tokens are kept in a file, so every process using the same file takes from the same tokens.
+    The file is locked while the tokens are updated. Each process sets the rate itself, from the same global parameter.
+    """
+
+    def __init__(self, path, rate=0):
+        self.path = path
+        super().__init__(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = max(float(rate), 0)
+
+    def consume(self, amount):
+        rate = self.rate
+        if rate <= 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            now = time.time()
+            tokens, updated_at = self._parse_state(f.read(), now)
+            tokens = min(rate, tokens + max(now - updated_at, 0) * rate) - amount
+            f.seek(0)
+            f.truncate()
+            f.write('{} {}'.format(tokens, now))
+        wait = -tokens / rate if tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def _parse_state(self, state, now):
+        """
+        Returns the tokens and update time saved in the file, or an empty bucket if the file is new.
+        """
+        try:
+            tokens, updated_at = state.split()
+            return float(tokens), float(updated_at)
+        except ValueError:
+            return 0, now
+
+
+GLOBAL_BUCKETS = {key: SharedTokenBucket(os.path.join(GLOBAL_BUCKET_FOLDER, key)) for key in LIMITS} # Shared by all backups on this machine
+
+
+class RateLimiter:
+    """
+    Limits the I/O of a single backup by both its own limits and the global ones.
+    """
+
+    def __init__(self, backup_model):
+        self.backup_model = backup_model
+        self.buckets = {key: TokenBucket() for key in LIMITS}
+        self.invalid_values = set()
+        self.refreshed_at = None
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """
+        Reads the limits from the database again, unless that was done less than REFRESH_INTERVAL seconds ago.
+        """
+        now = time.monotonic()
+        if not force and self.refreshed_at is not None and now - self.refreshed_at < REFRESH_INTERVAL:
+            return
+        self.refreshed_at = now
+        for key in LIMITS:
+            backup_parameter = self.backup_model.parameters.filter(key=key).first() if self.backup_model.pk else None
+            self.buckets[key].set_rate(self._parse_limit(key, backup_parameter.value if backup_parameter else None))
+            global_parameter = GlobalParameter.get_global_parameter(key)
+            GLOBAL_BUCKETS[key].set_rate(self._parse_limit(key, global_parameter.value if global_parameter else None))
+
+    def consume_bytes(self, amount):
+        self._consume(BANDWIDTH_LIMIT, amount)
+
+    def consume_operations(self, amount=1):
+        self._consume(OPERATION_LIMIT, amount)
+
+    def get_bandwidth_limit(self):
+        """
+        Returns the number of bytes per second this backup may currently move, or 0 if there is no limit.
+        """
+        rates = [bucket.rate for bucket in (self.buckets[BANDWIDTH_LIMIT], GLOBAL_BUCKETS[BANDWIDTH_LIMIT]) if bucket.rate > 0]
+        return int(min(rates)) if rates else 0
+
+    def _parse_limit(self, key, value):
+        """
+        Returns the given limit as a number, or 0 if it can't be parsed.
+        Each invalid value is only logged once.
+        """
+        try:
+            return parse_rate(value)
+        except ValueError:
+            if (key, value) not in self.invalid_values:
+                self.invalid_values.add((key, value))
+                self.backup_model.get_logger().log("Ignoring invalid {} '{}', use a number with an optional K, M or G suffix.", 'BACKUP', 'WARNING', key, value)
+            return 0
+
+    def _consume(self, key, amount):
+        self.buckets[key].consume(amount)
+        GLOBAL_BUCKETS[key].consume(amount)
+
+
+def parse_rate(value):
+    """
+    Returns the given rate, like '500', '200K' or '10M', as a number. Empty values are 0.
+    Raises ValueError if the value isn't a valid rate.
+    """
+    if value is None:
+        return 0
+    value = str(value).strip().upper()
+    if not value:
+        return 0
+    multiplier = RATE_SUFFIXES.get(value[-1], 1)
+    if value[-1] in RATE_SUFFIXES:
+        value = value[:-1]
+    return float(value) * multiplier
@@ -0,0 +1,53 @@
+import hashlib
+import os
+from tempfile import TemporaryDirectory
+from django.test import TestCase
+
+from becky.utils import calculate_checksum, copy_file_with_checksum, get_hasher, split_balanced, UnsupportedChecksumAlgorithmException, CHECKSUM_CHUNK_SIZE
+
+class ChecksumTests(TestCase):
+
+    def test_streamed_checksum_matches_hashlib(self):
+        """
+        Makes sure hashing a file in chunks gives the same result as hashing the whole content at once.
+        The file is made larger than a single chunk on purpose.
+        """
+        test_directory = TemporaryDirectory()
+        test_file_path = os.path.join(test_directory.name, 'file')
+        content = os.urandom(CHECKSUM_CHUNK_SIZE * 2 + 123)
+        open(test_file_path, 'wb').write(content)
+        for algorithm in ['md5', 'sha256', 'blake2b']:
+            self.assertEqual(calculate_checksum(test_file_path, algorithm), hashlib.new(algorithm, content).hexdigest())
+        self.assertEqual(calculate_checksum(test_file_path), hashlib.md5(content).hexdigest()) # MD5 is still the default
+        self.assertEqual(calculate_checksum(test_directory.name), '0')
+        test_directory.cleanup()
+
+    def test_unsupported_algorithm(self):
+        with self.assertRaises(UnsupportedChecksumAlgorithmException):
+            get_hasher('crc32')
+
+    def test_copy_file_with_checksum(self):
+        """
+        Makes sure the copy is identical to the original and the returned checksum matches its content.
+        """
+        test_directory = TemporaryDirectory()
+        source_path = os.path.join(test_directory.name, 'source')
+        destination_path = os.path.join(test_directory.name, 'destination')
+        content = os.urandom(CHECKSUM_CHUNK_SIZE + 1)
+        open(source_path, 'wb').write(content)
+        checksum = copy_file_with_checksum(source_path, destination_path, 'sha256')
+        self.assertEqual(open(destination_path, 'rb').read(), content)
+        self.assertEqual(checksum, hashlib.sha256(content).hexdigest())
+        test_directory.cleanup()
+
+
+class SplitBalancedTests(TestCase):
+
+    def test_weights_are_balanced(self):
+        sizes = [100, 1, 50, 50, 30, 20, 2, 1]
+        shards = split_balanced(sizes, 3, lambda size: size)
+        self.assertEqual(sorted(sum(shard) for shard in shards), [74, 80, 100])
+        self.assertEqual(sorted(size for shard in shards for size in shard), sorted(sizes))
+        self.assertEqual(shards[0], [100]) # Heaviest first, original order kept within a shard
+        self.assertEqual(split_balanced([5], 4, lambda size: size), [[5]])
+        self.assertEqual(split_balanced([], 4, lambda size: size), [])
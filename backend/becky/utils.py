@@ -2,6 +2,7 @@ import os
 import uuid
 import random
 import hashlib
+import heapq
 import datetime
 from django.utils.timezone import make_aware
 from nose.tools import nottest
@@ -68,19 +69,113 @@ def path_to_folders(path):
     return folders
 
 
-def calculate_checksum(path):
+def batched(iterable, batch_size):
     """
-    Calculates a MD5 hash of the file at the given path.
+    Splits the given iterable into lists of at most batch_size items.
+    Items are consumed lazily, so only one batch is kept in memory at a time.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def split_balanced(items, count, weight):
+    """
+    Splits the given items into at most count lists with total weights as even as possible.
+    The heaviest items are placed first, each into the lightest list so far.
+    Items keep their original order within each list. Empty lists are left out.
+    """
+    shards = [(0, shard_index, []) for shard_index in range(max(1, count))]
+    for item_index in sorted(range(len(items)), key=lambda i: weight(items[i]), reverse=True):
+        total, shard_index, shard = heapq.heappop(shards)
+        shard.append(item_index)
+        heapq.heappush(shards, (total + weight(items[item_index]), shard_index, shard))
+    return [[items[i] for i in sorted(shard)] for _, _, shard in sorted(shards, key=lambda s: s[1]) if shard]
+
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024 # Files are hashed one chunk at a time, never read to memory as a whole
+DEFAULT_CHECKSUM_ALGORITHM = 'md5'
+CHECKSUM_ALGORITHMS = ['md5', 'sha256', 'blake2b', 'xxhash']
+
+def get_hasher(algorithm=DEFAULT_CHECKSUM_ALGORITHM):
+    """
+    Returns a new hash object for the given checksum algorithm.
+    md5, sha256 and blake2b come from hashlib, xxhash (xxh64) needs
+    the optional xxhash package to be installed.
+    """
+    if algorithm in ('md5', 'sha256', 'blake2b'):
+        return hashlib.new(algorithm)
+    elif algorithm == 'xxhash':
+        try:
+            import xxhash
+        except ImportError:
+            raise UnsupportedChecksumAlgorithmException(algorithm, message="The xxhash package is not installed.")
+        return xxhash.xxh64()
+    else:
+        raise UnsupportedChecksumAlgorithmException(algorithm)
+
+def iter_file_chunks(path, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """
+    Yields the content of the file at the given path in chunks of chunk_size bytes.
+    The same buffer is reused for every chunk, so the yielded memoryviews are only
+    valid until the next chunk is read.
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            read_count = f.readinto(buffer)
+            if not read_count:
+                break
+            yield view[:read_count]
+
+def calculate_checksum(path, algorithm=DEFAULT_CHECKSUM_ALGORITHM, cache=None):
+    """
+    Calculates a hash of the file at the given path with the given algorithm.
+    The file is streamed in fixed size chunks, so memory use doesn't depend on the file size.
+    If a checksum cache is given, it is consulted first with the stat fingerprint of the file
+    and the calculated checksum is added to it.
     """
     if os.path.isdir(path):
         return '0'
     else:
-        content = open(path, 'rb').read()
-        checksum = hashlib.md5()
-        checksum.update(content)
+        if cache is not None:
+            fingerprint = cache.fingerprint(path)
+            checksum = cache.get(fingerprint, algorithm)
+            if checksum is not None:
+                return checksum
+        checksum = get_hasher(algorithm)
+        for chunk in iter_file_chunks(path):
+            checksum.update(chunk)
         checksum = checksum.hexdigest()
+        if cache is not None:
+            cache.put(fingerprint, algorithm, checksum) # Fingerprint was taken before hashing, so a file changed meanwhile never matches it again
         return checksum
 
+def copy_file_with_checksum(source_path, destination_path, algorithm=DEFAULT_CHECKSUM_ALGORITHM, compressor=None, limiter=None):
+    """
+    Copies the file at source_path to destination_path and returns the checksum of the copied data.
+    The checksum is calculated from the same chunks that are written to the destination,
+    so the file is only read once and the checksum always matches the copy.
+    If a compressor (an object with compress() and flush() methods) is given, the chunks are
+    compressed on the way. The checksum is still calculated from the uncompressed data.
+    If a limiter (see backups.throttling) is given, each chunk waits for its share of the bandwidth.
+    """
+    checksum = get_hasher(algorithm)
+    with open(destination_path, 'wb') as destination:
+        for chunk in iter_file_chunks(source_path):
+            if limiter is not None:
+                limiter.consume_bytes(len(chunk))
+            checksum.update(chunk)
+            destination.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            destination.write(compressor.flush())
+    return checksum.hexdigest()
+
 def unix_timestamp_to_dt(timestamp):
     """
     Turns a unix timestamp into a django aware datetime object.
@@ -91,3 +186,14 @@ def unix_timestamp_to_dt(timestamp):
     backup_timestamp = backup_timestamp.replace(microsecond=int(microseconds))
     return backup_timestamp
 
+
+
+class UnsupportedChecksumAlgorithmException(Exception):
+
+    def __init__(self, algorithm, message="Attempted to use an unsupported checksum algorithm."):
+        self.algorithm = algorithm
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return "{} -- Checksum algorithm {} is not supported.".format(self.message, str(self.algorithm))
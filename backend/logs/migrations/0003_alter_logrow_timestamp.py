@@ -0,0 +1,19 @@
+# Generated by Django 3.2 on 2026-10-18 06:29
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0002_alter_logrow_backup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='logrow',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,4 +1,7 @@
+import time
+import threading
 from django.db import models
+from django.utils import timezone
 
 from becky.utils import format_timestamp_gui
 
@@ -8,7 +11,7 @@ class LogRow(models.Model):
     level = models.CharField(max_length=32, null=False)
     tag = models.CharField(max_length=32, null=False)
     message = models.CharField(max_length=512, null=False)
-    timestamp = models.DateTimeField(auto_now=True)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     def to_json(self):
         return {'backup_id': self.backup.id, 'level': self.level, 'tag': self.tag, 'message': self.message, 'timestamp': format_timestamp_gui(self.timestamp)}
@@ -17,37 +20,101 @@ class LogRow(models.Model):
 
 """
 Backupper that any scanner or provider can use to add logs to specific backup model.
+In buffered mode, rows are collected in memory and written with a single bulk insert
+once the buffer is full or old enough, or when flush() is called.
+Messages below the minimum level of the backup ('log_level' parameter) are dropped
+before any row is created. An invalid 'log_level' is logged as a warning and DEBUG is used instead,
+so a bad parameter never stops a backup, restore or verify.
 """
 class BackupLogger:
 
-    def __init__(self, backup_model):
-        self.backup_model = backup_model
+    levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR'] # From the least to the most severe
 
-    def log(self, message, tag, level):
+    def __init__(self, backup_model, buffered=False, buffer_size=200, flush_interval=5.0, min_level=None):
+        self.backup_model = backup_model
+        self.buffered = buffered
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.owner_thread = threading.get_ident()
+        if min_level:
+            self._check_level_validity(min_level)
+            self.min_level = min_level
+        else:
+            self.min_level = self._get_min_level()
+
+    def log(self, message, tag, level, *args):
         """
         Adds a single row level log with the supplied message. Tag and the level are applied to log.
+        Any extra arguments are formatted into the message, but only if the level is not filtered out.
         """
         self._check_level_validity(level)
+        if not self.is_enabled_for(level):
+            return
+        if args:
+            message = message.format(*args)
         self._add_log_row(message, tag, level)
         self._print_log(message, tag, level)
 
+    def is_enabled_for(self, level):
+        """
+        Returns whether messages of the given level are saved at all.
+        """
+        return self.levels.index(level) >= self.levels.index(self.min_level)
+
+    def flush(self):
+        """
+        Writes all buffered log rows to the DB.
+        """
+        if not self.buffer:
+            self.last_flush = time.monotonic()
+            return
+        rows, self.buffer = self.buffer, []
+        try:
+            LogRow.objects.bulk_create(rows, batch_size=self.buffer_size)
+        except Exception as e:
+            raise FailedToLogException(e)
+        self.last_flush = time.monotonic()
+
     def _add_log_row(self, message, tag, level):
         """
         Creates a new LogRow object and saves it to the DB.
+        In buffered mode the row is only written once the buffer is flushed.
         """
         try:
-            log_model = LogRow(backup=self.backup_model, level=level, tag=tag, message=message)
-            log_model.save()
+            log_model = LogRow(backup=self.backup_model, level=level, tag=tag, message=message, timestamp=timezone.now())
+            if not self.buffered:
+                log_model.save()
+                return
         except Exception as e:
             raise FailedToLogException(e)
+        self.buffer.append(log_model)
+        if threading.get_ident() != self.owner_thread:
+            return # Rows logged from worker threads are written by the next flush of the owning thread
+        if len(self.buffer) >= self.buffer_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _get_min_level(self):
+        """
+        Returns the minimum log level set for the backup model, defaulting to DEBUG.
+        An invalid level is warned about and DEBUG is used instead.
+        """
+        if not self.backup_model.pk:
+            return 'DEBUG'
+        level = self.backup_model.get_parameter_value('log_level', 'DEBUG').upper()
+        if level not in self.levels:
+            self.min_level = 'DEBUG'
+            self.log("Ignoring invalid log_level '{}', logging everything. Valid levels are {}.", 'LOGGER', 'WARNING', level, ', '.join(self.levels))
+            return 'DEBUG'
+        return level
 
     def _check_level_validity(self, level):
         """
         Checks whether the given 'level' is valid.
         If not, throws an error.
         """
-        allowed_levels = ['INFO', 'WARNING', 'ERROR', 'DEBUG']
-        if level not in allowed_levels:
+        if level not in self.levels:
             raise InvalidLogLevelException(level)
 
     def _print_log(self, message, tag, level):
@@ -1,3 +1,47 @@
 from django.test import TestCase
 
-# Create your tests here.
+from backups.models import Backup
+from logs.models import BackupLogger, LogRow
+
+class BackupLoggerTests(TestCase):
+
+    def setUp(self):
+        self.backup_model = Backup(name='_test_backup', provider='local+differential', scanner='local+differential', running=0)
+        self.backup_model.save()
+
+    def test_buffered_logger_flushes_in_bulk(self):
+        """
+        Makes sure a buffered logger keeps rows in memory until its buffer is full or it is flushed.
+        """
+        logger = BackupLogger(self.backup_model, buffered=True, buffer_size=10, flush_interval=60)
+        for i in range(0, 9):
+            logger.log('Message {}', 'TEST', 'INFO', i)
+        self.assertEqual(LogRow.objects.filter(backup=self.backup_model).count(), 0)
+        logger.log('Message {}', 'TEST', 'INFO', 9)
+        self.assertEqual(LogRow.objects.filter(backup=self.backup_model).count(), 10)
+        logger.log('Message {}', 'TEST', 'INFO', 10)
+        logger.flush()
+        messages = set(LogRow.objects.filter(backup=self.backup_model).values_list('message', flat=True))
+        self.assertSetEqual(messages, set(['Message {}'.format(i) for i in range(0, 11)]))
+
+    def test_min_level_drops_messages(self):
+        """
+        Messages below the 'log_level' parameter of the backup should never be saved.
+        """
+        self.backup_model.add_parameter('log_level', 'INFO')
+        logger = BackupLogger(self.backup_model)
+        logger.log('Debug message', 'TEST', 'DEBUG')
+        logger.log('Info message', 'TEST', 'INFO')
+        logger.log('Error message', 'TEST', 'ERROR')
+        messages = set(LogRow.objects.filter(backup=self.backup_model).values_list('message', flat=True))
+        self.assertSetEqual(messages, set(['Info message', 'Error message']))
+
+    def test_invalid_min_level_falls_back_to_debug(self):
+        """
+        An invalid 'log_level' parameter should be warned about instead of breaking the logger.
+        """
+        self.backup_model.add_parameter('log_level', 'verbose')
+        logger = BackupLogger(self.backup_model)
+        logger.log('Debug message', 'TEST', 'DEBUG')
+        levels = list(LogRow.objects.filter(backup=self.backup_model).order_by('id').values_list('level', flat=True))
+        self.assertListEqual(levels, ['WARNING', 'DEBUG'])
@@ -5,7 +5,7 @@ class GlobalParameter(models.Model):
     key = models.CharField(max_length=128, null=False)
     value = models.CharField(max_length=128, null=False)
 
-    supported_parameters = ['fs_root', 'test_setting']
+    supported_parameters = ['fs_root', 'test_setting', 'scan_workers', 'status_interval_ms', 'log_level', 'checksum_algorithm', 'checksum_workers', 'checksum_pool', 'checksum_cache_size', 'compression', 'compression_level', 'bandwidth_limit', 'operation_limit']
 
     @classmethod
     def get_all_global_parameters(cls):
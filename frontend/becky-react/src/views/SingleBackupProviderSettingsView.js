@@ -41,6 +41,7 @@ class SingleBackupProviderSettingsView extends React.Component {
         var component = '';
         switch(this.state.provider) {
             case 'local+differential':
+            case 'local+snapshot':
                 component = <LocalProvider changeProviderParameter={this.changeProviderSettings} defaultSettings={this.state.providerSettings}/>;
                 break
             case 'remote+differential':
@@ -80,6 +81,7 @@ class SingleBackupProviderSettingsView extends React.Component {
                             <Select native value={this.state.provider} onChange={this.handleChangeProvider} inputProps={{name: 'provider'}}>
                                   <option aria-label="None" value="" />
                                   <option value={'local+differential'}>Local</option>
+                                  <option value={'local+snapshot'}>Local (Browsable snapshots)</option>
                                   <option value={'remote+differential'}>Remote (Over SSH)</option>
                                   <option value={'s3+differential'}>S3 compatible object storage</option>
                             </Select>